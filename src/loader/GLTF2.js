@@ -55,6 +55,72 @@ define(function (require) {
         5123: vendor.Uint16Array,
         5126: vendor.Float32Array
     };
+    // Max value of normalized integer component types
+    var NORMALIZE_MAP = {
+        5120: 127,
+        5121: 255,
+        5122: 32767,
+        5123: 65535
+    };
+
+    function normalizeComponents(values, componentType) {
+        var max = NORMALIZE_MAP[componentType];
+        var out = [];
+        for (var i = 0; i < values.length; i++) {
+            // Signed value -max - 1 is also -1
+            out[i] = Math.max(values[i] / max, -1);
+        }
+        return out;
+    }
+
+    function readQuantizedAttribute(buffer, byteOffset, byteStride, accessorInfo, ArrayCtor, size) {
+        var count = accessorInfo.count;
+        var elementSize = ArrayCtor.BYTES_PER_ELEMENT;
+        var stride = byteStride ? byteStride / elementSize : size;
+        var srcArray = new ArrayCtor(buffer, byteOffset, count > 0 ? (count - 1) * stride + size : 0);
+        var scale = accessorInfo.normalized ? 1 / NORMALIZE_MAP[accessorInfo.componentType] : 1;
+        var signed = accessorInfo.componentType === 5120 || accessorInfo.componentType === 5122;
+        var out = new vendor.Float32Array(count * size);
+        for (var i = 0; i < count; i++) {
+            for (var k = 0; k < size; k++) {
+                var val = srcArray[i * stride + k] * scale;
+                out[i * size + k] = (signed && accessorInfo.normalized) ? Math.max(val, -1) : val;
+            }
+        }
+        return out;
+    }
+
+    // Mip levels written by the converter in image extras, all levels are
+    // uploaded after they are loaded, before that mipmaps are generated.
+    function loadMipmaps(texture, uris, crossOrigin) {
+        var images = [texture.image];
+        var loading = uris.length + 1;
+        function onload() {
+            loading--;
+            if (!loading) {
+                texture.mipmaps = images.map(function (image) {
+                    return { image: image };
+                });
+                texture.dirty();
+            }
+        }
+        if (texture.image.complete) {
+            onload();
+        }
+        else {
+            texture.once('success', onload);
+        }
+        for (var i = 0; i < uris.length; i++) {
+            var image = new Image();
+            if (crossOrigin) {
+                image.crossOrigin = crossOrigin;
+            }
+            image.onload = onload;
+            image.src = uris[i];
+            images.push(image);
+        }
+    }
+
     var SIZE_MAP = {
         SCALAR: 1,
         VEC2: 2,
@@ -396,7 +462,27 @@ define(function (require) {
                 if (target === glenum.TEXTURE_2D) {
                     var texture = new Texture2D(parameters);
                     var imageInfo = json.images[textureInfo.source];
-                    texture.load(util.relative2absolute(imageInfo.uri, rootPath), this.crossOrigin);
+                    if (imageInfo.bufferView != null) {
+                        // Image packed in the buffer
+                        var bufferViewInfo = json.bufferViews[imageInfo.bufferView];
+                        var buffer = lib.buffers[bufferViewInfo.buffer];
+                        var blob = new Blob([
+                            new Uint8Array(buffer, bufferViewInfo.byteOffset || 0, bufferViewInfo.byteLength)
+                        ], { type: imageInfo.mimeType });
+                        var objectURL = URL.createObjectURL(blob);
+                        texture.once('success', function () {
+                            URL.revokeObjectURL(objectURL);
+                        });
+                        texture.load(objectURL);
+                    }
+                    else {
+                        texture.load(util.relative2absolute(imageInfo.uri, rootPath), this.crossOrigin);
+                    }
+                    if (imageInfo.extras && imageInfo.extras.mipmaps) {
+                        loadMipmaps(texture, imageInfo.extras.mipmaps.map(function (uri) {
+                            return util.relative2absolute(uri, rootPath);
+                        }), this.crossOrigin);
+                    }
                     lib.textures[idx] = texture;
                 }
             }, this);
@@ -642,14 +728,34 @@ define(function (require) {
 
                         var size;
                         var ArrayCtor;
-                        var attributeArray = new ArrayCtor(buffer, byteOffset, attributeInfo.count * size);
+                        var attributeArray;
+                        var byteStride = bufferViewInfo.byteStride || 0;
+                        if (ArrayCtor === vendor.Float32Array && byteStride <= size * 4) {
+                            attributeArray = new ArrayCtor(buffer, byteOffset, attributeInfo.count * size);
+                        }
+                        else {
+                            // Quantized attributes (KHR_mesh_quantization), attributes in QTEK are all float
+                            attributeArray = readQuantizedAttribute(buffer, byteOffset, byteStride, attributeInfo, ArrayCtor, size);
+                        }
                         if (semantic === 'WEIGHTS_0' && size === 4) {
                             // Weight data in QTEK has only 3 component, the last component can be evaluated since it is normalized
-                            var weightArray = new ArrayCtor(attributeInfo.count * 3);
+                            var weightArray = new vendor.Float32Array(attributeInfo.count * 3);
+                            // Skinning in QTEK has 4 joints per vertex, JOINTS_1 and WEIGHTS_1 are dropped.
+                            // Weights are sorted in descending order, the 4 largest are renormalized.
+                            var hasMoreWeights = primitiveInfo.attributes.WEIGHTS_1 != null;
+                            if (hasMoreWeights) {
+                                console.warn('GLTFLoader only support 4 joints per vertex, JOINTS_1 and WEIGHTS_1 are ignored.');
+                            }
                             for (var i = 0; i < attributeInfo.count; i++) {
-                                weightArray[i * 3] = attributeArray[i * 4];
-                                weightArray[i * 3 + 1] = attributeArray[i * 4 + 1];
-                                weightArray[i * 3 + 2] = attributeArray[i * 4 + 2];
+                                var weightScale = 1;
+                                if (hasMoreWeights) {
+                                    var weightSum = attributeArray[i * 4] + attributeArray[i * 4 + 1]
+                                        + attributeArray[i * 4 + 2] + attributeArray[i * 4 + 3];
+                                    weightScale = weightSum > 0 ? 1 / weightSum : 0;
+                                }
+                                weightArray[i * 3] = attributeArray[i * 4] * weightScale;
+                                weightArray[i * 3 + 1] = attributeArray[i * 4 + 1] * weightScale;
+                                weightArray[i * 3 + 2] = attributeArray[i * 4 + 2] * weightScale;
                             }
                             geometry.attributes[attributeName].value = weightArray;
                         }
@@ -660,6 +766,10 @@ define(function (require) {
                             // Bounding Box
                             var min = attributeInfo.min;
                             var max = attributeInfo.max;
+                            if (attributeInfo.normalized) {
+                                min = min && normalizeComponents(min, componentType);
+                                max = max && normalizeComponents(max, componentType);
+                            }
                             if (min) {
                                 geometry.boundingBox.min.set(min[0], min[1], min[2]);
                             }
@@ -822,6 +932,17 @@ define(function (require) {
                 return new ArrayCtor(buffer, byteOffset, size * accessorInfo.count);
             }
 
+            function getCubicSplineValues(output, size) {
+                var count = output.length / size / 3;
+                var values = new vendor.Float32Array(count * size);
+                for (var i = 0; i < count; i++) {
+                    for (var k = 0; k < size; k++) {
+                        values[i * size + k] = output[(i * 3 + 1) * size + k];
+                    }
+                }
+                return values;
+            }
+
             function checkChannelPath(channelInfo) {
                 if (channelInfo.path === 'weights') {
                     console.warn('GLTFLoader not support morph targets yet.');
@@ -877,9 +998,9 @@ define(function (require) {
                             loop: true,
                             onframe: clipOnframe
                         });
-                        clip.channels.time = getAccessorData(samplerInfo.input);
+                        // Time accessor may be shared by samplers of other nodes, copy it before scaling.
+                        clip.channels.time = new vendor.Float32Array(getAccessorData(samplerInfo.input));
                         var frameLen = clip.channels.time.length;
-                        // TODO May share same buffer data ?
                         for (var k = 0; k < frameLen; k++) {
                             clip.channels.time[k] *= 1000;
                         }
@@ -897,7 +1018,12 @@ define(function (require) {
                         path = 'position';
                     }
 
-                    clip.channels[path] = getAccessorData(samplerInfo.output);
+                    var output = getAccessorData(samplerInfo.output);
+                    if (interpolation === 'CUBICSPLINE') {
+                        // Keep values between in and out tangents, keys are interpolated linearly.
+                        output = getCubicSplineValues(output, SIZE_MAP[json.accessors[samplerInfo.output].type]);
+                    }
+                    clip.channels[path] = output;
                 }
 
                 for (var key in clips) {
@@ -22,6 +22,15 @@ except ImportError:
     print(msg)
     sys.exit(1)
 
+# NumPy is optional, only used to speed up vertex welding.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Vertex welding shared with fbx2gltf2
+from meshutils import ToNumpyArray, QuantizeKey, WeldVertexStreams
+
 lib_materials = {}
 lib_techniques = {}
 
@@ -84,6 +93,10 @@ GL_LINEAR_MIPMAP_LINEAR = 0x2703
 GL_ARRAY_BUFFER = 0x8892
 GL_ELEMENT_ARRAY_BUFFER = 0x8893
 
+_useNumpy = not np == None
+# Positions, normals and uvs closer than epsilon will be welded to one vertex
+_weldEpsilon = 0
+
 _id = 0
 def GetId():
     global _id
@@ -488,6 +501,12 @@ def ConvertVertexLayer(pMesh, pLayer, pOutput):
 
         return True
 
+def PickWeldedVertices(pValues, pSplitted, pFirst, pControlPoints):
+    if pSplitted:
+        return [pValues[idx] for idx in pFirst]
+    else:
+        return [pValues[idx] for idx in pControlPoints]
+
 def CreateSkin():
     lSkinName = "skin_" + str(len(lib_skins.keys()))
     # https://github.com/KhronosGroup/glTF/issues/100
@@ -622,7 +641,35 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
         for i in range(len(lWeights)):
             lWeights[i] = lWeights[i][:3]
 
-        if lNormalSplitted or lUvSplitted or lUv2Splitted:
+        if (lNormalSplitted or lUvSplitted or lUv2Splitted) and _useNumpy:
+            lStreams = [(ToNumpyArray(pMesh.GetControlPoints(), 3), False)]
+            if lLayerNormal:
+                lStreams.append((ToNumpyArray(lNormals, 3), lNormalSplitted))
+            if lLayerUV:
+                lStreams.append((ToNumpyArray(lTexcoords, 2), lUvSplitted))
+            if lLayer2Uv:
+                lStreams.append((ToNumpyArray(lTexcoords2, 2), lUv2Splitted))
+
+            lPolygonVertices = np.array(pMesh.GetPolygonVertices(), dtype=np.int64)
+            lIndices, lColumns, lFirst = WeldVertexStreams(lPolygonVertices, lStreams, _weldEpsilon)
+
+            # Keep the original vertex data, min and max of accessors are computed from them.
+            lIndices = lIndices.tolist()
+            lControlPoints = lPolygonVertices[lFirst].tolist()
+            lFirst = lFirst.tolist()
+            lPositions = [pMesh.GetControlPointAt(idx) for idx in lControlPoints]
+            if lLayerNormal:
+                lNormals = PickWeldedVertices(lNormals, lNormalSplitted, lFirst, lControlPoints)
+            if lLayerUV:
+                lTexcoords = PickWeldedVertices(lTexcoords, lUvSplitted, lFirst, lControlPoints)
+            if lLayer2Uv:
+                lTexcoords2 = PickWeldedVertices(lTexcoords2, lUv2Splitted, lFirst, lControlPoints)
+
+            if hasSkin:
+                lWeights = [lWeights[idx] for idx in lControlPoints]
+                lJoints = [lJoints[idx] for idx in lControlPoints]
+
+        elif lNormalSplitted or lUvSplitted or lUv2Splitted:
             lCount = 0
             lVertexCount = 0
             lNormalsTmp = []
@@ -648,7 +695,7 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
 
                 if lLayer2Uv:
                     if not lUv2Splitted:
-                        lTexcoord = lTexcoords2[idx]
+                        lTexcoord2 = lTexcoords2[idx]
                     else:
                         lTexcoord2 = lTexcoords2[lCount]
 
@@ -665,6 +712,9 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
                 else:
                     lKey = (lPosition[0], lPosition[1], lPosition[2], lNormal[0], lNormal[1], lNormal[2])
 
+                if _weldEpsilon > 0:
+                    lKey = QuantizeKey(lKey, _weldEpsilon)
+
                 if lKey in lVertexMap:
                     lIndices.append(lVertexMap[lKey])
                 else:
@@ -1194,7 +1244,13 @@ def Convert(
     animFrameRate = 1 / 20,
     startTime = 0,
     duration = 1000,
-    poseTime = TIME_INFINITY):
+    poseTime = TIME_INFINITY,
+    useNumpy = True,
+    weldEpsilon = 0):
+
+    global _useNumpy, _weldEpsilon
+    _useNumpy = useNumpy and not np == None
+    _weldEpsilon = weldEpsilon
 
     ignoreScene = 'scene' in excluded
     ignoreAnimation = 'animation' in excluded
@@ -1267,6 +1323,8 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output', default='', type=str, help="Ouput glTF file path")
     parser.add_argument('-f', '--framerate', default=20, type=float, help="Animation frame per sencond")
     parser.add_argument('-p', '--pose', default=-1, type=float, help="Static pose time")
+    parser.add_argument('--no-numpy', action='store_true', help="Weld vertices without numpy even if it is installed")
+    parser.add_argument('-w', '--weld', default=0, type=float, help="Weld vertices closer than this epsilon, 0 to weld only identical vertices")
     parser.add_argument('file')
 
     args = parser.parse_args()
@@ -1290,4 +1348,14 @@ if __name__ == "__main__":
 
     excluded = args.exclude.split(',')
 
-    Convert(args.file, args.output, excluded, 1 / args.framerate, lStartTime, lDuration, lPoseTime)
\ No newline at end of file
+    Convert(
+        args.file,
+        args.output,
+        excluded,
+        1 / args.framerate,
+        lStartTime,
+        lDuration,
+        lPoseTime,
+        useNumpy = not args.no_numpy,
+        weldEpsilon = args.weld
+    )
\ No newline at end of file
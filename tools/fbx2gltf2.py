@@ -6,6 +6,9 @@
 # http://github.com/pissang/
 # ############################################
 import sys, struct, json, os.path, math, argparse
+import time, glob, traceback, multiprocessing, hashlib, shutil, collections
+import concurrent.futures
+from multiprocessing.connection import wait
 
 try:
     from FbxCommon import *
@@ -22,38 +25,24 @@ except ImportError:
     print(msg)
     sys.exit(1)
 
-lib_materials = []
-
-lib_images = []
-lib_samplers = []
-lib_textures = []
-
-# attributes, indices, anim_parameters will be merged in accessors
-lib_attributes_accessors = []
-lib_indices_accessors = []
-lib_animation_accessors = []
-lib_ibm_accessors = []
-lib_accessors = []
-
-lib_buffer_views = []
-lib_buffers = []
-
-lib_cameras = []
-lib_meshes = []
-
-lib_nodes = []
-lib_scenes = []
+# NumPy is optional, only used to speed up packing of large buffers.
+try:
+    import numpy as np
+except ImportError:
+    np = None
 
-lib_skins = []
+# Vertex welding shared with fbx2gltf
+import meshutils
+from meshutils import ListFromM4, ToNumpyArray, QuantizeKey, WeldVertexStreams
 
-lib_animations = []
+# Source files of the converter, cached conversions are invalid after any of them is modified.
+_converterFiles = [__file__, meshutils.__file__]
 
-# Only python 3 support bytearray ?
-# http://dabeaz.blogspot.jp/2010/01/few-useful-bytearray-tricks.html
-attributeBuffer = bytearray()
-indicesBuffer = bytearray()
-invBindMatricesBuffer = bytearray()
-animationBuffer = bytearray()
+# Pillow is optional, only used in the texture processing.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
 
 GL_RGBA = 0x1908
 
@@ -81,17 +70,72 @@ GL_LINEAR_MIPMAP_LINEAR = 0x2703
 GL_ARRAY_BUFFER = 0x8892
 GL_ELEMENT_ARRAY_BUFFER = 0x8893
 
+# https://github.com/KhronosGroup/glTF/tree/master/specification/2.0#glb-file-format-specification
+GLB_MAGIC = 0x46546C67
+GLB_VERSION = 2
+GLB_CHUNK_JSON = 0x4E4F534A
+GLB_CHUNK_BIN = 0x004E4942
+
+# Little endian numpy dtypes of struct format characters
+_numpyDTypeMap = {
+    'f' : '<f4',
+    'I' : '<u4',
+    'H' : '<u2',
+    'h' : '<i2',
+    'B' : '<u1',
+    'b' : '<i1'
+}
+
+# Max integer of normalized component types
+_normalizedMaxMap = {
+    'H' : 65535,
+    'h' : 32767,
+    'B' : 255,
+    'b' : 127
+}
+
 _id = 0
 def GetId():
     global _id
     _id = _id + 1
     return _id
 
-def ListFromM4(m):
-    return [m[0][0], m[0][1], m[0][2], m[0][3], m[1][0], m[1][1], m[1][2], m[1][3], m[2][0], m[2][1], m[2][2], m[2][3], m[3][0], m[3][1], m[3][2], m[3][3]]
+def GetComponent(pList, pIdx, pStride, pComponent):
+    lItem = pList[pIdx]
+    if pStride == 1:
+        lValue = lItem
+    elif pStride == 16:
+        lValue = ListFromM4(lItem)[pComponent]
+    else:
+        lValue = lItem[pComponent]
+    # Numpy scalars can't be serialized to json
+    if isinstance(lValue, np.generic):
+        lValue = lValue.item()
+    return lValue
 
-def CreateAccessorBuffer(pList, pType, pStride, minMax = False):
-    lGLTFAcessor = {}
+def PackNumpy(pList, pType, pStride, minMax):
+    lArray = ToNumpyArray(pList, pStride)
+    lData = lArray.astype(_numpyDTypeMap[pType]).tobytes()
+
+    lMin = lMax = None
+    if minMax:
+        if len(pList) > 0:
+            # Pick the original items so min, max are same with the struct
+            # packing, both in value and in type.
+            lMinIdx = np.argmin(lArray, axis=0)
+            lMaxIdx = np.argmax(lArray, axis=0)
+            lMin = [GetComponent(pList, lMinIdx[i], pStride, i) for i in range(pStride)]
+            lMax = [GetComponent(pList, lMaxIdx[i], pStride, i) for i in range(pStride)]
+        else:
+            lMax = [0] * pStride
+            lMin = [0] * pStride
+
+    return lData, lMin, lMax
+
+def CreateAccessorBuffer(pList, pType, pStride, minMax = False, useNumpy = False):
+    if useNumpy:
+        lData, lMin, lMax = PackNumpy(pList, pType, pStride, minMax)
+        return lData, CreateAccessor(len(pList), pType, pStride, lMin, lMax)
 
     lType = '<' + pType * pStride
     lData = []
@@ -137,6 +181,14 @@ def CreateAccessorBuffer(pList, pType, pStride, minMax = False):
                     lMin[i] = min(lMin[i], item[i])
                     lMax[i] = max(lMax[i], item[i])
 
+    if not minMax:
+        lMin = lMax = None
+
+    return b''.join(lData), CreateAccessor(len(pList), pType, pStride, lMin, lMax)
+
+def CreateAccessor(pCount, pType, pStride, pMin, pMax):
+    lGLTFAcessor = {}
+
     if pType == 'f':
         lGLTFAcessor['componentType'] = GL_FLOAT
     # Unsigned Int
@@ -147,6 +199,13 @@ def CreateAccessorBuffer(pList, pType, pStride, minMax = False):
     elif pType == 'H':
         lGLTFAcessor['componentType'] = GL_UNSIGNED_SHORT
 
+    elif pType == 'h':
+        lGLTFAcessor['componentType'] = GL_SHORT
+    elif pType == 'B':
+        lGLTFAcessor['componentType'] = GL_UNSIGNED_BYTE
+    elif pType == 'b':
+        lGLTFAcessor['componentType'] = GL_BYTE
+
     if pStride == 1:
         lGLTFAcessor['type'] = 'SCALAR'
     elif pStride == 2:
@@ -161,65 +220,616 @@ def CreateAccessorBuffer(pList, pType, pStride, minMax = False):
         lGLTFAcessor['type'] = 'MAT4'
 
     lGLTFAcessor['byteOffset'] = 0
-    lGLTFAcessor['count'] = len(pList)
+    lGLTFAcessor['count'] = pCount
+
+    if not pMin == None:
+        lGLTFAcessor['max'] = pMax
+        lGLTFAcessor['min'] = pMin
+
+    return lGLTFAcessor
+
+
+# Quantize values in [-1, 1] or [0, 1] to normalized integers
+def QuantizeNormalized(pArray, pType):
+    lMax = _normalizedMaxMap[pType]
+    lLow = -1 if pType in ('h', 'b') else 0
+    return np.round(np.clip(pArray, lLow, 1) * lMax).astype(_numpyDTypeMap[pType])
+
+# Uniform scale and offset mapping the bounding box to [-1, 1]. Uniform scale
+# keeps the normals unchanged after dequantization.
+def GetQuantizationBounds(pPositions):
+    if len(pPositions) == 0:
+        return [0.0, 0.0, 0.0], 1.0
+    lMin = pPositions.min(axis=0)
+    lMax = pPositions.max(axis=0)
+    lScale = float((lMax - lMin).max()) / 2
+    if lScale == 0:
+        lScale = 1.0
+    return ((lMin + lMax) / 2).tolist(), lScale
+
+def QuantizePositions(pPositions, pBounds):
+    lOffset, lScale = pBounds
+    return QuantizeNormalized((pPositions - lOffset) / lScale, 'h')
+
+# Column major matrix transforming normalized positions back to the mesh space
+def GetDequantizationMatrix(pBounds):
+    lOffset, lScale = pBounds
+    return [lScale, 0, 0, 0, 0, lScale, 0, 0, 0, 0, lScale, 0, lOffset[0], lOffset[1], lOffset[2], 1]
+
+# Normalized unsigned byte weights which still sum to 255
+def QuantizeWeights(pWeights):
+    lSum = pWeights.sum(axis=1, keepdims=True)
+    lWeights = np.divide(pWeights, lSum, out=np.zeros_like(pWeights), where=lSum > 0)
+    lQuantized = np.round(lWeights * 255).astype(np.int64)
+    lRows = np.nonzero(lSum[:, 0] > 0)[0]
+    lMaxIdx = np.argmax(lQuantized, axis=1)
+    lQuantized[lRows, lMaxIdx[lRows]] += 255 - lQuantized[lRows].sum(axis=1)
+    return lQuantized.astype(_numpyDTypeMap['B'])
+
+# Vertex -> triangles adjacency in CSR layout, triangles of vertex v are
+# pAdjacency[pOffsets[v]:pOffsets[v + 1]]
+def BuildVertexTriangleAdjacency(pTriangles, pVertexCount):
+    lVertices = pTriangles.ravel()
+    lAdjacency = np.argsort(lVertices, kind='stable') // 3
+    lCounts = np.bincount(lVertices, minlength=pVertexCount)
+    lOffsets = np.zeros(pVertexCount + 1, dtype=np.int64)
+    np.cumsum(lCounts, out=lOffsets[1:])
+    return lAdjacency, lOffsets, lCounts
+
+# Fast Triangle Reordering for Vertex Locality and Reduced Overdraw, Sander et al. 2007
+# http://gfx.cs.princeton.edu/pubs/Sander_2007_%3ETR/tipsy.pdf
+def TipsifyIndices(pIndices, pVertexCount, pCacheSize):
+    lTriangles = np.asarray(pIndices, dtype=np.int64).reshape(-1, 3)
+    if len(lTriangles) == 0:
+        return lTriangles.ravel()
+    lAdjacency, lOffsets, lLiveCounts = BuildVertexTriangleAdjacency(lTriangles, pVertexCount)
+    # Plain lists are much faster than numpy arrays for element access in the loop
+    lAdjacency = lAdjacency.tolist()
+    lOffsets = lOffsets.tolist()
+    lLiveCounts = lLiveCounts.tolist()
+    lTriangleList = lTriangles.tolist()
+
+    lTimeStamps = [0] * pVertexCount
+    lEmitted = [False] * len(lTriangleList)
+    lDeadEndStack = []
+    lTriangleOrder = []
+    lTime = pCacheSize + 1
+    lCursor = 0
+    lFanning = lTriangleList[0][0]
+
+    while lFanning >= 0:
+        lCandidates = []
+        for t in lAdjacency[lOffsets[lFanning]:lOffsets[lFanning + 1]]:
+            if lEmitted[t]:
+                continue
+            lEmitted[t] = True
+            lTriangleOrder.append(t)
+            for v in lTriangleList[t]:
+                lDeadEndStack.append(v)
+                lCandidates.append(v)
+                lLiveCounts[v] -= 1
+                if lTime - lTimeStamps[v] > pCacheSize:
+                    lTimeStamps[v] = lTime
+                    lTime += 1
+
+        # Next fanning vertex is the one still in cache with most live triangles
+        lFanning = -1
+        lBestPriority = -1
+        for v in lCandidates:
+            if lLiveCounts[v] > 0:
+                lPriority = 0
+                if lTime - lTimeStamps[v] + 2 * lLiveCounts[v] <= pCacheSize:
+                    lPriority = lTime - lTimeStamps[v]
+                if lPriority > lBestPriority:
+                    lBestPriority = lPriority
+                    lFanning = v
+
+        # Dead end, use recent referenced vertices or the next vertex in input order
+        if lFanning == -1:
+            while len(lDeadEndStack) > 0:
+                v = lDeadEndStack.pop()
+                if lLiveCounts[v] > 0:
+                    lFanning = v
+                    break
+        if lFanning == -1:
+            while lCursor < pVertexCount:
+                if lLiveCounts[lCursor] > 0:
+                    lFanning = lCursor
+                    break
+                lCursor += 1
+
+    return lTriangles[np.array(lTriangleOrder, dtype=np.int64)].ravel()
+
+# Reorder vertices in the order they are first referenced, returns the new indices and
+# the old index of each new vertex.
+def ReorderVerticesForFetch(pIndices, pVertexCount):
+    lReferenced, lFirst = np.unique(pIndices, return_index=True)
+    lOrder = lReferenced[np.argsort(lFirst, kind='stable')]
+    # Vertices not referenced by any triangle are kept at last
+    lOrder = np.concatenate([lOrder, np.setdiff1d(np.arange(pVertexCount), lReferenced)])
+    lRemap = np.empty(pVertexCount, dtype=np.int64)
+    lRemap[lOrder] = np.arange(pVertexCount)
+    return lRemap[pIndices], lOrder
+
+# Cache misses of a FIFO post transform vertex cache
+def CountCacheMisses(pIndices, pCacheSize):
+    lCache = collections.deque()
+    lCached = set()
+    lMisses = 0
+    for v in pIndices:
+        if not v in lCached:
+            lMisses += 1
+            lCache.append(v)
+            lCached.add(v)
+            if len(lCache) > pCacheSize:
+                lCached.discard(lCache.popleft())
+    return lMisses
+
+def ReorderVertices(pList, pOrder):
+    if isinstance(pList, np.ndarray):
+        return pList[pOrder]
+    return [pList[idx] for idx in pOrder.tolist()]
+
+# Columns [pStart, pEnd) of each vertex
+def SliceVertices(pList, pStart, pEnd):
+    if not np == None and isinstance(pList, np.ndarray):
+        return pList[:, pStart:pEnd]
+    return [item[pStart:pEnd] for item in pList]
+
+# (vertex, joint, weight) triples of all clusters to joints and weights of each vertex.
+# The pInfluences largest weights are kept in descending order and renormalized,
+# empty influences have joint -1 and weight 0.
+def BuildSkinWeights(pVertices, pJoints, pWeights, pVertexCount, pInfluences):
+    lVertices = np.asarray(pVertices, dtype=np.int64)
+    lJoints = np.asarray(pJoints, dtype=np.int64)
+    lWeights = np.asarray(pWeights, dtype=np.float64)
+    lNonZero = lWeights > 0
+    lVertices = lVertices[lNonZero]
+    lJoints = lJoints[lNonZero]
+    lWeights = lWeights[lNonZero]
+    # Sorted by vertex, then by descending weight, equal weights keep the cluster order
+    lOrder = np.lexsort((np.arange(len(lVertices)), -lWeights, lVertices))
+    lVertices = lVertices[lOrder]
+    lCounts = np.bincount(lVertices, minlength=pVertexCount)
+    lRanks = np.arange(len(lVertices)) - (np.cumsum(lCounts) - lCounts)[lVertices]
+    lKept = lRanks < pInfluences
+
+    lSkinJoints = np.full((pVertexCount, pInfluences), -1, dtype=np.int64)
+    lSkinWeights = np.zeros((pVertexCount, pInfluences), dtype=np.float64)
+    lSkinJoints[lVertices[lKept], lRanks[lKept]] = lJoints[lOrder][lKept]
+    lSkinWeights[lVertices[lKept], lRanks[lKept]] = lWeights[lOrder][lKept]
+    # Summed column by column like the list version
+    lSum = np.zeros((pVertexCount, 1), dtype=np.float64)
+    for i in range(pInfluences):
+        lSum[:, 0] += lSkinWeights[:, i]
+    np.divide(lSkinWeights, lSum, out=lSkinWeights, where=lSum > 0)
+    return lSkinJoints, lSkinWeights, int(lCounts.max()) if len(lCounts) > 0 else 0
+
+def BuildSkinWeightsList(pVertices, pJoints, pWeights, pVertexCount, pInfluences):
+    lInfluences = [[] for i in range(pVertexCount)]
+    for i in range(len(pVertices)):
+        if pWeights[i] > 0:
+            lInfluences[pVertices[i]].append((pJoints[i], pWeights[i]))
+    lSkinJoints = []
+    lSkinWeights = []
+    lMaxInfluences = 0
+    for lVertexInfluences in lInfluences:
+        lMaxInfluences = max(lMaxInfluences, len(lVertexInfluences))
+        lVertexInfluences = sorted(lVertexInfluences, key = lambda item: -item[1])[:pInfluences]
+        lVertexInfluences += [(-1, 0.0)] * (pInfluences - len(lVertexInfluences))
+        lSum = 0.0
+        for lJoint, lWeight in lVertexInfluences:
+            lSum += lWeight
+        lSkinJoints.append([lJoint for lJoint, lWeight in lVertexInfluences])
+        lSkinWeights.append([lWeight / lSum if lSum > 0 else 0.0 for lJoint, lWeight in lVertexInfluences])
+    return lSkinJoints, lSkinWeights, lMaxInfluences
+
+# Libraries and buffers of one conversion.
+class GltfBuilder(object):
+
+    def __init__(self, useNumpy = True, weldEpsilon = 0, vertexCacheSize = 0, quantize = False, animTolerance = None, cubicSpline = False, splitClips = False, animJobs = 1, maxInfluences = 4, imageHash = False, mergePrimitives = False, keySampling = False):
+        self.useNumpy = useNumpy and not np == None
+        # Positions, normals and uvs closer than epsilon will be welded to one vertex
+        self.weldEpsilon = weldEpsilon
+        # Triangles are reordered for a post transform cache of this size, 0 to disable
+        self.vertexCacheSize = vertexCacheSize
+        # Triangle count, cache misses before and after the reordering
+        self.vertexCacheStats = [0, 0, 0]
+        # Write vertex attributes with KHR_mesh_quantization
+        self.quantize = quantize and self.useNumpy
+        # Joints bound to one vertex, 8 joints are written to JOINTS_1 and WEIGHTS_1
+        self.maxInfluences = maxInfluences
+        # Byte identical images with different paths are one image
+        self.imageHash = imageHash
+        # Materials only differ in name are merged, and primitives with the same material
+        self.mergePrimitives = mergePrimitives
+        self.materialHashMap = {}
+        # Pages of texture atlas, and fbx material id -> (page, uv rect)
+        self.atlasPages = []
+        self.atlasMaterials = {}
+        # Source texture files read in the conversion, their stamps are part of the cache key
+        self.textureFiles = set()
+        # Error tolerances of translation, rotation in degrees and scale in keyframe reduction
+        self.animTolerance = animTolerance if self.useNumpy else None
+        # Path -> [samples before, samples after, max error]
+        self.animReductionStats = {}
+        # Bytes of animation data before and after keyframe reduction
+        self.animReductionBytes = [0, 0]
+        # Sha1 of packed sample times -> accessor index
+        self.timeAccessorMap = {}
+        # Write animation data of each clip to its own buffer
+        self.splitClips = splitClips
+        # (name, buffer, accessors) of each clip in its own buffer
+        self.clipBuffers = []
+        # Worker processes sampling animation, which load the fbx file again
+        self.animJobs = animJobs if self.useNumpy else 1
+        self.animPool = None
+        self.filePath = ''
+        # Export translation and scale keys as CUBICSPLINE, other channels are sampled
+        self.cubicSpline = cubicSpline
+        # Channels exported from keys and channels fell back to sampling
+        self.cubicSplineStats = [0, 0]
+        # Sample plain transforms from curve keys instead of the evaluator
+        self.keySampling = keySampling
+
+        self.lib_materials = []
+
+        self.lib_images = []
+        self.lib_samplers = []
+        self.lib_textures = []
+
+        # attributes, indices, anim_parameters will be merged in accessors
+        self.lib_attributes_accessors = []
+        self.lib_indices_accessors = []
+        self.lib_animation_accessors = []
+        self.lib_ibm_accessors = []
+        self.lib_accessors = []
+
+        self.lib_buffer_views = []
+        self.lib_buffers = []
+
+        self.lib_cameras = []
+        self.lib_meshes = []
+
+        self.lib_nodes = []
+        self.lib_scenes = []
+
+        self.lib_skins = []
+        # Skeleton roots and dequantization -> skin builders sharing the skeleton
+        self.sharedSkinMap = {}
+        self.skinBuilders = []
+
+        self.lib_animations = []
+
+        # Only python 3 support bytearray ?
+        # http://dabeaz.blogspot.jp/2010/01/few-useful-bytearray-tricks.html
+        self.attributeBuffer = bytearray()
+        self.indicesBuffer = bytearray()
+        # Quantized attributes padded to 4 bytes, byteStride -> [buffer, accessors]
+        self.stridedAttributeBuffers = {}
+        # Nodes of quantized meshes created after all nodes are converted
+        self.dequantizedMeshNodes = []
+        # Converted meshes shared by nodes, instance key -> (mesh index, quantization bounds)
+        self.meshInstanceMap = {}
+        # Unique ids of meshes already splitted by material
+        self.splittedMeshIds = set()
+        self.invBindMatricesBuffer = bytearray()
+        self.animationBuffer = bytearray()
+        # Indices and values of sparse accessors, the buffer view has no target
+        self.sparseBuffer = bytearray()
+        self.lib_sparse_accessors = []
+        # Mesh index -> blend shape channels of morph targets
+        self.morphChannelMap = {}
+        # (glTF node with the mesh, blend shape channels) of meshes with morph targets
+        self.morphTargetNodes = []
+
+        self.samplerHashMap = {}
+        self.textureHashMap = {}
+        # Normalized path -> image index
+        self.imagePathMap = {}
+        # Sha1 of image file -> image index
+        self.imageHashMap = {}
+
+        # Start from -1 and ignore the root node
+        self.nodeCount = -1
+        self.nodeIdxMap = {}
+
+        self.defaultMaterialIndex = 0
+
+    def CreateAttributeBuffer(self, pList, pType, pStride):
+        lData, lGLTFAttribute = CreateAccessorBuffer(pList, pType, pStride, True, self.useNumpy)
+        lGLTFAttribute['byteOffset'] = len(self.attributeBuffer)
+        # pType is float
+        self.attributeBuffer.extend(lData)
+        idx = len(self.lib_accessors)
+        self.lib_attributes_accessors.append(lGLTFAttribute)
+        self.lib_accessors.append(lGLTFAttribute)
+        return idx
+
+    # pArray is a quantized numpy array
+    def CreateQuantizedAttributeBuffer(self, pArray, pType, pStride, pNormalized, pByteStride = 0):
+        lGLTFAttribute = CreateAccessor(len(pArray), pType, pStride, None, None)
+        if len(pArray) > 0:
+            lGLTFAttribute['max'] = pArray.max(axis=0).tolist()
+            lGLTFAttribute['min'] = pArray.min(axis=0).tolist()
+        else:
+            lGLTFAttribute['max'] = lGLTFAttribute['min'] = [0] * pStride
+        if pNormalized:
+            lGLTFAttribute['normalized'] = True
+
+        if pByteStride > 0:
+            # Vertex attributes must be aligned to 4 bytes
+            lPadded = np.zeros((len(pArray), pByteStride // pArray.itemsize), dtype=pArray.dtype)
+            lPadded[:, :pStride] = pArray
+            if not pByteStride in self.stridedAttributeBuffers:
+                self.stridedAttributeBuffers[pByteStride] = [bytearray(), []]
+            lBuffer, lAccessors = self.stridedAttributeBuffers[pByteStride]
+            lData = lPadded.tobytes()
+        else:
+            lBuffer = self.attributeBuffer
+            lAccessors = self.lib_attributes_accessors
+            lData = pArray.tobytes()
+
+        lGLTFAttribute['byteOffset'] = len(lBuffer)
+        lBuffer.extend(lData)
+        idx = len(self.lib_accessors)
+        lAccessors.append(lGLTFAttribute)
+        self.lib_accessors.append(lGLTFAttribute)
+        return idx
+
+    # Attribute of pCount items which are zero except the items at pIndices
+    def CreateSparseAttributeBuffer(self, pIndices, pValues, pStride, pCount):
+        lData, lGLTFAttribute = CreateAccessorBuffer(pValues, 'f', pStride, True, self.useNumpy)
+        lGLTFAttribute['count'] = pCount
+        lGLTFAttribute.pop('byteOffset', None)
+        if len(pIndices) < pCount:
+            lGLTFAttribute['min'] = [min(v, 0) for v in lGLTFAttribute['min']]
+            lGLTFAttribute['max'] = [max(v, 0) for v in lGLTFAttribute['max']]
+        idx = len(self.lib_accessors)
+        self.lib_accessors.append(lGLTFAttribute)
+        # Accessor without buffer view is initialized with zeros
+        if len(pIndices) == 0:
+            return idx
+
+        lGLTFValues = {'byteOffset' : len(self.sparseBuffer)}
+        self.sparseBuffer.extend(lData)
+        lIndicesType = 'H' if pCount <= 0xffff else 'I'
+        lData, lGLTFIndices = CreateAccessorBuffer(pIndices, lIndicesType, 1, False, self.useNumpy)
+        lGLTFIndices = {
+            'byteOffset' : len(self.sparseBuffer),
+            'componentType' : lGLTFIndices['componentType']
+        }
+        self.sparseBuffer.extend(lData)
+        # Keep the values of next accessor aligned to 4 bytes
+        self.sparseBuffer.extend(b'\0' * (-len(self.sparseBuffer) % 4))
+
+        lGLTFAttribute['sparse'] = {
+            'count' : len(pIndices),
+            'indices' : lGLTFIndices,
+            'values' : lGLTFValues
+        }
+        self.lib_sparse_accessors += [lGLTFIndices, lGLTFValues]
+        return idx
+
+    def CreateIndicesBuffer(self, pList, pType):
+        # Sketchfab needs all accessor have min, max?
+        lData, lGLTFIndices = CreateAccessorBuffer(pList, pType, 1, True, self.useNumpy)
+        lGLTFIndices['byteOffset'] = len(self.indicesBuffer)
+        self.indicesBuffer.extend(lData)
+        idx = len(self.lib_accessors)
+        self.lib_indices_accessors.append(lGLTFIndices)
+        self.lib_accessors.append(lGLTFIndices)
+        return idx
+
+    def CreateAnimationBuffer(self, pList, pType, pStride):
+        lData, lGLTFAnimSampler = CreateAccessorBuffer(pList, pType, pStride, True, self.useNumpy)
+        return self.AddAnimationAccessor(lData, lGLTFAnimSampler)
+
+    # Samplers with same times share one input accessor, across nodes, layers and stacks.
+    def CreateTimeBuffer(self, pList):
+        lData, lGLTFAnimSampler = CreateAccessorBuffer(pList, 'f', 1, True, self.useNumpy)
+        lKey = hashlib.sha1(lData).digest()
+        if not lKey in self.timeAccessorMap:
+            self.timeAccessorMap[lKey] = self.AddAnimationAccessor(lData, lGLTFAnimSampler)
+        return self.timeAccessorMap[lKey]
+
+    def AddAnimationAccessor(self, pData, pGLTFAnimSampler):
+        pGLTFAnimSampler['byteOffset'] = len(self.animationBuffer)
+        self.animationBuffer.extend(pData)
+        idx = len(self.lib_accessors)
+        self.lib_animation_accessors.append(pGLTFAnimSampler)
+        self.lib_accessors.append(pGLTFAnimSampler)
+        return idx
+
+    def CreateIBMBuffer(self, pList):
+        lData, lGLTFIBM = CreateAccessorBuffer(pList, 'f', 16, True, self.useNumpy)
+        lGLTFIBM['byteOffset'] = len(self.invBindMatricesBuffer)
+        self.invBindMatricesBuffer.extend(lData)
+        idx = len(self.lib_accessors)
+        self.lib_ibm_accessors.append(lGLTFIBM)
+        self.lib_accessors.append(lGLTFIBM)
+        return idx
+
+    def AddTextureFile(self, pFile):
+        if not pFile == None:
+            self.textureFiles.add(pFile)
+
+    def CreateImage(self, pPath):
+        lFbxDir = os.path.dirname(self.filePath)
+        lKey = NormalizeImagePath(pPath, lFbxDir)
+        if lKey in self.imagePathMap:
+            return self.imagePathMap[lKey]
+
+        lHash = None
+        if self.imageHash:
+            lFile = FindTextureFile(pPath, lFbxDir)
+            self.AddTextureFile(lFile)
+            lHash = HashImageFile(lFile)
+        if not lHash == None and lHash in self.imageHashMap:
+            lImageIdx = self.imageHashMap[lHash]
+        else:
+            lImageIdx = len(self.lib_images)
+            self.lib_images.append({
+                'uri' : pPath
+            })
+            if not lHash == None:
+                self.imageHashMap[lHash] = lImageIdx
+        self.imagePathMap[lKey] = lImageIdx
+        return lImageIdx
+
+    def CreateSkin(self):
+        lSkinIdx = len(self.lib_skins)
+        # https://github.com/KhronosGroup/glTF/issues/100
+        self.lib_skins.append({
+            'joints' : [],
+        })
 
-    if minMax:
-        lGLTFAcessor['max'] = lMax
-        lGLTFAcessor['min'] = lMin
-
-    return b''.join(lData), lGLTFAcessor
-
-
-def CreateAttributeBuffer(pList, pType, pStride):
-    lData, lGLTFAttribute = CreateAccessorBuffer(pList, pType, pStride, True)
-    lGLTFAttribute['byteOffset'] = len(attributeBuffer)
-    # pType is float
-    attributeBuffer.extend(lData)
-    idx = len(lib_accessors)
-    lib_attributes_accessors.append(lGLTFAttribute)
-    lib_accessors.append(lGLTFAttribute)
-    return idx
-
-
-def CreateIndicesBuffer(pList, pType):
-    # Sketchfab needs all accessor have min, max?
-    lData, lGLTFIndices = CreateAccessorBuffer(pList, pType, 1, True)
-    lGLTFIndices['byteOffset'] = len(indicesBuffer)
-    indicesBuffer.extend(lData)
-    idx = len(lib_accessors)
-    lib_indices_accessors.append(lGLTFIndices)
-    lib_accessors.append(lGLTFIndices)
-    return idx
-
-def CreateAnimationBuffer(pList, pType, pStride):
-    lData, lGLTFAnimSampler = CreateAccessorBuffer(pList, pType, pStride, True)
-    lGLTFAnimSampler['byteOffset'] = len(animationBuffer)
-    animationBuffer.extend(lData)
-    idx = len(lib_accessors)
-    lib_animation_accessors.append(lGLTFAnimSampler)
-    lib_accessors.append(lGLTFAnimSampler)
-    return idx
-
-def CreateIBMBuffer(pList):
-    lData, lGLTFIBM = CreateAccessorBuffer(pList, 'f', 16, True)
-    lGLTFIBM['byteOffset'] = len(invBindMatricesBuffer)
-    invBindMatricesBuffer.extend(lData)
-    idx = len(lib_accessors)
-    lib_ibm_accessors.append(lGLTFIBM)
-    lib_accessors.append(lGLTFIBM)
-    return idx
-
-
-def CreateImage(pPath):
-    lImageIndices = [idx for idx in range(len(lib_images)) if lib_images[idx]['uri'] == pPath]
-    if len(lImageIndices):
-        return lImageIndices[0]
-
-    lImageIdx = len(lib_images)
-    lib_images.append({
-        'uri' : pPath
-    })
-    return lImageIdx
+        return lSkinIdx
+
+    def CreateAnimation(self, pName):
+        lAnimIdx = len(self.lib_animations)
+        lGLTFAnimation = {
+            'name' : pName,
+            'channels' : [],
+            'samplers' : []
+        }
+
+        return lAnimIdx, lGLTFAnimation
+
+    # Following animation data are written to a new buffer of the clip
+    def BeginClipBuffer(self, pName):
+        self.animationBuffer = bytearray()
+        self.lib_animation_accessors = []
+        # Clip can't share times in buffer of other clip
+        self.timeAccessorMap = {}
+        self.clipBuffers.append((pName, self.animationBuffer, self.lib_animation_accessors))
+
+    # Animation buffer in the main buffer is left empty
+    def EndClipBuffers(self):
+        self.animationBuffer = bytearray()
+        self.lib_animation_accessors = []
+        self.timeAccessorMap = {}
+
+    def AddNode(self, pNode):
+        self.nodeIdxMap[pNode.GetUniqueID()] = self.nodeCount
+        self.nodeCount = self.nodeCount + 1
+
+    def GetNodeIdx(self, pNode):
+        return self.nodeIdxMap[pNode.GetUniqueID()]
+
+    # Node indices are decided before converting, the dequantization node of
+    # mesh is appended as a child after all nodes are converted.
+    def AddDequantizedMeshNode(self, pGLTFNode, pMeshIdx, pMatrix):
+        lGLTFMeshNode = {
+            'name' : pGLTFNode['name'] + '_dequantized',
+            'mesh' : pMeshIdx,
+            'matrix' : pMatrix
+        }
+        self.dequantizedMeshNodes.append((pGLTFNode, lGLTFMeshNode))
+        return lGLTFMeshNode
+
+    def SetNodeMesh(self, pGLTFNode, pMeshIdx, pQuantizationBounds, pHasSkin):
+        # Dequantization of skinned mesh is applied in the inverse bind matrices
+        if not pQuantizationBounds == None and not pHasSkin:
+            lGLTFMeshNode = self.AddDequantizedMeshNode(pGLTFNode, pMeshIdx, GetDequantizationMatrix(pQuantizationBounds))
+        else:
+            pGLTFNode['mesh'] = pMeshIdx
+            lGLTFMeshNode = pGLTFNode
+        # Weights animation targets the node with mesh
+        if pMeshIdx in self.morphChannelMap:
+            self.morphTargetNodes.append((lGLTFMeshNode, self.morphChannelMap[pMeshIdx]))
+
+    def CreateDequantizedMeshNodes(self):
+        for lGLTFNode, lGLTFMeshNode in self.dequantizedMeshNodes:
+            if not 'children' in lGLTFNode:
+                lGLTFNode['children'] = []
+            lGLTFNode['children'].append(len(self.lib_nodes))
+            self.lib_nodes.append(lGLTFMeshNode)
+        self.dequantizedMeshNodes = []
+
+    # Buffer sections in the same order with the buffer views
+    def GetBuffers(self):
+        lStridedBuffers = [self.stridedAttributeBuffers[lByteStride][0] for lByteStride in sorted(self.stridedAttributeBuffers)]
+        return [self.attributeBuffer] + lStridedBuffers + [self.invBindMatricesBuffer, self.animationBuffer, self.sparseBuffer, self.indicesBuffer]
+
+    def CreateBufferView(self, pBufferIdx, pByteLength, lib, lByteOffset, target=GL_ARRAY_BUFFER, byteStride=0):
+        lBufferViewIdx = len(self.lib_buffer_views)
+        lBufferView = {
+            "buffer": pBufferIdx,
+            "byteLength": pByteLength,
+            "byteOffset": lByteOffset,
+            # PENDING
+            "byteStride": byteStride,
+            "target": target
+        }
+        if target == None:
+            del lBufferView['byteStride']
+            del lBufferView['target']
+        self.lib_buffer_views.append(lBufferView)
+        for lAttrib in lib:
+            lAttrib['bufferView'] = lBufferViewIdx
+
+        return lBufferView
+
+    # Byte offsets are computed from size of each section, which are written in the same order.
+    def CreateBufferViews(self, pBufferIdx):
+
+        lByteOffset = self.CreateBufferView(pBufferIdx, len(self.attributeBuffer), self.lib_attributes_accessors, 0)['byteLength']
+
+        for lByteStride in sorted(self.stridedAttributeBuffers):
+            lBuffer, lAccessors = self.stridedAttributeBuffers[lByteStride]
+            lByteOffset += self.CreateBufferView(pBufferIdx, len(lBuffer), lAccessors, lByteOffset, GL_ARRAY_BUFFER, lByteStride)['byteLength']
+
+        if len(self.lib_ibm_accessors) > 0:
+            lByteOffset += self.CreateBufferView(pBufferIdx, len(self.invBindMatricesBuffer), self.lib_ibm_accessors, lByteOffset)['byteLength']
+
+        if len(self.lib_animation_accessors) > 0:
+            lByteOffset += self.CreateBufferView(pBufferIdx, len(self.animationBuffer), self.lib_animation_accessors, lByteOffset)['byteLength']
+
+        if len(self.lib_sparse_accessors) > 0:
+            lByteOffset += self.CreateBufferView(pBufferIdx, len(self.sparseBuffer), self.lib_sparse_accessors, lByteOffset, None)['byteLength']
+
+        #Indices buffer view
+        #Put the indices buffer at last or there may be a error
+        #When creating a Float32Array, which the offset must be multiple of 4
+        self.CreateBufferView(pBufferIdx, len(self.indicesBuffer), self.lib_indices_accessors, lByteOffset, GL_ELEMENT_ARRAY_BUFFER)
+
+    def ToJSON(self, pSceneIdx = None):
+        lOutput = {
+            'asset': {
+                'generator': 'qtek fbx2gltf',
+                'version': '2.0'
+            },
+            'extensionsUsed': ['KHR_materials_common'],
+            'accessors' : self.lib_accessors,
+            'bufferViews' : self.lib_buffer_views,
+            'buffers' : self.lib_buffers,
+            'nodes' : self.lib_nodes,
+            'scenes' : self.lib_scenes,
+            'meshes' : self.lib_meshes,
+        }
+        if len(self.lib_cameras) > 0:
+            lOutput['cameras'] = self.lib_cameras
+        if len(self.lib_skins) > 0:
+            lOutput['skins'] = self.lib_skins
+        if len(self.lib_materials) > 0:
+            lOutput['materials'] = self.lib_materials
+        if len(self.lib_images) > 0:
+            lOutput['images'] = self.lib_images
+        if len(self.lib_samplers) > 0:
+            lOutput['samplers'] = self.lib_samplers
+        if len(self.lib_textures) > 0:
+            lOutput['textures'] = self.lib_textures
+        if len(self.lib_animations) > 0:
+            lOutput['animations'] = self.lib_animations
+        if self.quantize:
+            lOutput['extensionsUsed'].append('KHR_mesh_quantization')
+            lOutput['extensionsRequired'] = ['KHR_mesh_quantization']
+        #Default scene
+        if not pSceneIdx == None:
+            lOutput['scene'] = pSceneIdx
+
+        return lOutput
 
 def HashSampler(pTexture):
     lHashStr = []
@@ -235,27 +845,23 @@ def ConvertWrapMode(pWrap):
     elif pWrap == FbxTexture.eClamp:
         return GL_CLAMP_TO_EDGE
 
-_samplerHashMap = {}
-def CreateSampler(pTexture):
+def CreateSampler(pBuilder, pTexture):
     lHashKey = HashSampler(pTexture)
-    if lHashKey in _samplerHashMap:
-        return _samplerHashMap[lHashKey]
+    if lHashKey in pBuilder.samplerHashMap:
+        return pBuilder.samplerHashMap[lHashKey]
     else:
-        lSamplerIdx = len(lib_samplers)
-        lib_samplers.append({
+        lSamplerIdx = len(pBuilder.lib_samplers)
+        pBuilder.lib_samplers.append({
             'wrapS' : ConvertWrapMode(pTexture.WrapModeU.Get()),
             'wrapT' : ConvertWrapMode(pTexture.WrapModeV.Get()),
             # Texture filter in fbx ?
             'minFilter' : GL_LINEAR_MIPMAP_LINEAR,
             'magFilter' : GL_LINEAR
         })
-        _samplerHashMap[lHashKey] = lSamplerIdx
+        pBuilder.samplerHashMap[lHashKey] = lSamplerIdx
         return lSamplerIdx
 
-_textureHashMap = {}
-def CreateTexture(pProperty):
-    lTextureList = []
-
+def GetFileTextures(pProperty):
     lFileTextures = []
     lLayeredTextureCount = pProperty.GetSrcObjectCount(FbxCriteria.ObjectType(FbxLayeredTexture.ClassId))
     if lLayeredTextureCount > 0:
@@ -272,23 +878,27 @@ def CreateTexture(pProperty):
             lTexture = pProperty.GetSrcObject(FbxCriteria.ObjectType(FbxTexture.ClassId), t)
             if lTexture and lTexture.__class__ == FbxFileTexture:
                 lFileTextures.append(lTexture)
+    return lFileTextures
 
-    for lTexture in lFileTextures:
-        lImageIdx = CreateImage(lTexture.GetFileName())
-        lSamplerIdx = CreateSampler(lTexture)
+def CreateTexture(pBuilder, pProperty):
+    lTextureList = []
+
+    for lTexture in GetFileTextures(pProperty):
+        lImageIdx = pBuilder.CreateImage(lTexture.GetFileName())
+        lSamplerIdx = CreateSampler(pBuilder, lTexture)
         lHashKey = (lImageIdx, lSamplerIdx)
-        if lHashKey in _textureHashMap:
-            lTextureList.append(_textureHashMap[lHashKey])
+        if lHashKey in pBuilder.textureHashMap:
+            lTextureList.append(pBuilder.textureHashMap[lHashKey])
         else:
-            lTextureIdx = len(lib_textures)
-            lib_textures.append({
+            lTextureIdx = len(pBuilder.lib_textures)
+            pBuilder.lib_textures.append({
                 'format' : GL_RGBA,
                 'internalFormat' : GL_RGBA,
                 'sampler' : lSamplerIdx,
                 'source' : lImageIdx,
                 'target' : GL_TEXTURE_2D
             })
-            _textureHashMap[lHashKey] = lTextureIdx
+            pBuilder.textureHashMap[lHashKey] = lTextureIdx
             lTextureList.append(lTextureIdx)
     # PENDING Return the first texture ?
     if len(lTextureList) > 0:
@@ -296,7 +906,59 @@ def CreateTexture(pProperty):
     else:
         return None
 
-def ConvertMaterial(pMaterial):
+# Texture of atlas page, created when first used
+def GetAtlasTexture(pBuilder, pPageIdx):
+    lPage = pBuilder.atlasPages[pPageIdx]
+    if lPage['texture'] == None:
+        # Uri is set when the page is written
+        lPage['image'] = len(pBuilder.lib_images)
+        pBuilder.lib_images.append({
+            'uri' : ''
+        })
+        # Packed textures can't repeat
+        if not 'atlas' in pBuilder.samplerHashMap:
+            pBuilder.samplerHashMap['atlas'] = len(pBuilder.lib_samplers)
+            pBuilder.lib_samplers.append({
+                'wrapS' : GL_CLAMP_TO_EDGE,
+                'wrapT' : GL_CLAMP_TO_EDGE,
+                'minFilter' : GL_LINEAR_MIPMAP_LINEAR,
+                'magFilter' : GL_LINEAR
+            })
+        lPage['texture'] = len(pBuilder.lib_textures)
+        pBuilder.lib_textures.append({
+            'format' : GL_RGBA,
+            'internalFormat' : GL_RGBA,
+            'sampler' : pBuilder.samplerHashMap['atlas'],
+            'source' : lPage['image'],
+            'target' : GL_TEXTURE_2D
+        })
+    return lPage['texture']
+
+# Uvs transformed to pRect (u, v, width, height) of the atlas, None if any uv is out of [0, 1]
+def RemapAtlasTexcoords(pBuilder, pTexcoords, pRect):
+    lU, lV, lWidth, lHeight = pRect
+    if pBuilder.useNumpy:
+        lArray = ToNumpyArray(pTexcoords, 2).astype(np.float64)
+        if len(lArray) > 0 and (lArray.min() < 0 or lArray.max() > 1):
+            return None
+        return lArray * (lWidth, lHeight) + (lU, lV)
+    for lTexcoord in pTexcoords:
+        if min(lTexcoord[0], lTexcoord[1]) < 0 or max(lTexcoord[0], lTexcoord[1]) > 1:
+            return None
+    return [[lU + lTexcoord[0] * lWidth, lV + lTexcoord[1] * lHeight] for lTexcoord in pTexcoords]
+
+def AddMaterial(pBuilder, pGLTFMaterial):
+    if pBuilder.mergePrimitives:
+        lHashKey = json.dumps(dict([(k, v) for k, v in pGLTFMaterial.items() if not k == 'name']), sort_keys = True)
+        if lHashKey in pBuilder.materialHashMap:
+            return pBuilder.materialHashMap[lHashKey]
+        pBuilder.materialHashMap[lHashKey] = len(pBuilder.lib_materials)
+    lMaterialIdx = len(pBuilder.lib_materials)
+    pBuilder.lib_materials.append(pGLTFMaterial)
+    return lMaterialIdx
+
+# Diffuse map is replaced by pDiffuseTexture if the uvs have been remapped to an atlas
+def ConvertMaterial(pBuilder, pMaterial, pDiffuseTexture = None):
     lMaterialName = pMaterial.GetName()
 
     lGLTFMaterial = {
@@ -312,10 +974,8 @@ def ConvertMaterial(pMaterial):
     lValues = lGLTFMaterial['extensions']['KHR_materials_common']['values']
     lShading = pMaterial.ShadingModel.Get()
 
-    lMaterialIdx = len(lib_materials);
     if (lShading == 'unknown'):
-        lib_materials.append(lGLTFMaterial)
-        return lMaterialIdx
+        return AddMaterial(pBuilder, lGLTFMaterial)
 
     lValues['ambient'] = list(pMaterial.Ambient.Get())
     lValues['emission'] = list(pMaterial.Emissive.Get())
@@ -330,8 +990,10 @@ def ConvertMaterial(pMaterial):
 
     # Use diffuse map
     # TODO Diffuse Factor ?
-    if pMaterial.Diffuse.GetSrcObjectCount() > 0:
-        lTextureIdx = CreateTexture(pMaterial.Diffuse)
+    if not pDiffuseTexture == None:
+        lValues['diffuse'] = pDiffuseTexture
+    elif pMaterial.Diffuse.GetSrcObjectCount() > 0:
+        lTextureIdx = CreateTexture(pBuilder, pMaterial.Diffuse)
         if not lTextureIdx == None:
             lValues['diffuse'] = lTextureIdx
     else:
@@ -339,14 +1001,14 @@ def ConvertMaterial(pMaterial):
 
     if pMaterial.Bump.GetSrcObjectCount() > 0:
         # TODO 3dsmax use the normal map as bump map ?
-        lTextureIdx = CreateTexture(pMaterial.Bump)
+        lTextureIdx = CreateTexture(pBuilder, pMaterial.Bump)
         if not lTextureName == None:
             lGLTFMaterial['normalTexture'] = {
                 "index": lTextureIdx
             }
 
     if pMaterial.NormalMap.GetSrcObjectCount() > 0:
-        lTextureIdx = CreateTexture(pMaterial.NormalMap)
+        lTextureIdx = CreateTexture(pBuilder, pMaterial.NormalMap)
         if not lTextureIdx == None:
             lGLTFMaterial['normalTexture'] = {
                 "index": lTextureIdx
@@ -361,8 +1023,7 @@ def ConvertMaterial(pMaterial):
         else:
             lValues['specular'] = list(pMaterial.Specular.Get())
 
-    lib_materials.append(lGLTFMaterial)
-    return lMaterialIdx
+    return AddMaterial(pBuilder, lGLTFMaterial)
 
 def ConvertVertexLayer(pMesh, pLayer, pOutput):
     lMappingMode = pLayer.GetMappingMode()
@@ -395,21 +1056,176 @@ def ConvertVertexLayer(pMesh, pLayer, pOutput):
 
         return True
 
-def CreateSkin():
-    lSkinIdx = len(lib_skins)
-    # https://github.com/KhronosGroup/glTF/issues/100
-    lib_skins.append({
-        'joints' : [],
-    })
+_defaultMaterialName = 'DEFAULT_MAT_'
 
-    return lSkinIdx
+# Joints of one skin, shared by all primitives of the node and other nodes with the same skeleton.
+class SkinBuilder(object):
+
+    def __init__(self, pSkinIdx, pGLTFSkin, pExtraJointMatrix):
+        self.skinIdx = pSkinIdx
+        self.skin = pGLTFSkin
+        # Node index -> joint index
+        self.jointMap = {}
+        # Node index -> cluster of joint
+        self.clusters = collections.OrderedDict()
+        # Node index -> inverse bind matrix
+        self.bindMatrices = {}
+        # Inverse bind matrix of extra joints
+        self.extraJointMatrix = pExtraJointMatrix
+        # Skeleton nodes not linked to any cluster, in order of finding
+        self.extraJoints = []
+        self.extraJointSet = set()
+        self.roots = set()
+
+    def AddJoint(self, pNodeIdx, pCluster):
+        if not pNodeIdx in self.jointMap:
+            self.jointMap[pNodeIdx] = len(self.skin['joints'])
+            self.skin['joints'].append(pNodeIdx)
+            self.clusters[pNodeIdx] = pCluster
+        return self.jointMap[pNodeIdx]
+
+    def HasJoint(self, pNodeIdx):
+        return pNodeIdx in self.jointMap or pNodeIdx in self.extraJointSet
+
+    def AddExtraJoint(self, pNodeIdx):
+        if not self.HasJoint(pNodeIdx):
+            self.extraJoints.append(pNodeIdx)
+            self.extraJointSet.add(pNodeIdx)
+
+    # Meshes can share the skin if joints in both have the same bind pose
+    def IsBindPoseCompatible(self, pBindMatrices):
+        for lNodeIdx in pBindMatrices:
+            if lNodeIdx in self.bindMatrices and not MatrixAlmostEqual(self.bindMatrices[lNodeIdx], pBindMatrices[lNodeIdx]):
+                return False
+        return True
 
-_defaultMaterialName = 'DEFAULT_MAT_'
-_defaultMaterialIndex = 0
+def MatrixAlmostEqual(pA, pB, pEpsilon = 1e-5):
+    lA = ListFromM4(pA)
+    lB = ListFromM4(pB)
+    for i in range(16):
+        if abs(lA[i] - lB[i]) > pEpsilon * max(1, abs(lA[i])):
+            return False
+    return True
+
+# Skin clusters of all meshes of node, node index of joint -> cluster
+def GetNodeClusters(pBuilder, pNode):
+    lClusters = collections.OrderedDict()
+    for i in range(pNode.GetNodeAttributeCount()):
+        lNodeAttribute = pNode.GetNodeAttributeByIndex(i)
+        if lNodeAttribute.GetAttributeType() == FbxNodeAttribute.eMesh:
+            for i2 in range(lNodeAttribute.GetDeformerCount(FbxDeformer.eSkin)):
+                lDeformer = lNodeAttribute.GetDeformer(i2, FbxDeformer.eSkin)
+                for i3 in range(lDeformer.GetClusterCount()):
+                    lCluster = lDeformer.GetCluster(i3)
+                    lNodeIdx = pBuilder.GetNodeIdx(lCluster.GetLink())
+                    if not lNodeIdx in lClusters:
+                        lClusters[lNodeIdx] = lCluster
+    return lClusters
+
+def GetInverseBindMatrix(pCluster, pGeometricMatrix, pDequantizationMatrix):
+    lClusterGlobalInitMatrix = FbxAMatrix()
+    lReferenceGlobalInitMatrix = FbxAMatrix()
+    # Inverse Bind Pose Matrix
+    # Matrix of Mesh
+    pCluster.GetTransformMatrix(lReferenceGlobalInitMatrix)
+    # Matrix of Joint
+    pCluster.GetTransformLinkMatrix(lClusterGlobalInitMatrix)
+    # http://blog.csdn.net/bugrunner/article/details/7232291
+    # http://help.autodesk.com/view/FBX/2017/ENU/?guid=__cpp_ref__view_scene_2_draw_scene_8cxx_example_html
+    m = lClusterGlobalInitMatrix.Inverse() * lReferenceGlobalInitMatrix * pGeometricMatrix
+    if not pDequantizationMatrix == None:
+        m = m * pDequantizationMatrix
+    return m
+
+# Roots of skeleton of the joints. Skeleton nodes between joints and root which are not
+# joints are added to the extra joints of pSkin.
+def FindSkeletonRoots(pBuilder, pClusters, pSkin = None):
+    lRoots = set()
+    for lNodeIdx in pClusters:
+        lCluster = pClusters[lNodeIdx]
+        lLink = lCluster.GetLink()
+        lParent = lLink
+        lRootFound = False
+        # Parent already have index
+        lParentIdx = pBuilder.GetNodeIdx(lParent)
+        while not lParent == None:
+            lSkeleton = lParent.GetSkeleton()
+            if lSkeleton == None:
+                break;
+
+            # In case some skeleton is not a attached to any vertices(not a cluster)
+            # PENDING
+            if not pSkin == None:
+                pSkin.AddExtraJoint(lParentIdx)
+
+            if lSkeleton.IsSkeletonRoot():
+                lRootFound = True
+                break;
+            lParent = lParent.GetParent()
+            lParentIdx = pBuilder.GetNodeIdx(lParent)
+
+        # lSkeletonTypes = ["Root", "Limb", "Limb Node", "Effector"]
+        # print(lSkeletonTypes[lSkeleton.GetSkeletonType()])
+
+        if lRootFound:
+            lRoots.add(lParentIdx)
+        else:
+            # TODO IsSkeletonRoot not works well, try another way
+            # which do not have a parent or its parent is not in skin
+            lParent = lLink.GetParent()
+            if lParent == None or not pBuilder.GetNodeIdx(lParent) in pClusters:
+                lRoots.add(pBuilder.GetNodeIdx(lLink))
+    return lRoots
+
+# Skinned meshes bound to the same skeleton with the same bind pose share one skin
+def GetSharedSkin(pBuilder, pNode, pQuantizationBounds):
+    lT = pNode.GetGeometricTranslation(FbxNode.eSourcePivot)
+    lR = pNode.GetGeometricRotation(FbxNode.eSourcePivot)
+    lS = pNode.GetGeometricScaling(FbxNode.eSourcePivot)
+    lGeometricMatrix = FbxAMatrix(lT, lR, lS)
+
+    lDequantizationMatrix = None
+    lDequantizationKey = None
+    if not pQuantizationBounds == None:
+        lOffset, lScale = pQuantizationBounds
+        lDequantizationMatrix = FbxAMatrix(FbxVector4(lOffset[0], lOffset[1], lOffset[2]), FbxVector4(0, 0, 0), FbxVector4(lScale, lScale, lScale))
+        lDequantizationKey = (tuple(lOffset), lScale)
+
+    lClusters = GetNodeClusters(pBuilder, pNode)
+    lBindMatrices = {}
+    for lNodeIdx in lClusters:
+        lBindMatrices[lNodeIdx] = GetInverseBindMatrix(lClusters[lNodeIdx], lGeometricMatrix, lDequantizationMatrix)
+
+    lKey = (tuple(sorted(FindSkeletonRoots(pBuilder, lClusters))), lDequantizationKey)
+    if not lKey in pBuilder.sharedSkinMap:
+        pBuilder.sharedSkinMap[lKey] = []
+    for lSkin in pBuilder.sharedSkinMap[lKey]:
+        if lSkin.IsBindPoseCompatible(lBindMatrices):
+            break
+    else:
+        lSkinIdx = pBuilder.CreateSkin()
+        lSkin = SkinBuilder(lSkinIdx, pBuilder.lib_skins[lSkinIdx], lDequantizationMatrix if not lDequantizationMatrix == None else FbxMatrix())
+        pBuilder.sharedSkinMap[lKey].append(lSkin)
+        pBuilder.skinBuilders.append(lSkin)
+
+    for lNodeIdx in lBindMatrices:
+        if not lNodeIdx in lSkin.bindMatrices:
+            lSkin.bindMatrices[lNodeIdx] = lBindMatrices[lNodeIdx]
+    return lSkin
 
-def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
+# Joints of skin are only known after all meshes sharing it are converted
+def CreateSkinBindMatrices(pBuilder):
+    for lSkin in pBuilder.skinBuilders:
+        lSkin.roots = FindSkeletonRoots(pBuilder, lSkin.clusters, lSkin)
 
-    global _defaultMaterialIndex;
+        lIBM = [lSkin.bindMatrices[lNodeIdx] for lNodeIdx in lSkin.skin['joints']]
+        lIBM += [lSkin.extraJointMatrix] * len(lSkin.extraJoints)
+        lSkin.skin['inverseBindMatrices'] = pBuilder.CreateIBMBuffer(lIBM)
+
+        lSkin.skin['joints'] += lSkin.extraJoints
+
+# Primitives are added to pMergeGroups instead if given, except the ones with morph targets
+def ConvertMesh(pBuilder, pScene, pMesh, pNode, pSkin, pQuantizationBounds = None, pMorphChannels = [], pMergeGroups = None):
 
     lGLTFPrimitive = {}
     lPositions = []
@@ -420,8 +1236,9 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
 
     lWeights = []
     lJoints = []
-    # Count joint number of each vertex
-    lJointCounts = []
+    # Control point of each vertex, for the deltas of morph targets
+    lVertexControlPoints = []
+    hasMorph = len(pMorphChannels) > 0
 
     # Only consider layer 0
     lLayer = pMesh.GetLayer(0)
@@ -435,15 +1252,13 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
         lMaterial = None;
         if not lLayerMaterial:
             print("Mesh " + pNode.GetName() + " doesn't have material")
-            lMaterial = FbxSurfacePhong.Create(pScene, _defaultMaterialName + str(_defaultMaterialIndex))
-            _defaultMaterialIndex += 1;
+            lMaterial = FbxSurfacePhong.Create(pScene, _defaultMaterialName + str(pBuilder.defaultMaterialIndex))
+            pBuilder.defaultMaterialIndex += 1;
         else:
             # Mapping Mode of material must be eAllSame
             # Because the mesh has been splitted by material
             idx = lLayerMaterial.GetIndexArray()[0];
             lMaterial = pNode.GetMaterial(idx)
-        lMaterialKey = ConvertMaterial(lMaterial)
-        lGLTFPrimitive["material"] = lMaterialKey
 
         lNormalSplitted = False
         lUvSplitted = False
@@ -467,17 +1282,13 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
                 lUv2Splitted = ConvertVertexLayer(pMesh, lLayer2Uv, lTexcoords2)
 
         hasSkin = False
-        moreThanFourJoints = False
-        lMaxJointCount = 0
         ## Handle Skinning data
         if (pMesh.GetDeformerCount(FbxDeformer.eSkin) > 0):
             hasSkin = True
-            lControlPointsCount = pMesh.GetControlPointsCount()
-            for i in range(lControlPointsCount):
-                lWeights.append([0, 0, 0, 0])
-                # -1 can't used in UNSIGNED_SHORT
-                lJoints.append([-1, -1, -1, -1])
-                lJointCounts.append(0)
+            # (vertex, joint, weight) of each influence
+            lSkinVertices = []
+            lSkinJoints = []
+            lSkinWeights = []
 
             for i in range(pMesh.GetDeformerCount(FbxDeformer.eSkin)):
                 lDeformer = pMesh.GetDeformer(i, FbxDeformer.eSkin)
@@ -485,46 +1296,51 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
                 for i2 in range(lDeformer.GetClusterCount()):
                     lCluster = lDeformer.GetCluster(i2)
                     lNode = lCluster.GetLink()
-                    lJointIndex = -1
-                    lNodeIdx = GetNodeIdx(lNode)
-                    if not lNodeIdx in pSkin['joints']:
-                        lJointIndex = len(pSkin['joints'])
-                        pSkin['joints'].append(lNodeIdx)
-
-                        pClusters[lNodeIdx] = lCluster
-                    else:
-                        lJointIndex = pSkin['joints'].index(lNodeIdx)
+                    lJointIndex = pSkin.AddJoint(pBuilder.GetNodeIdx(lNode), lCluster)
 
                     lControlPointIndices = lCluster.GetControlPointIndices()
                     lControlPointWeights = lCluster.GetControlPointWeights()
+                    lCount = lCluster.GetControlPointIndicesCount()
+
+                    lSkinVertices += [lControlPointIndices[i3] for i3 in range(lCount)]
+                    lSkinJoints += [lJointIndex] * lCount
+                    lSkinWeights += [lControlPointWeights[i3] for i3 in range(lCount)]
 
-                    for i3 in range(lCluster.GetControlPointIndicesCount()):
-                        lControlPointIndex = lControlPointIndices[i3]
-                        lControlPointWeight = lControlPointWeights[i3]
-                        lJointCount = lJointCounts[lControlPointIndex]
-
-                        # At most binding four joint per vertex
-                        if lJointCount <= 3:
-                            # Joint index
-                            lJoints[lControlPointIndex][lJointCount] = lJointIndex
-                            lWeights[lControlPointIndex][lJointCount] = lControlPointWeight
-                        else:
-                            moreThanFourJoints = True
-                            # More than four joints, replace joint of minimum Weight
-                            lMinW, lMinIdx = min( (lWeights[lControlPointIndex][i], i) for i in range(len(lWeights[lControlPointIndex])) )
-                            lJoints[lControlPointIndex][lMinIdx] = lJointIndex
-                            lWeights[lControlPointIndex][lMinIdx] = lControlPointWeight
-                            lMaxJointCount = max(lMaxJointCount, lJointIndex)
-                        lJointCounts[lControlPointIndex] += 1
-
-        if moreThanFourJoints:
-            print('More than 4 joints (%d joints) bound to per vertex in %s. ' %(lMaxJointCount, pNode.GetName()))
-
-        # Weight is FLOAT_3 because it is normalized
-        for i in range(len(lWeights)):
-            lWeights[i] = lWeights[i][:3]
-
-        if lNormalSplitted or lUvSplitted or lUv2Splitted:
+            lControlPointsCount = pMesh.GetControlPointsCount()
+            if pBuilder.useNumpy:
+                lJoints, lWeights, lMaxInfluences = BuildSkinWeights(lSkinVertices, lSkinJoints, lSkinWeights, lControlPointsCount, pBuilder.maxInfluences)
+            else:
+                lJoints, lWeights, lMaxInfluences = BuildSkinWeightsList(lSkinVertices, lSkinJoints, lSkinWeights, lControlPointsCount, pBuilder.maxInfluences)
+
+            if lMaxInfluences > pBuilder.maxInfluences:
+                print('More than %d joints (%d joints) bound to per vertex in %s. ' %(pBuilder.maxInfluences, lMaxInfluences, pNode.GetName()))
+
+        if (lNormalSplitted or lUvSplitted or lUv2Splitted) and pBuilder.useNumpy:
+            lStreams = [(ToNumpyArray(pMesh.GetControlPoints(), 3), False)]
+            if lLayerNormal:
+                lStreams.append((ToNumpyArray(lNormals, 3), lNormalSplitted))
+            if lLayerUV:
+                lStreams.append((ToNumpyArray(lTexcoords, 2), lUvSplitted))
+            if lLayer2Uv:
+                lStreams.append((ToNumpyArray(lTexcoords2, 2), lUv2Splitted))
+
+            lPolygonVertices = np.array(pMesh.GetPolygonVertices(), dtype=np.int64)
+            lIndices, lColumns, lFirst = WeldVertexStreams(lPolygonVertices, lStreams, pBuilder.weldEpsilon)
+
+            lPositions = lColumns.pop(0)
+            if lLayerNormal:
+                lNormals = lColumns.pop(0)
+            if lLayerUV:
+                lTexcoords = lColumns.pop(0)
+            if lLayer2Uv:
+                lTexcoords2 = lColumns.pop(0)
+
+            lVertexControlPoints = lPolygonVertices[lFirst]
+            if hasSkin:
+                lWeights = lWeights[lVertexControlPoints]
+                lJoints = lJoints[lVertexControlPoints]
+
+        elif lNormalSplitted or lUvSplitted or lUv2Splitted:
             lCount = 0
             lVertexCount = 0
             lNormalsTmp = []
@@ -550,7 +1366,7 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
 
                 if lLayer2Uv:
                     if not lUv2Splitted:
-                        lTexcoord = lTexcoords2[idx]
+                        lTexcoord2 = lTexcoords2[idx]
                     else:
                         lTexcoord2 = lTexcoords2[lCount]
 
@@ -567,6 +1383,9 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
                 else:
                     lKey = (lPosition[0], lPosition[1], lPosition[2], lNormal[0], lNormal[1], lNormal[2])
 
+                if pBuilder.weldEpsilon > 0:
+                    lKey = QuantizeKey(lKey, pBuilder.weldEpsilon)
+
                 if lKey in lVertexMap:
                     lIndices.append(lVertexMap[lKey])
                 else:
@@ -582,6 +1401,8 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
                     if hasSkin:
                         lWeightsTmp.append(lWeights[idx])
                         lJointsTmp.append(lJoints[idx])
+                    if hasMorph:
+                        lVertexControlPoints.append(idx)
                     lIndices.append(lVertexCount)
                     lVertexMap[lKey] = lVertexCount
                     lVertexCount += 1
@@ -596,32 +1417,228 @@ def ConvertMesh(pScene, pMesh, pNode, pSkin, pClusters):
         else:
             lIndices = pMesh.GetPolygonVertices()
             lPositions = pMesh.GetControlPoints()
+            lVertexControlPoints = list(range(len(lPositions)))
+
+        if pBuilder.vertexCacheSize > 0 and pBuilder.useNumpy:
+            lCacheSize = pBuilder.vertexCacheSize
+            lIndices = np.asarray(lIndices, dtype=np.int64)
+            lMisses = CountCacheMisses(lIndices.tolist(), lCacheSize)
+            lIndices = TipsifyIndices(lIndices, len(lPositions), lCacheSize)
+            lIndices, lOrder = ReorderVerticesForFetch(lIndices, len(lPositions))
+            pBuilder.vertexCacheStats[0] += len(lIndices) // 3
+            pBuilder.vertexCacheStats[1] += lMisses
+            pBuilder.vertexCacheStats[2] += CountCacheMisses(lIndices.tolist(), lCacheSize)
+
+            lPositions = ReorderVertices(lPositions, lOrder)
+            if not lLayerNormal == None:
+                lNormals = ReorderVertices(lNormals, lOrder)
+            if lLayerUV:
+                lTexcoords = ReorderVertices(lTexcoords, lOrder)
+            if lLayer2Uv:
+                lTexcoords2 = ReorderVertices(lTexcoords2, lOrder)
+            if hasSkin:
+                lJoints = ReorderVertices(lJoints, lOrder)
+                lWeights = ReorderVertices(lWeights, lOrder)
+            if hasMorph:
+                lVertexControlPoints = ReorderVertices(lVertexControlPoints, lOrder)
+
+        # Diffuse map packed in atlas is used if all uvs are in the texture
+        lAtlasTexture = None
+        if lLayerUV and lMaterial.GetUniqueID() in pBuilder.atlasMaterials:
+            lPageIdx, lRect = pBuilder.atlasMaterials[lMaterial.GetUniqueID()]
+            lAtlasTexcoords = RemapAtlasTexcoords(pBuilder, lTexcoords, lRect)
+            if not lAtlasTexcoords is None:
+                lTexcoords = lAtlasTexcoords
+                lAtlasTexture = GetAtlasTexture(pBuilder, lPageIdx)
+        lMaterialKey = ConvertMaterial(pBuilder, lMaterial, lAtlasTexture)
+        lGLTFPrimitive["material"] = lMaterialKey
+
+        lVertices = (
+            lPositions,
+            lNormals if not lLayerNormal == None else None,
+            lTexcoords if lLayerUV else None,
+            lTexcoords2 if lLayer2Uv else None,
+            lJoints if hasSkin else None,
+            lWeights if hasSkin else None
+        )
+        if not pMergeGroups == None and not hasMorph:
+            # Primitives with same material and attributes
+            lGroupKey = (lMaterialKey,) + tuple([lList is None for lList in lVertices])
+            if not lGroupKey in pMergeGroups:
+                pMergeGroups[lGroupKey] = []
+            pMergeGroups[lGroupKey].append((lVertices, lIndices))
+            return None
 
         lGLTFPrimitive['attributes'] = {}
-        lGLTFPrimitive['attributes']['POSITION'] = CreateAttributeBuffer(lPositions, 'f', 3)
-        if not lLayerNormal == None:
-            lGLTFPrimitive['attributes']['NORMAL'] = CreateAttributeBuffer(lNormals, 'f', 3)
-        if lLayerUV:
-            lGLTFPrimitive['attributes']['TEXCOORD_0'] = CreateAttributeBuffer(lTexcoords, 'f', 2)
-        if lLayer2Uv:
-            lGLTFPrimitive['attributes']['TEXCOORD_1'] = CreateAttributeBuffer(lTexcoords2, 'f', 2)
-        if hasSkin:
-            # PENDING UNSIGNED_SHORT will have bug.
-            lGLTFPrimitive['attributes']['JOINTS_0'] = CreateAttributeBuffer(lJoints, 'f', 4)
-            lGLTFPrimitive['attributes']['WEIGHTS_0'] = CreateAttributeBuffer(lWeights, 'f', 3)
-
-        if len(lPositions) >= 0xffff:
-            #Use unsigned int in element indices
-            lIndicesType = 'I'
-        else:
-            lIndicesType = 'H'
-        lGLTFPrimitive['indices'] = CreateIndicesBuffer(lIndices, lIndicesType)
+        ConvertPrimitiveAttributes(pBuilder, lGLTFPrimitive['attributes'], pQuantizationBounds, lVertices)
+
+        if hasMorph:
+            lShapes = GetMeshTargetShapes(pMesh)
+            lGLTFPrimitive['targets'] = []
+            for lChannelName in pMorphChannels:
+                lGLTFPrimitive['targets'].append({
+                    'POSITION' : ConvertMorphTarget(pBuilder, pMesh, lShapes.get(lChannelName), lVertexControlPoints, pQuantizationBounds)
+                })
+
+        lGLTFPrimitive['indices'] = ConvertIndices(pBuilder, lIndices, len(lPositions))
 
         return lGLTFPrimitive
     else:
         return None
 
-def ConvertCamera(pCamera):
+def ConvertPrimitiveAttributes(pBuilder, pAttributes, pQuantizationBounds, pVertices):
+    if not pQuantizationBounds == None:
+        ConvertQuantizedAttributes(pBuilder, pAttributes, pQuantizationBounds, *pVertices)
+    else:
+        ConvertAttributes(pBuilder, pAttributes, *pVertices)
+
+def ConvertIndices(pBuilder, pIndices, pVertexCount):
+    if pVertexCount >= 0xffff:
+        #Use unsigned int in element indices
+        lIndicesType = 'I'
+    else:
+        lIndicesType = 'H'
+    return pBuilder.CreateIndicesBuffer(pIndices, lIndicesType)
+
+def ConcatVertices(pBuilder, pLists, pStride):
+    if pBuilder.useNumpy:
+        return np.concatenate([ToNumpyArray(lList, pStride) for lList in pLists])
+    lResult = []
+    for lList in pLists:
+        lResult += list(lList)
+    return lResult
+
+# One primitive of vertices and indices of all merged primitives
+def ConvertMergedPrimitive(pBuilder, pMaterialIdx, pParts, pQuantizationBounds):
+    lStrides = (3, 3, 2, 2, pBuilder.maxInfluences, pBuilder.maxInfluences)
+    lVertices = []
+    for i in range(len(lStrides)):
+        if pParts[0][0][i] is None:
+            lVertices.append(None)
+        else:
+            lVertices.append(ConcatVertices(pBuilder, [lPart[0][i] for lPart in pParts], lStrides[i]))
+
+    lIndices = []
+    lVertexCount = 0
+    for lPartVertices, lPartIndices in pParts:
+        if pBuilder.useNumpy:
+            lIndices.append(np.asarray(lPartIndices, dtype=np.int64) + lVertexCount)
+        else:
+            lIndices += [idx + lVertexCount for idx in lPartIndices]
+        lVertexCount += len(lPartVertices[0])
+    if pBuilder.useNumpy:
+        lIndices = np.concatenate(lIndices)
+
+    lGLTFPrimitive = {'material' : pMaterialIdx, 'attributes' : {}}
+    ConvertPrimitiveAttributes(pBuilder, lGLTFPrimitive['attributes'], pQuantizationBounds, lVertices)
+    lGLTFPrimitive['indices'] = ConvertIndices(pBuilder, lIndices, lVertexCount)
+    return lGLTFPrimitive
+
+# Blend shape channels of all meshes of node, name -> channel in order of first use.
+# Meshes splitted by material have their own channels with the same names.
+def GetNodeBlendShapeChannels(pNode):
+    lChannels = collections.OrderedDict()
+    for i in range(pNode.GetNodeAttributeCount()):
+        lNodeAttribute = pNode.GetNodeAttributeByIndex(i)
+        if lNodeAttribute.GetAttributeType() == FbxNodeAttribute.eMesh:
+            for i2 in range(lNodeAttribute.GetDeformerCount(FbxDeformer.eBlendShape)):
+                lBlendShape = lNodeAttribute.GetDeformer(i2, FbxDeformer.eBlendShape)
+                for i3 in range(lBlendShape.GetBlendShapeChannelCount()):
+                    lChannel = lBlendShape.GetBlendShapeChannel(i3)
+                    if not lChannel.GetName() in lChannels:
+                        lChannels[lChannel.GetName()] = lChannel
+    return lChannels
+
+# Channel name -> target shape at full weight
+def GetMeshTargetShapes(pMesh):
+    lShapes = {}
+    for i in range(pMesh.GetDeformerCount(FbxDeformer.eBlendShape)):
+        lBlendShape = pMesh.GetDeformer(i, FbxDeformer.eBlendShape)
+        for i2 in range(lBlendShape.GetBlendShapeChannelCount()):
+            lChannel = lBlendShape.GetBlendShapeChannel(i2)
+            lCount = lChannel.GetTargetShapeCount()
+            if lCount > 1:
+                print('In-between shapes of blend shape channel %s are ignored.' % lChannel.GetName())
+            if lCount > 0:
+                lShapes[lChannel.GetName()] = lChannel.GetTargetShape(lCount - 1)
+    return lShapes
+
+# Position deltas of vertices, sparse if it is smaller than the dense deltas.
+# Mesh without the channel has a target of zero deltas.
+def ConvertMorphTarget(pBuilder, pMesh, pShape, pVertexControlPoints, pQuantizationBounds):
+    lCount = len(pVertexControlPoints)
+    if pShape == None:
+        return pBuilder.CreateSparseAttributeBuffer([], [], 3, lCount)
+
+    if pBuilder.useNumpy:
+        lControlPoints = np.asarray(pVertexControlPoints, dtype=np.int64)
+        lDeltas = ToNumpyArray(pShape.GetControlPoints(), 3).astype(np.float64) - ToNumpyArray(pMesh.GetControlPoints(), 3).astype(np.float64)
+        lDeltas = lDeltas[lControlPoints]
+        # Deltas are also transformed by the dequantization matrix
+        if not pQuantizationBounds == None:
+            lDeltas /= pQuantizationBounds[1]
+        lMoved = np.nonzero(np.any(lDeltas != 0, axis=1))[0]
+        lMovedDeltas = lDeltas[lMoved]
+    else:
+        lBase = pMesh.GetControlPoints()
+        lTarget = pShape.GetControlPoints()
+        lDeltas = [[lTarget[idx][i] - lBase[idx][i] for i in range(3)] for idx in pVertexControlPoints]
+        lMoved = [idx for idx in range(lCount) if any(lDeltas[idx])]
+        lMovedDeltas = [lDeltas[idx] for idx in lMoved]
+
+    lIndexSize = 2 if lCount <= 0xffff else 4
+    if len(lMoved) * (12 + lIndexSize) < lCount * 12:
+        return pBuilder.CreateSparseAttributeBuffer(lMoved, lMovedDeltas, 3, lCount)
+    return pBuilder.CreateAttributeBuffer(lDeltas, 'f', 3)
+
+def ConvertAttributes(pBuilder, pAttributes, pPositions, pNormals, pTexcoords, pTexcoords2, pJoints, pWeights):
+    pAttributes['POSITION'] = pBuilder.CreateAttributeBuffer(pPositions, 'f', 3)
+    if pNormals is not None:
+        pAttributes['NORMAL'] = pBuilder.CreateAttributeBuffer(pNormals, 'f', 3)
+    if pTexcoords is not None:
+        pAttributes['TEXCOORD_0'] = pBuilder.CreateAttributeBuffer(pTexcoords, 'f', 2)
+    if pTexcoords2 is not None:
+        pAttributes['TEXCOORD_1'] = pBuilder.CreateAttributeBuffer(pTexcoords2, 'f', 2)
+    if pJoints is not None and pBuilder.maxInfluences > 4:
+        for i in range(pBuilder.maxInfluences // 4):
+            pAttributes['JOINTS_%d' % i] = pBuilder.CreateAttributeBuffer(SliceVertices(pJoints, i * 4, i * 4 + 4), 'f', 4)
+            pAttributes['WEIGHTS_%d' % i] = pBuilder.CreateAttributeBuffer(SliceVertices(pWeights, i * 4, i * 4 + 4), 'f', 4)
+    elif pJoints is not None:
+        # PENDING UNSIGNED_SHORT will have bug.
+        pAttributes['JOINTS_0'] = pBuilder.CreateAttributeBuffer(pJoints, 'f', 4)
+        # All 4 weights as the spec requires, same as the quantized VEC4
+        pAttributes['WEIGHTS_0'] = pBuilder.CreateAttributeBuffer(pWeights, 'f', 4)
+
+# https://github.com/KhronosGroup/glTF/tree/master/extensions/2.0/Khronos/KHR_mesh_quantization
+def ConvertQuantizedAttributes(pBuilder, pAttributes, pBounds, pPositions, pNormals, pTexcoords, pTexcoords2, pJoints, pWeights):
+    lPositions = QuantizePositions(ToNumpyArray(pPositions, 3).astype(np.float64), pBounds)
+    # Padded to 4 components
+    pAttributes['POSITION'] = pBuilder.CreateQuantizedAttributeBuffer(lPositions, 'h', 3, True, 8)
+    if pNormals is not None:
+        lNormals = QuantizeNormalized(ToNumpyArray(pNormals, 3).astype(np.float64), 'b')
+        pAttributes['NORMAL'] = pBuilder.CreateQuantizedAttributeBuffer(lNormals, 'b', 3, True, 4)
+    for lSemantic, lTexcoords in (('TEXCOORD_0', pTexcoords), ('TEXCOORD_1', pTexcoords2)):
+        if lTexcoords is None:
+            continue
+        lArray = ToNumpyArray(lTexcoords, 2).astype(np.float64)
+        # Only uvs in [0, 1] can be normalized without a texture transform
+        if len(lArray) == 0 or (lArray.min() >= 0 and lArray.max() <= 1):
+            pAttributes[lSemantic] = pBuilder.CreateQuantizedAttributeBuffer(QuantizeNormalized(lArray, 'H'), 'H', 2, True)
+        else:
+            pAttributes[lSemantic] = pBuilder.CreateAttributeBuffer(lTexcoords, 'f', 2)
+    if pJoints is not None:
+        lInfluences = pBuilder.maxInfluences
+        # Joints of empty influences are -1
+        lJoints = np.maximum(ToNumpyArray(pJoints, lInfluences), 0)
+        lJointsType = 'B' if len(lJoints) == 0 or lJoints.max() < 256 else 'H'
+        lJoints = lJoints.astype(_numpyDTypeMap[lJointsType])
+        # Weights of all sets sum to 255
+        lWeights = QuantizeWeights(ToNumpyArray(pWeights, lInfluences).astype(np.float64))
+        for i in range(lInfluences // 4):
+            pAttributes['JOINTS_%d' % i] = pBuilder.CreateQuantizedAttributeBuffer(np.ascontiguousarray(lJoints[:, i * 4:i * 4 + 4]), lJointsType, 4, False)
+            pAttributes['WEIGHTS_%d' % i] = pBuilder.CreateQuantizedAttributeBuffer(np.ascontiguousarray(lWeights[:, i * 4:i * 4 + 4]), 'B', 4, True)
+
+def ConvertCamera(pBuilder, pCamera):
     lGLTFCamera = {}
 
     if pCamera.ProjectionType.Get() == FbxCamera.ePerspective:
@@ -641,24 +1658,43 @@ def ConvertCamera(pCamera):
             "zfar": pCamera.FarPlane.Get()
         }
 
-    lCameraIdx = len(lib_cameras)
-    lib_cameras.append(lGLTFCamera)
+    lCameraIdx = len(pBuilder.lib_cameras)
+    pBuilder.lib_cameras.append(lGLTFCamera)
     return lCameraIdx
 
-def ConvertSceneNode(pScene, pNode, pPoseTime, fbxConverter):
+# Nodes with same mesh attributes and materials can share one mesh.
+def GetMeshInstanceKey(pNode):
+    lMeshIds = []
+    for i in range(pNode.GetNodeAttributeCount()):
+        lNodeAttribute = pNode.GetNodeAttributeByIndex(i)
+        if lNodeAttribute.GetAttributeType() == FbxNodeAttribute.eMesh:
+            lMeshIds.append(lNodeAttribute.GetUniqueID())
+    # Materials are connected to node, not mesh
+    lMaterialIds = [pNode.GetMaterial(i).GetUniqueID() for i in range(pNode.GetMaterialCount())]
+    return (tuple(lMeshIds), tuple(lMaterialIds))
+
+def ConvertSceneNode(pBuilder, pScene, pNode, pPoseTime, fbxConverter):
     lGLTFNode = {}
     lNodeName = pNode.GetName()
     lGLTFNode['name'] = pNode.GetName()
 
-    lib_nodes.append(lGLTFNode)
+    pBuilder.lib_nodes.append(lGLTFNode)
 
     # Transform matrix
     lGLTFNode['matrix'] = ListFromM4(pNode.EvaluateLocalTransform(pPoseTime))
 
     #PENDING : Triangulate and split all geometry not only the default one ?
-    #PENDING : Multiple node use the same mesh ?
     lGeometry = pNode.GetGeometry()
+    lInstanceKey = None
     if not lGeometry == None:
+        lInstanceKey = GetMeshInstanceKey(pNode)
+
+    # Multiple nodes use the same mesh
+    if lInstanceKey in pBuilder.meshInstanceMap:
+        lMeshIdx, lQuantizationBounds = pBuilder.meshInstanceMap[lInstanceKey]
+        pBuilder.SetNodeMesh(lGLTFNode, lMeshIdx, lQuantizationBounds, False)
+
+    elif not lGeometry == None:
         lMeshKey = lNodeName
         lMeshName = lGeometry.GetName()
         if lMeshName == '':
@@ -669,8 +1705,7 @@ def ConvertSceneNode(pScene, pNode, pPoseTime, fbxConverter):
         fbxConverter.Triangulate(lGeometry, True)
 
         lHasSkin = False
-        lGLTFSkin = None
-        lClusters = {}
+        lSkin = None
 
         # If any attribute of this node have skinning data
         # (Mesh splitted by material may have multiple MeshAttribute in one node)
@@ -679,101 +1714,52 @@ def ConvertSceneNode(pScene, pNode, pPoseTime, fbxConverter):
             if lNodeAttribute.GetAttributeType() == FbxNodeAttribute.eMesh:
                 if (lNodeAttribute.GetDeformerCount(FbxDeformer.eSkin) > 0):
                     lHasSkin = True
+        # All primitives of mesh share one dequantization transform
+        lQuantizationBounds = None
+        if pBuilder.quantize:
+            lControlPoints = []
+            for i in range(pNode.GetNodeAttributeCount()):
+                lNodeAttribute = pNode.GetNodeAttributeByIndex(i)
+                if lNodeAttribute.GetAttributeType() == FbxNodeAttribute.eMesh:
+                    lControlPoints.append(ToNumpyArray(lNodeAttribute.GetControlPoints(), 3).astype(np.float64))
+            lQuantizationBounds = GetQuantizationBounds(np.concatenate(lControlPoints) if len(lControlPoints) > 0 else [])
+
         if lHasSkin:
-            lSkinIdx = CreateSkin()
-            lGLTFSkin = lib_skins[lSkinIdx]
-            lGLTFNode['skin'] = lSkinIdx
+            lSkin = GetSharedSkin(pBuilder, pNode, lQuantizationBounds)
+            lGLTFNode['skin'] = lSkin.skinIdx
+
+        # All primitives have targets of all channels
+        lMorphChannels = GetNodeBlendShapeChannels(pNode)
 
+        lMergeGroups = collections.OrderedDict() if pBuilder.mergePrimitives else None
+        lPrimitives = []
         for i in range(pNode.GetNodeAttributeCount()):
             lNodeAttribute = pNode.GetNodeAttributeByIndex(i)
             if lNodeAttribute.GetAttributeType() == FbxNodeAttribute.eMesh:
-                lPrimitive = ConvertMesh(pScene, lNodeAttribute, pNode, lGLTFSkin, lClusters)
+                lPrimitive = ConvertMesh(pBuilder, pScene, lNodeAttribute, pNode, lSkin, lQuantizationBounds, list(lMorphChannels.keys()), lMergeGroups)
                 if not lPrimitive == None:
-                    if (not "primitives" in lGLTFMesh):
-                        lGLTFMesh["primitives"] = []
-                    lGLTFMesh["primitives"].append(lPrimitive)
+                    lPrimitives.append(lPrimitive)
+        if not lMergeGroups == None:
+            for lGroupKey in lMergeGroups:
+                lPrimitives.append(ConvertMergedPrimitive(pBuilder, lGroupKey[0], lMergeGroups[lGroupKey], lQuantizationBounds))
+        if len(lPrimitives) > 0:
+            lGLTFMesh["primitives"] = lPrimitives
 
         if "primitives" in lGLTFMesh:
-            lMeshIdx = len(lib_meshes)
-            lib_meshes.append(lGLTFMesh)
-            lGLTFNode['mesh'] = lMeshIdx
+            lMeshIdx = len(pBuilder.lib_meshes)
+            pBuilder.lib_meshes.append(lGLTFMesh)
+            if len(lMorphChannels) > 0:
+                lGLTFMesh['weights'] = [lChannel.DeformPercent.Get() / 100 for lChannel in lMorphChannels.values()]
+                lGLTFMesh['extras'] = {'targetNames' : list(lMorphChannels.keys())}
+                pBuilder.morphChannelMap[lMeshIdx] = list(lMorphChannels.values())
+            pBuilder.SetNodeMesh(lGLTFNode, lMeshIdx, lQuantizationBounds, lHasSkin)
+            # Skin is bound to node, only share meshes without skin
+            if not lHasSkin:
+                pBuilder.meshInstanceMap[lInstanceKey] = (lMeshIdx, lQuantizationBounds)
+                # Triangulated meshes may have replaced the mesh attributes
+                pBuilder.meshInstanceMap[GetMeshInstanceKey(pNode)] = (lMeshIdx, lQuantizationBounds)
 
         if lHasSkin:
-            roots = []
-            lExtraJoints = []
-            # Find Root
-            for lNodeIdx in lGLTFSkin['joints']:
-                lCluster = lClusters[lNodeIdx]
-                lLink = lCluster.GetLink()
-                lParent = lLink
-                lRootFound = False
-                # Parent already have index
-                lParentIdx = GetNodeIdx(lParent)
-                # if lParent == None or not lParent.GetName() in lGLTFSkin['joints']:
-                #     if not lParent.GetName() in roots:
-                #         roots.append(lLink.GetName())
-                while not lParent == None:
-                    lSkeleton = lParent.GetSkeleton()
-                    if lSkeleton == None:
-                        break;
-
-                    # In case some skeleton is not a attached to any vertices(not a cluster)
-                    # PENDING
-                    if not lParentIdx in lGLTFSkin['joints'] and not lParentIdx in lExtraJoints:
-                        lExtraJoints.append(lParentIdx)
-
-                    if lSkeleton.IsSkeletonRoot():
-                        lRootFound = True
-                        break;
-                    lParent = lParent.GetParent()
-                    lParentIdx = GetNodeIdx(lParent)
-
-                # lSkeletonTypes = ["Root", "Limb", "Limb Node", "Effector"]
-                # print(lSkeletonTypes[lSkeleton.GetSkeletonType()])
-
-                if lRootFound:
-                    if not lParentIdx in roots:
-                        roots.append(lParentIdx)
-                else:
-                    # TODO IsSkeletonRoot not works well, try another way
-                    # which do not have a parent or its parent is not in skin
-                    lParent = lLink.GetParent()
-                    if lParent == None or not GetNodeIdx(lParent) in lGLTFSkin['joints']:
-                        if not GetNodeIdx(lLink) in roots:
-                            roots.append(GetNodeIdx(lLink))
-
-            # lRootNode = fbxNodes[roots[0]]
-            # lRootNodeTransform = lRootNode.GetParent().EvaluateGlobalTransform()
-
-            lClusterGlobalInitMatrix = FbxAMatrix()
-            lReferenceGlobalInitMatrix = FbxAMatrix()
-
-            lT = pNode.GetGeometricTranslation(FbxNode.eSourcePivot)
-            lR = pNode.GetGeometricRotation(FbxNode.eSourcePivot)
-            lS = pNode.GetGeometricScaling(FbxNode.eSourcePivot)
-
-            lIBM = []
-            for i in range(len(lGLTFSkin['joints'])):
-                lJointIdx = lGLTFSkin['joints'][i]
-                lCluster = lClusters[lJointIdx]
-
-                # Inverse Bind Pose Matrix
-                # Matrix of Mesh
-                lCluster.GetTransformMatrix(lReferenceGlobalInitMatrix)
-                # Matrix of Joint
-                lCluster.GetTransformLinkMatrix(lClusterGlobalInitMatrix)
-                # http://blog.csdn.net/bugrunner/article/details/7232291
-                # http://help.autodesk.com/view/FBX/2017/ENU/?guid=__cpp_ref__view_scene_2_draw_scene_8cxx_example_html
-                m = lClusterGlobalInitMatrix.Inverse() * lReferenceGlobalInitMatrix * FbxAMatrix(lT, lR, lS)
-                lIBM.append(m)
-
-            for i in range(len(lExtraJoints)):
-                lIBM.append(FbxMatrix())
-
-            lGLTFSkin['inverseBindMatrices'] = CreateIBMBuffer(lIBM)
-
-            lGLTFSkin['joints'] += lExtraJoints
-
             # Mesh with skin should have identity global transform.
             # Since vertices have all been transformed to skeleton spaces.
             # PENDING
@@ -789,41 +1775,128 @@ def ConvertSceneNode(pScene, pNode, pPoseTime, fbxConverter):
         if not lNodeAttribute == None:
             lAttributeType = lNodeAttribute.GetAttributeType()
             if lAttributeType == FbxNodeAttribute.eCamera:
-                lCameraKey = ConvertCamera(lNodeAttribute)
+                lCameraKey = ConvertCamera(pBuilder, lNodeAttribute)
                 lGLTFNode['camera'] = lCameraKey
 
     if pNode.GetChildCount() > 0:
         lGLTFNode['children'] = []
         for i in range(pNode.GetChildCount()):
-            lChildNodeIdx = ConvertSceneNode(pScene, pNode.GetChild(i), pPoseTime, fbxConverter)
+            lChildNodeIdx = ConvertSceneNode(pBuilder, pScene, pNode.GetChild(i), pPoseTime, fbxConverter)
             lGLTFNode['children'].append(lChildNodeIdx)
 
-    return GetNodeIdx(pNode)
+    return pBuilder.GetNodeIdx(pNode)
 
-def ConvertScene(pScene, pPoseTime, fbxConverter):
+def ConvertScene(pBuilder, pScene, pPoseTime, fbxConverter):
     lRoot = pScene.GetRootNode()
 
     lGLTFScene = {'nodes' : []}
 
-    lSceneIdx = len(lib_scenes)
-    lib_scenes.append(lGLTFScene)
+    lSceneIdx = len(pBuilder.lib_scenes)
+    pBuilder.lib_scenes.append(lGLTFScene)
 
     for i in range(lRoot.GetChildCount()):
-        lNodeIdx = ConvertSceneNode(pScene, lRoot.GetChild(i), pPoseTime, fbxConverter)
+        lNodeIdx = ConvertSceneNode(pBuilder, pScene, lRoot.GetChild(i), pPoseTime, fbxConverter)
         lGLTFScene['nodes'].append(lNodeIdx)
 
     return lSceneIdx
 
-def CreateAnimation():
-    lAnimIdx = len(lib_animations)
-    lGLTFAnimation = {
-        'channels' : [],
-        'samplers' : []
-    }
+_samplerChannels = ['rotation', 'scale', 'translation']
 
-    return lAnimIdx, lGLTFAnimation
+def LerpVectors(pA, pB, pT):
+    return pA + (pB - pA) * pT[:, None]
 
-_samplerChannels = ['rotation', 'scale', 'translation']
+def VectorError(pInterpolated, pValues):
+    return np.sqrt(((pInterpolated - pValues) ** 2).sum(axis=1))
+
+def SlerpQuaternions(pA, pB, pT):
+    lDot = np.dot(pA, pB)
+    if lDot < 0:
+        pB = -pB
+        lDot = -lDot
+    if lDot > 0.9995:
+        lResult = LerpVectors(pA, pB, pT)
+    else:
+        lTheta = math.acos(lDot)
+        lSin = math.sin(lTheta)
+        lResult = (np.sin((1 - pT) * lTheta)[:, None] * pA + np.sin(pT * lTheta)[:, None] * pB) / lSin
+    return lResult / np.sqrt((lResult ** 2).sum(axis=1))[:, None]
+
+# Angle between rotations in degrees
+def QuaternionError(pInterpolated, pValues):
+    lDot = np.abs((pInterpolated * pValues).sum(axis=1)) / np.sqrt((pValues ** 2).sum(axis=1))
+    return np.degrees(2 * np.arccos(np.clip(lDot, 0, 1)))
+
+def GetSegmentError(pTimes, pValues, pStart, pEnd, pInterpolate, pError):
+    if pEnd - pStart < 2:
+        return 0.0
+    lSpan = pTimes[pEnd] - pTimes[pStart]
+    if lSpan > 0:
+        lT = (pTimes[pStart + 1:pEnd] - pTimes[pStart]) / lSpan
+    else:
+        lT = np.zeros(pEnd - pStart - 1)
+    lInterpolated = pInterpolate(pValues[pStart], pValues[pEnd], lT)
+    return float(pError(lInterpolated, pValues[pStart + 1:pEnd]).max())
+
+# Greedy keyframe reduction. From each kept key, the farthest key whose LINEAR
+# interpolation reproduces all samples in between within the tolerance is kept next.
+# Returns indices of kept keys and the max error.
+def ReduceKeyframes(pTimes, pValues, pTolerance, pInterpolate, pError):
+    lCount = len(pTimes)
+    if lCount <= 2:
+        return np.arange(lCount), 0.0
+    lKept = [0]
+    lMaxError = 0.0
+    i = 0
+    while i < lCount - 1:
+        lGood = i + 1
+        lGoodError = 0.0
+        lBad = lCount
+        # Double the segment until it fails, then binary search between
+        lStep = 2
+        while lGood < lCount - 1:
+            j = min(i + lStep, lCount - 1)
+            lError = GetSegmentError(pTimes, pValues, i, j, pInterpolate, pError)
+            if lError > pTolerance:
+                lBad = j
+                break
+            lGood = j
+            lGoodError = lError
+            lStep *= 2
+        while lBad - lGood > 1:
+            j = (lGood + lBad) // 2
+            lError = GetSegmentError(pTimes, pValues, i, j, pInterpolate, pError)
+            if lError > pTolerance:
+                lBad = j
+            else:
+                lGood = j
+                lGoodError = lError
+        lKept.append(lGood)
+        lMaxError = max(lMaxError, lGoodError)
+        i = lGood
+    return np.array(lKept), lMaxError
+
+def ReduceAnimationChannel(pBuilder, pPath, pTimes, pValues):
+    lTimes = np.array(pTimes, dtype=np.float64)
+    lValues = np.array(pValues, dtype=np.float64)
+    lTranslationTolerance, lRotationTolerance, lScaleTolerance = pBuilder.animTolerance
+    if pPath == 'rotation':
+        # Keep quaternions in the same hemisphere as the previous one
+        if len(lValues) > 1:
+            lDots = (lValues[1:] * lValues[:-1]).sum(axis=1)
+            lValues[1:] *= np.cumprod(np.where(lDots < 0, -1, 1))[:, None]
+        lKept, lMaxError = ReduceKeyframes(lTimes, lValues, lRotationTolerance, SlerpQuaternions, QuaternionError)
+    elif pPath == 'translation':
+        lKept, lMaxError = ReduceKeyframes(lTimes, lValues, lTranslationTolerance, LerpVectors, VectorError)
+    else:
+        lKept, lMaxError = ReduceKeyframes(lTimes, lValues, lScaleTolerance, LerpVectors, VectorError)
+
+    if not pPath in pBuilder.animReductionStats:
+        pBuilder.animReductionStats[pPath] = [0, 0, 0.0]
+    lStats = pBuilder.animReductionStats[pPath]
+    lStats[0] += len(lTimes)
+    lStats[1] += len(lKept)
+    lStats[2] = max(lStats[2], lMaxError)
+    return lTimes[lKept], lValues[lKept]
 
 def GetPropertyAnimationCurveTime(pAnimCurve):
     lTimeSpan = FbxTimeSpan()
@@ -834,9 +1907,8 @@ def GetPropertyAnimationCurveTime(pAnimCurve):
 
     return lStartTimeDouble, lEndTimeDouble, lDuration
 
-def ConvertNodeAnimation(pAnimLayer, pNode, pSampleRate, pStartTime, pDuration):
-    lNodeIdx = GetNodeIdx(pNode)
-
+# Animated channels and sample times of node in the layer, None if not animated
+def GetNodeAnimationRange(pAnimLayer, pNode, pSampleRate, pStartTime, pDuration):
     # PENDING
     lTranslationCurve = pNode.LclTranslation.GetCurve(pAnimLayer, 'X')
     lRotationCurve = pNode.LclRotation.GetCurve(pAnimLayer, 'X')
@@ -863,133 +1935,847 @@ def ConvertNodeAnimation(pAnimLayer, pNode, pSampleRate, pStartTime, pDuration):
     lStartTimeDouble = max(lStartTimeDouble, pStartTime)
 
     if lDuration > 1e-5:
-        lAnimName, lGLTFAnimation = CreateAnimation()
-
         lNumFrames = math.ceil(lDuration / pSampleRate)
+        return (lHaveTranslation, lHaveRotation, lHaveScaling), (lStartTimeDouble, lEndTimeDouble, lNumFrames)
+    return None
+
+def GetSampleTimes(pTimeRange, pSampleRate):
+    lStartTimeDouble, lEndTimeDouble, lNumFrames = pTimeRange
+    return [min(lStartTimeDouble + pSampleRate * i, lEndTimeDouble) for i in range(lNumFrames)]
+
+# Animated nodes of the layer in depth first order
+def ListAnimatedNodes(pAnimLayer, pNode, pSampleRate, pStartTime, pDuration, pAnimatedNodes):
+    lRange = GetNodeAnimationRange(pAnimLayer, pNode, pSampleRate, pStartTime, pDuration)
+    if not lRange == None:
+        pAnimatedNodes.append((pNode, lRange[0], lRange[1]))
+    for i in range(pNode.GetChildCount()):
+        ListAnimatedNodes(pAnimLayer, pNode.GetChild(i), pSampleRate, pStartTime, pDuration, pAnimatedNodes)
 
-        lTime = FbxTime()
+def SampleNodeAnimation(pNode, pPaths, pTimes):
+    lHaveTranslation, lHaveRotation, lHaveScaling = pPaths
+    lTime = FbxTime()
 
-        lTimeChannel = []
-        lTranslationChannel = []
-        lRotationChannel = []
-        lScaleChannel = []
+    lTranslationChannel = []
+    lRotationChannel = []
+    lScaleChannel = []
 
-        lQuaternion = FbxQuaternion()
-        for i in range(lNumFrames):
-            lSecondDouble = min(lStartTimeDouble + pSampleRate * i, lEndTimeDouble)
-            lTime.SetSecondDouble(lSecondDouble)
+    for lSecondDouble in pTimes:
+        lTime.SetSecondDouble(lSecondDouble)
+
+        lTransform = pNode.EvaluateLocalTransform(lTime)
 
-            lTransform = pNode.EvaluateLocalTransform(lTime)
-            lTranslation = lTransform.GetT()
-            lQuaternion = lTransform.GetQ()
-            lScale = lTransform.GetS()
-
-            #Convert quaternion to axis angle
-            lTimeChannel.append(lSecondDouble)
-
-            if lHaveRotation:
-                lRotationChannel.append(list(lQuaternion))
-            if lHaveTranslation:
-                lTranslationChannel.append(list(lTranslation))
-            if lHaveScaling:
-                lScaleChannel.append(list(lScale))
-
-        lSamplerAccessors = {
-            # TODO Share time
-            "time": CreateAnimationBuffer(lTimeChannel, 'f', 1)
-        };
-        if lHaveTranslation:
-            lSamplerAccessors['translation'] = CreateAnimationBuffer(lTranslationChannel, 'f', 3)
         if lHaveRotation:
-            lSamplerAccessors['rotation'] = CreateAnimationBuffer(lRotationChannel, 'f', 4)
+            lRotationChannel.append(list(lTransform.GetQ()))
+        if lHaveTranslation:
+            lTranslationChannel.append(list(lTransform.GetT()))
         if lHaveScaling:
-            lSamplerAccessors['scale'] = CreateAnimationBuffer(lScaleChannel, 'f', 3)
-
-        #TODO Other interpolation methods
-        for path in _samplerChannels:
-            if path in lSamplerAccessors:
-                lSamplerIdx = len(lGLTFAnimation['samplers'])
-                lGLTFAnimation['samplers'].append({
-                    "input": lSamplerAccessors['time'],
-                    "interpolation": "LINEAR",
-                    "output": lSamplerAccessors[path]
-                })
-                lGLTFAnimation['channels'].append({
-                    "sampler" : lSamplerIdx,
-                    "target" : {
-                        "node": lNodeIdx,
-                        "path" : path
-                    }
-                })
-
-        if len(lGLTFAnimation['channels']) > 0:
-            lib_animations.append(lGLTFAnimation)
-
-    for i in range(pNode.GetChildCount()):
-        ConvertNodeAnimation(pAnimLayer, pNode.GetChild(i), pSampleRate, pStartTime, pDuration)
-
-def ConvertAnimation(pScene, pSampleRate, pStartTime, pDuration):
-    lRoot = pScene.GetRootNode()
-    for i in range(pScene.GetSrcObjectCount(FbxCriteria.ObjectType(FbxAnimStack.ClassId))):
-        lAnimStack = pScene.GetSrcObject(FbxCriteria.ObjectType(FbxAnimStack.ClassId), i)
-        for j in range(lAnimStack.GetSrcObjectCount(FbxCriteria.ObjectType(FbxAnimLayer.ClassId))):
-            lAnimLayer = lAnimStack.GetSrcObject(FbxCriteria.ObjectType(FbxAnimLayer.ClassId), j)
-            # for k in range(lRoot.GetChildCount()):
-            ConvertNodeAnimation(lAnimLayer, lRoot, pSampleRate, pStartTime, pDuration)
-
-
-def CreateBufferView(pBufferIdx, appendBufferData, lib, lByteOffset, target=GL_ARRAY_BUFFER):
-    lBufferViewIdx = len(lib_buffer_views)
-    lBufferView = {
-        "buffer": pBufferIdx,
-        "byteLength": len(appendBufferData),
-        "byteOffset": lByteOffset,
-        # PENDING
-        "byteStride": 0,
-        "target": target
-    }
-    lib_buffer_views.append(lBufferView)
-    for lAttrib in lib:
-        lAttrib['bufferView'] = lBufferViewIdx
-
-    return lBufferView
-
+            lScaleChannel.append(list(lTransform.GetS()))
+
+    return lTranslationChannel, lRotationChannel, lScaleChannel
+
+_transformLimits = [
+    lPath + lLimit + lAxis
+    for lPath in ['Translation', 'Rotation', 'Scaling']
+    for lLimit in ['Min', 'Max']
+    for lAxis in 'XYZ'
+]
+
+# Local transform is composed from the curves directly, translation * rotation * scale
+# in XYZ euler order, which is the common case of exported skeletons. Limits clamp the
+# evaluated values, they are only applied by the evaluator.
+# Without RotationActive, pre/post rotation and order are ignored by the evaluator,
+# so requiring their defaults is the same in both cases.
+def CanSampleCurveKeys(pNode):
+    if not (HasNoPivots(pNode) and IsZeroVector(pNode.PreRotation.Get()) and IsZeroVector(pNode.PostRotation.Get()) \
+        and pNode.RotationOrder.Get() == eEulerXYZ and pNode.InheritType.Get() == FbxTransform.eInheritRSrs):
+        return False
+    for lLimit in _transformLimits:
+        if getattr(pNode, lLimit).Get():
+            return False
+    return True
+
+# Values of keys from GetCurveKeys at all the times, segments are hermite splines and
+# values are constant before the first key and after the last key.
+def EvaluateCurveKeys(pKeys, pTimes):
+    lKeyTimes, lValues, lInTangents, lOutTangents = [np.array(lList, dtype=np.float64) for lList in pKeys]
+    if len(lKeyTimes) == 1:
+        return np.full(len(pTimes), lValues[0])
+    lTimes = np.clip(pTimes, lKeyTimes[0], lKeyTimes[-1])
+    lSegments = np.clip(np.searchsorted(lKeyTimes, lTimes, side='right') - 1, 0, len(lKeyTimes) - 2)
+    lStart = lKeyTimes[lSegments]
+    lSpan = lKeyTimes[lSegments + 1] - lStart
+    lSpan[lSpan <= 0] = 1
+    t = (lTimes - lStart) / lSpan
+    t2 = t * t
+    t3 = t2 * t
+    return (2 * t3 - 3 * t2 + 1) * lValues[lSegments] \
+        + (t3 - 2 * t2 + t) * lOutTangents[lSegments] * lSpan \
+        + (-2 * t3 + 3 * t2) * lValues[lSegments + 1] \
+        + (t3 - t2) * lInTangents[lSegments + 1] * lSpan
+
+# Vector property at all the times, None if a curve can't be evaluated from its keys
+def SampleCurveKeyChannel(pAnimLayer, pProperty, pTimes):
+    lStaticValue = pProperty.Get()
+    lChannel = np.empty((len(pTimes), 3))
+    for i in range(3):
+        lCurve = pProperty.GetCurve(pAnimLayer, 'XYZ'[i])
+        if lCurve == None:
+            lChannel[:, i] = lStaticValue[i]
+            continue
+        # Values are held outside the keys, cycles and repetitions need the evaluator
+        if not lCurve.GetPreExtrapolation() == FbxAnimCurveBase.eConstant \
+            or not lCurve.GetPostExtrapolation() == FbxAnimCurveBase.eConstant:
+            return None
+        lKeys = GetCurveKeys(lCurve, -math.inf, math.inf)
+        if lKeys == None:
+            return None
+        lChannel[:, i] = EvaluateCurveKeys(lKeys, pTimes)
+    return lChannel
+
+# Quaternions of XYZ euler angles in degrees, w is positive as the evaluator returns
+def EulerToQuaternions(pAngles):
+    lHalfAngles = np.radians(pAngles) / 2
+    lCx, lCy, lCz = np.cos(lHalfAngles).T
+    lSx, lSy, lSz = np.sin(lHalfAngles).T
+    lQuaternions = np.stack([
+        lSx * lCy * lCz - lCx * lSy * lSz,
+        lCx * lSy * lCz + lSx * lCy * lSz,
+        lCx * lCy * lSz - lSx * lSy * lCz,
+        lCx * lCy * lCz + lSx * lSy * lSz
+    ], axis=1)
+    lQuaternions[lQuaternions[:, 3] < 0] *= -1
+    return lQuaternions
+
+# Channels of node sampled from the keys of its curves in the only layer, without
+# evaluating the transform frame by frame. None if the evaluator is needed.
+def SampleCurveKeyAnimation(pAnimLayer, pNode, pPaths, pTimes):
+    if not CanSampleCurveKeys(pNode):
+        return None
+    lHaveTranslation, lHaveRotation, lHaveScaling = pPaths
+    lTimes = np.array(pTimes)
+    lTranslations = lRotations = lScales = None
+    if lHaveTranslation:
+        lTranslations = SampleCurveKeyChannel(pAnimLayer, pNode.LclTranslation, lTimes)
+        if lTranslations is None:
+            return None
+    if lHaveRotation:
+        lAngles = SampleCurveKeyChannel(pAnimLayer, pNode.LclRotation, lTimes)
+        if lAngles is None:
+            return None
+        lRotations = EulerToQuaternions(lAngles)
+    if lHaveScaling:
+        lScales = SampleCurveKeyChannel(pAnimLayer, pNode.LclScaling, lTimes)
+        # Negative and zero scale are decomposed differently by the evaluator
+        if lScales is None or np.any(lScales <= 0):
+            return None
+    return lTranslations, lRotations, lScales
+
+# Nodes with the same sample times are evaluated frame by frame together, so the time
+# is set once per frame and the evaluator works on one time at a time. Channels are
+# written to numpy arrays, which are packed without converting to lists.
+# Nodes with plain transforms are sampled from curve keys if the only layer is given.
+def SampleNodeAnimations(pAnimatedNodes, pSampleRate, pAnimLayer = None):
+    lGroups = {}
+    for idx in range(len(pAnimatedNodes)):
+        lNode, lPaths, lTimeRange = pAnimatedNodes[idx]
+        if not lTimeRange in lGroups:
+            lGroups[lTimeRange] = []
+        lGroups[lTimeRange].append(idx)
+
+    lSamples = [None] * len(pAnimatedNodes)
+    lTime = FbxTime()
+    for lTimeRange in lGroups:
+        lTimes = GetSampleTimes(lTimeRange, pSampleRate)
+        lNumFrames = len(lTimes)
+        lTargets = []
+        for idx in lGroups[lTimeRange]:
+            lNode, lPaths, lTimeRange = pAnimatedNodes[idx]
+            if not pAnimLayer == None:
+                lChannels = SampleCurveKeyAnimation(pAnimLayer, lNode, lPaths, lTimes)
+                if not lChannels == None:
+                    lSamples[idx] = (lTimes, lChannels)
+                    continue
+            lHaveTranslation, lHaveRotation, lHaveScaling = lPaths
+            # FbxVector4 and FbxQuaternion have 4 components
+            lChannels = (
+                np.empty((lNumFrames, 4)) if lHaveTranslation else None,
+                np.empty((lNumFrames, 4)) if lHaveRotation else None,
+                np.empty((lNumFrames, 4)) if lHaveScaling else None
+            )
+            lTargets.append((lNode, lChannels[0], lChannels[1], lChannels[2]))
+            lSamples[idx] = (lTimes, lChannels)
 
-def CreateBufferViews(pBufferIdx):
+        for i in range(lNumFrames):
+            lTime.SetSecondDouble(lTimes[i])
+            for lNode, lTranslations, lRotations, lScales in lTargets:
+                lTransform = lNode.EvaluateLocalTransform(lTime)
+                if not lRotations is None:
+                    lRotations[i] = lTransform.GetQ()
+                if not lTranslations is None:
+                    lTranslations[i] = lTransform.GetT()
+                if not lScales is None:
+                    lScales[i] = lTransform.GetS()
+
+    return lSamples
+
+def IsZeroVector(pVector):
+    return pVector[0] == 0 and pVector[1] == 0 and pVector[2] == 0
+
+# Translation is affected by rotation and scale with pivots and offsets
+def HasNoPivots(pNode):
+    return IsZeroVector(pNode.RotationOffset.Get()) and IsZeroVector(pNode.RotationPivot.Get()) \
+        and IsZeroVector(pNode.ScalingOffset.Get()) and IsZeroVector(pNode.ScalingPivot.Get())
+
+# Keys of one component curve, with tangents in value per second.
+# Returns None if any key can't be mapped to a cubic spline segment.
+def GetCurveKeys(pCurve, pStartTime, pEndTime):
+    lCount = pCurve.KeyGetCount()
+    lTimes = [pCurve.KeyGetTime(i).GetSecondDouble() for i in range(lCount)]
+    lValues = [pCurve.KeyGetValue(i) for i in range(lCount)]
+    lInTangents = [0.0] * lCount
+    lOutTangents = [0.0] * lCount
+    if lCount == 0 or lTimes[0] < pStartTime or lTimes[-1] > pEndTime:
+        return None
+    for i in range(lCount - 1):
+        lInterpolation = pCurve.KeyGetInterpolation(i)
+        if lInterpolation == FbxAnimCurveDef.eInterpolationCubic:
+            # Weighted tangents are bezier handles which hermite spline can't represent
+            if pCurve.KeyIsRightTangentWeighted(i) or pCurve.KeyIsLeftTangentWeighted(i + 1):
+                return None
+            lOutTangents[i] = pCurve.KeyGetRightDerivative(i)
+            lInTangents[i + 1] = pCurve.KeyGetLeftDerivative(i + 1)
+        elif lInterpolation == FbxAnimCurveDef.eInterpolationLinear:
+            lSpan = lTimes[i + 1] - lTimes[i]
+            lSlope = (lValues[i + 1] - lValues[i]) / lSpan if lSpan > 0 else 0.0
+            lOutTangents[i] = lInTangents[i + 1] = lSlope
+        else:
+            # Constant interpolation
+            return None
+    return lTimes, lValues, lInTangents, lOutTangents
+
+# glTF CUBICSPLINE output of a vector property, in tangent, value and out tangent
+# of each key. Components must have keys at the same times.
+def GetCubicSplineChannel(pAnimLayer, pProperty, pStartTime, pEndTime):
+    lTimes = None
+    lComponents = []
+    lStaticValue = pProperty.Get()
+    for i in range(3):
+        lCurve = pProperty.GetCurve(pAnimLayer, 'XYZ'[i])
+        if lCurve == None:
+            lComponents.append(None)
+            continue
+        lKeys = GetCurveKeys(lCurve, pStartTime, pEndTime)
+        if lKeys == None:
+            return None
+        if lTimes == None:
+            lTimes = lKeys[0]
+        elif not lTimes == lKeys[0]:
+            return None
+        lComponents.append(lKeys)
+    # CUBICSPLINE sampler needs at least 2 keyframes, single key is sampled
+    if lTimes == None or len(lTimes) < 2:
+        return None
 
-    lByteOffset = CreateBufferView(pBufferIdx, attributeBuffer, lib_attributes_accessors, 0)['byteLength']
+    lOutput = []
+    for k in range(len(lTimes)):
+        lInTangent = []
+        lValue = []
+        lOutTangent = []
+        for i in range(3):
+            if lComponents[i] == None:
+                lInTangent.append(0.0)
+                lValue.append(lStaticValue[i])
+                lOutTangent.append(0.0)
+            else:
+                lInTangent.append(lComponents[i][2][k])
+                lValue.append(lComponents[i][1][k])
+                lOutTangent.append(lComponents[i][3][k])
+        lOutput += [lInTangent, lValue, lOutTangent]
+    return lTimes, lOutput
+
+# Translation and scale which can be exported from keys. Rotation curves are euler
+# angles and are always sampled to quaternions.
+def GetCubicSplineChannels(pBuilder, pAnimLayer, pNode, pPaths, pStartTime, pDuration):
+    lHaveTranslation, lHaveRotation, lHaveScaling = pPaths
+    lCubicChannels = {}
+    lEndTime = pStartTime + pDuration
+    if lHaveTranslation:
+        if HasNoPivots(pNode):
+            lChannel = GetCubicSplineChannel(pAnimLayer, pNode.LclTranslation, pStartTime, lEndTime)
+            if not lChannel == None:
+                lCubicChannels['translation'] = lChannel
+    if lHaveScaling:
+        lChannel = GetCubicSplineChannel(pAnimLayer, pNode.LclScaling, pStartTime, lEndTime)
+        if not lChannel == None:
+            lCubicChannels['scale'] = lChannel
+
+    pBuilder.cubicSplineStats[0] += len(lCubicChannels)
+    pBuilder.cubicSplineStats[1] += lHaveTranslation + lHaveRotation + lHaveScaling - len(lCubicChannels)
+    return lCubicChannels
+
+def CreateNodeAnimation(pBuilder, pGLTFAnimation, pNode, pTimeChannel, pTranslationChannel, pRotationChannel, pScaleChannel, pCubicChannels = {}):
+    lNodeIdx = pBuilder.GetNodeIdx(pNode)
+
+    lChannels = []
+    if not pTranslationChannel is None:
+        lChannels.append(('translation', pTranslationChannel, 3))
+    if not pRotationChannel is None:
+        lChannels.append(('rotation', pRotationChannel, 4))
+    if not pScaleChannel is None:
+        lChannels.append(('scale', pScaleChannel, 3))
+
+    lSamplerInputs = {}
+    lSamplerAccessors = {}
+    if len(lChannels) == 0:
+        pass
+    elif pBuilder.animTolerance == None:
+        lTimeAccessor = pBuilder.CreateTimeBuffer(pTimeChannel)
+        for path, lChannel, lStride in lChannels:
+            lSamplerInputs[path] = lTimeAccessor
+            lSamplerAccessors[path] = pBuilder.CreateAnimationBuffer(lChannel, 'f', lStride)
+    else:
+        # Channels keep different keys after reduction
+        pBuilder.animReductionBytes[0] += len(pTimeChannel) * 4
+        for path, lChannel, lStride in lChannels:
+            lTimes, lValues = ReduceAnimationChannel(pBuilder, path, pTimeChannel, ToNumpyArray(lChannel, lStride))
+            pBuilder.animReductionBytes[0] += len(lChannel) * lStride * 4
+            pBuilder.animReductionBytes[1] += len(lTimes) * (lStride + 1) * 4
+            lSamplerInputs[path] = pBuilder.CreateTimeBuffer(lTimes)
+            lSamplerAccessors[path] = pBuilder.CreateAnimationBuffer(lValues, 'f', lStride)
+
+    lInterpolations = {}
+    for path in _samplerChannels:
+        if path in pCubicChannels:
+            lTimes, lOutput = pCubicChannels[path]
+            lSamplerInputs[path] = pBuilder.CreateTimeBuffer(lTimes)
+            lSamplerAccessors[path] = pBuilder.CreateAnimationBuffer(lOutput, 'f', 3)
+            lInterpolations[path] = 'CUBICSPLINE'
+
+    for path in _samplerChannels:
+        if path in lSamplerAccessors:
+            lSamplerIdx = len(pGLTFAnimation['samplers'])
+            pGLTFAnimation['samplers'].append({
+                "input": lSamplerInputs[path],
+                "interpolation": lInterpolations.get(path, 'LINEAR'),
+                "output": lSamplerAccessors[path]
+            })
+            pGLTFAnimation['channels'].append({
+                "sampler" : lSamplerIdx,
+                "target" : {
+                    "node": lNodeIdx,
+                    "path" : path
+                }
+            })
 
-    if len(lib_ibm_accessors) > 0:
-        lByteOffset += CreateBufferView(pBufferIdx, invBindMatricesBuffer, lib_ibm_accessors, lByteOffset)['byteLength']
+# Scene loaded in the animation worker process, FBX objects can't be sent between processes.
+_workerScene = None
+_workerNodes = None
+_workerFilePath = None
 
-    if len(lib_animation_accessors) > 0:
-        lByteOffset += CreateBufferView(pBufferIdx, animationBuffer, lib_animation_accessors, lByteOffset)['byteLength']
+# Nodes in the same depth first order of node indices, index 0 is the root node
+def ListSceneNodes(pNode, pNodes):
+    pNodes.append(pNode)
+    for i in range(pNode.GetChildCount()):
+        ListSceneNodes(pNode.GetChild(i), pNodes)
 
-    #Indices buffer view
-    #Put the indices buffer at last or there may be a error
-    #When creating a Float32Array, which the offset must be multiple of 4
-    CreateBufferView(pBufferIdx, indicesBuffer, lib_indices_accessors, lByteOffset, GL_ELEMENT_ARRAY_BUFFER)
+# Errors raised in the pool initializer make the pool restart workers forever,
+# so the failure is raised by the first task instead.
+def InitAnimationWorker(pFilePath):
+    global _workerScene, _workerNodes, _workerFilePath
+    _workerFilePath = pFilePath
+    lSdkManager, lScene = InitializeSdkObjects()
+    if not LoadScene(lSdkManager, lScene, pFilePath):
+        return
+    _workerScene = lScene
+    _workerNodes = []
+    ListSceneNodes(_workerScene.GetRootNode(), _workerNodes)
+
+def SampleAnimationPartition(pTask):
+    if _workerScene == None:
+        raise RuntimeError("Animation worker failed to load the scene %s" % _workerFilePath)
+    lStackIdx, lPartition, lSampleRate, lKeySampling = pTask
+    lAnimStack = _workerScene.GetSrcObject(FbxCriteria.ObjectType(FbxAnimStack.ClassId), lStackIdx)
+    _workerScene.SetCurrentAnimationStack(lAnimStack)
+    lAnimatedNodes = [(_workerNodes[lNodeIdx + 1], lPaths, lTimeRange) for lNodeIdx, lPaths, lTimeRange in lPartition]
+    lAnimLayer = None
+    if lKeySampling and lAnimStack.GetSrcObjectCount(FbxCriteria.ObjectType(FbxAnimLayer.ClassId)) == 1:
+        lAnimLayer = lAnimStack.GetSrcObject(FbxCriteria.ObjectType(FbxAnimLayer.ClassId), 0)
+    return SampleNodeAnimations(lAnimatedNodes, lSampleRate, lAnimLayer)
+
+# Nodes are split to contiguous partitions of similar frame count, sampled in worker
+# processes and merged in the partition order, which is same with the serial sampling.
+def SampleNodeAnimationsParallel(pBuilder, pStackIdx, pAnimatedNodes, pSampleRate):
+    lTotalFrames = sum([lTimeRange[2] for lNode, lPaths, lTimeRange in pAnimatedNodes])
+    lPartitionFrames = lTotalFrames / pBuilder.animJobs
+    lTasks = []
+    lPartition = []
+    lFrames = 0
+    for lNode, lPaths, lTimeRange in pAnimatedNodes:
+        lPartition.append((pBuilder.GetNodeIdx(lNode), lPaths, lTimeRange))
+        lFrames += lTimeRange[2]
+        if lFrames >= lPartitionFrames * (len(lTasks) + 1):
+            lTasks.append((pStackIdx, lPartition, pSampleRate, pBuilder.keySampling))
+            lPartition = []
+    if len(lPartition) > 0:
+        lTasks.append((pStackIdx, lPartition, pSampleRate, pBuilder.keySampling))
+
+    lSamples = []
+    for lPartitionSamples in pBuilder.animPool.map(SampleAnimationPartition, lTasks):
+        lSamples += lPartitionSamples
+    return lSamples
+
+# Layers are blended by the evaluator, node animated in several layers is sampled
+# once with all its channels in the union of time ranges.
+def MergeAnimatedNodes(pLayerAnimatedNodes, pSampleRate, pDuration):
+    lAnimatedNodes = []
+    lNodeIndices = {}
+    for lLayerAnimatedNodes in pLayerAnimatedNodes:
+        for lNode, lPaths, lTimeRange in lLayerAnimatedNodes:
+            lNodeId = lNode.GetUniqueID()
+            if not lNodeId in lNodeIndices:
+                lNodeIndices[lNodeId] = len(lAnimatedNodes)
+                lAnimatedNodes.append((lNode, lPaths, lTimeRange))
+                continue
+            idx = lNodeIndices[lNodeId]
+            lPrevNode, lPrevPaths, lPrevTimeRange = lAnimatedNodes[idx]
+            lStartTimeDouble = min(lPrevTimeRange[0], lTimeRange[0])
+            lEndTimeDouble = max(lPrevTimeRange[1], lTimeRange[1])
+            lNumFrames = max(
+                lPrevTimeRange[2], lTimeRange[2],
+                math.ceil(min(lEndTimeDouble - lStartTimeDouble, pDuration) / pSampleRate)
+            )
+            lAnimatedNodes[idx] = (lNode, (
+                lPrevPaths[0] or lPaths[0],
+                lPrevPaths[1] or lPaths[1],
+                lPrevPaths[2] or lPaths[2]
+            ), (lStartTimeDouble, lEndTimeDouble, lNumFrames))
+    return lAnimatedNodes
+
+def ConvertNodeAnimation(pBuilder, pGLTFAnimation, pAnimLayers, pNode, pSampleRate, pStartTime, pDuration, pStackIdx = 0):
+    lLayerAnimatedNodes = []
+    for lAnimLayer in pAnimLayers:
+        lAnimatedNodes = []
+        ListAnimatedNodes(lAnimLayer, pNode, pSampleRate, pStartTime, pDuration, lAnimatedNodes)
+        lLayerAnimatedNodes.append(lAnimatedNodes)
+    lAnimatedNodes = MergeAnimatedNodes(lLayerAnimatedNodes, pSampleRate, pDuration)
+
+    # Channels exported from keys are not sampled.
+    # Keys of one layer are the final values only if there is no other layer.
+    lCubicChannels = [{}] * len(lAnimatedNodes)
+    if pBuilder.cubicSpline and len(pAnimLayers) == 1:
+        lAnimLayer = pAnimLayers[0]
+        for idx in range(len(lAnimatedNodes)):
+            lNode, lPaths, lTimeRange = lAnimatedNodes[idx]
+            lCubicChannels[idx] = GetCubicSplineChannels(pBuilder, lAnimLayer, lNode, lPaths, pStartTime, pDuration)
+            lAnimatedNodes[idx] = (lNode, (
+                lPaths[0] and not 'translation' in lCubicChannels[idx],
+                lPaths[1],
+                lPaths[2] and not 'scale' in lCubicChannels[idx]
+            ), lTimeRange)
+    elif pBuilder.cubicSpline:
+        for lNode, lPaths, lTimeRange in lAnimatedNodes:
+            pBuilder.cubicSplineStats[1] += sum(lPaths)
+    lSampledNodes = [idx for idx in range(len(lAnimatedNodes)) if any(lAnimatedNodes[idx][1])]
+
+    if not pBuilder.animPool == None and len(lSampledNodes) > 1:
+        lSamples = SampleNodeAnimationsParallel(pBuilder, pStackIdx, [lAnimatedNodes[idx] for idx in lSampledNodes], pSampleRate)
+    elif pBuilder.useNumpy:
+        lSamples = SampleNodeAnimations([lAnimatedNodes[idx] for idx in lSampledNodes], pSampleRate,
+            pAnimLayers[0] if pBuilder.keySampling and len(pAnimLayers) == 1 else None)
+    else:
+        lSamples = []
+        for idx in lSampledNodes:
+            lNode, lPaths, lTimeRange = lAnimatedNodes[idx]
+            lTimes = GetSampleTimes(lTimeRange, pSampleRate)
+            lSamples.append((lTimes, SampleNodeAnimation(lNode, lPaths, lTimes)))
+    lNodeSamples = dict(zip(lSampledNodes, lSamples))
+
+    for idx in range(len(lAnimatedNodes)):
+        lNode, lPaths, lTimeRange = lAnimatedNodes[idx]
+        lTimes, lChannels = lNodeSamples.get(idx, (None, (None, None, None)))
+        CreateNodeAnimation(pBuilder, pGLTFAnimation, lNode, lTimes,
+            lChannels[0] if lPaths[0] else None,
+            lChannels[1] if lPaths[1] else None,
+            lChannels[2] if lPaths[2] else None,
+            lCubicChannels[idx]
+        )
+
+    ConvertMorphAnimation(pBuilder, pGLTFAnimation, pAnimLayers, pSampleRate, pStartTime, pDuration)
+
+# Weights of all blend shape channels of mesh are sampled in one sampler.
+# PENDING Channel animated in several layers only use the curve of first layer.
+def ConvertMorphAnimation(pBuilder, pGLTFAnimation, pAnimLayers, pSampleRate, pStartTime, pDuration):
+    if len(pBuilder.morphTargetNodes) == 0:
+        return
+    lNodeIndices = dict((id(lGLTFNode), idx) for idx, lGLTFNode in enumerate(pBuilder.lib_nodes))
+    lTime = FbxTime()
+    for lGLTFNode, lChannels in pBuilder.morphTargetNodes:
+        lCurves = []
+        lStartTimeDouble = lEndTimeDouble = None
+        for lChannel in lChannels:
+            lCurve = None
+            for lAnimLayer in pAnimLayers:
+                lCurve = lChannel.DeformPercent.GetCurve(lAnimLayer)
+                if not lCurve == None:
+                    lCurveStartTime, lCurveEndTime, lCurveDuration = GetPropertyAnimationCurveTime(lCurve)
+                    lStartTimeDouble = lCurveStartTime if lStartTimeDouble == None else min(lStartTimeDouble, lCurveStartTime)
+                    lEndTimeDouble = lCurveEndTime if lEndTimeDouble == None else max(lEndTimeDouble, lCurveEndTime)
+                    break
+            lCurves.append(lCurve)
+        if lStartTimeDouble == None:
+            continue
+
+        lDuration = min(lEndTimeDouble - lStartTimeDouble, pDuration)
+        lStartTimeDouble = max(lStartTimeDouble, pStartTime)
+        if lDuration < 1e-5:
+            continue
+        lTimes = GetSampleTimes((lStartTimeDouble, lEndTimeDouble, math.ceil(lDuration / pSampleRate)), pSampleRate)
+
+        # Weights of all targets at each frame
+        lWeights = []
+        for lSecondDouble in lTimes:
+            lTime.SetSecondDouble(lSecondDouble)
+            for i in range(len(lChannels)):
+                if lCurves[i] == None:
+                    lWeights.append(lChannels[i].DeformPercent.Get() / 100)
+                else:
+                    lWeights.append(lCurves[i].Evaluate(lTime) / 100)
 
+        lSamplerIdx = len(pGLTFAnimation['samplers'])
+        pGLTFAnimation['samplers'].append({
+            "input": pBuilder.CreateTimeBuffer(lTimes),
+            "interpolation": 'LINEAR',
+            "output": pBuilder.CreateAnimationBuffer(lWeights, 'f', 1)
+        })
+        pGLTFAnimation['channels'].append({
+            "sampler" : lSamplerIdx,
+            "target" : {
+                "node": lNodeIndices[id(lGLTFNode)],
+                "path" : 'weights'
+            }
+        })
 
-# Start from -1 and ignore the root node
-_nodeCount = -1
-_nodeIdxMap = {}
-def ListNodes(pNode, fbxConverter):
-    global _nodeCount
-    _nodeIdxMap[pNode.GetUniqueID()] = _nodeCount
-    _nodeCount = _nodeCount + 1
+# One named animation of each anim stack
+def ConvertAnimation(pBuilder, pScene, pSampleRate, pStartTime, pDuration):
+    lRoot = pScene.GetRootNode()
+    lStackCount = pScene.GetSrcObjectCount(FbxCriteria.ObjectType(FbxAnimStack.ClassId))
+    if pBuilder.animJobs > 1 and lStackCount > 0 and pBuilder.filePath:
+        pBuilder.animPool = multiprocessing.Pool(pBuilder.animJobs, InitAnimationWorker, (pBuilder.filePath,))
+
+    try:
+        for i in range(lStackCount):
+            lAnimStack = pScene.GetSrcObject(FbxCriteria.ObjectType(FbxAnimStack.ClassId), i)
+            # Transforms are evaluated in the current anim stack
+            pScene.SetCurrentAnimationStack(lAnimStack)
+
+            lAnimLayers = []
+            for j in range(lAnimStack.GetSrcObjectCount(FbxCriteria.ObjectType(FbxAnimLayer.ClassId))):
+                lAnimLayers.append(lAnimStack.GetSrcObject(FbxCriteria.ObjectType(FbxAnimLayer.ClassId), j))
+
+            lAnimName = lAnimStack.GetName()
+            if pBuilder.splitClips:
+                pBuilder.BeginClipBuffer(lAnimName)
+            lAnimIdx, lGLTFAnimation = pBuilder.CreateAnimation(lAnimName)
+            ConvertNodeAnimation(pBuilder, lGLTFAnimation, lAnimLayers, lRoot, pSampleRate, pStartTime, pDuration, i)
+            if len(lGLTFAnimation['channels']) > 0:
+                pBuilder.lib_animations.append(lGLTFAnimation)
+
+        if pBuilder.splitClips:
+            pBuilder.EndClipBuffers()
+    except BaseException:
+        # Workers may be still sampling, don't wait for them
+        if not pBuilder.animPool == None:
+            pBuilder.animPool.terminate()
+        raise
+    finally:
+        if not pBuilder.animPool == None:
+            pBuilder.animPool.close()
+            pBuilder.animPool.join()
+            pBuilder.animPool = None
+
+
+def ListNodes(pBuilder, pNode, fbxConverter):
+    pBuilder.AddNode(pNode)
     
     # TODO SplitMeshPerMaterial may loss deformer in mesh
     # TODO It will be crashed in some fbx files
     # FBX version 2014.2 seems have fixed it
-    if not pNode.GetMesh() == None:
-        fbxConverter.SplitMeshPerMaterial(pNode.GetMesh(), True)
+    lMesh = pNode.GetMesh()
+    # Mesh shared by nodes only need to be splitted once
+    if not lMesh == None and not lMesh.GetUniqueID() in pBuilder.splittedMeshIds:
+        pBuilder.splittedMeshIds.add(lMesh.GetUniqueID())
+        fbxConverter.SplitMeshPerMaterial(lMesh, True)
 
     for k in range(pNode.GetChildCount()):
-        ListNodes(pNode.GetChild(k), fbxConverter)
+        ListNodes(pBuilder, pNode.GetChild(k), fbxConverter)
+
+def GetPadding(pByteLength):
+    return (4 - pByteLength % 4) % 4
+
+def GetBuffersByteLength(pBuffers):
+    lByteLength = 0
+    for lBuffer in pBuffers:
+        lByteLength += len(lBuffer)
+    return lByteLength
+
+# Section of the buffer read from a file when written, such as embedded images.
+class FileSection(object):
+
+    def __init__(self, pPath):
+        self.path = pPath
+        self.byteLength = os.path.getsize(pPath)
+
+    def __len__(self):
+        return self.byteLength
+
+# Sections are streamed to file in slices of memoryview without being merged to one copy.
+_writeChunkSize = 1 << 24
+def WriteBuffers(pOut, pBuffers):
+    for lBuffer in pBuffers:
+        if isinstance(lBuffer, FileSection):
+            lFile = open(lBuffer.path, 'rb')
+            shutil.copyfileobj(lFile, pOut, _writeChunkSize)
+            lFile.close()
+            continue
+        lView = memoryview(lBuffer)
+        for i in range(0, len(lView), _writeChunkSize):
+            pOut.write(lView[i:i + _writeChunkSize])
+        lView.release()
+
+def WriteGLB(pOutputFile, pOutput, pBuffers):
+    lJSONData = json.dumps(pOutput, sort_keys = True, separators=(',', ':')).encode('utf-8')
+    # JSON chunk is padded with spaces
+    lJSONData += b' ' * GetPadding(len(lJSONData))
+
+    lBinLength = GetBuffersByteLength(pBuffers)
+    lBinPadding = GetPadding(lBinLength)
+
+    lLength = 12 + 8 + len(lJSONData) + 8 + lBinLength + lBinPadding
+
+    out = open(pOutputFile, 'wb')
+    out.write(struct.pack('<III', GLB_MAGIC, GLB_VERSION, lLength))
+    out.write(struct.pack('<II', len(lJSONData), GLB_CHUNK_JSON))
+    out.write(lJSONData)
+    out.write(struct.pack('<II', lBinLength + lBinPadding, GLB_CHUNK_BIN))
+    WriteBuffers(out, pBuffers)
+    out.write(b'\0' * lBinPadding)
+    out.close()
+
+# JSON and BIN chunk data of a GLB file written by WriteGLB
+def ReadGLB(pFile):
+    f = open(pFile, 'rb')
+    lMagic, lVersion, lLength = struct.unpack('<III', f.read(12))
+    lOutput = None
+    lBinData = b''
+    while f.tell() < lLength:
+        lChunkLength, lChunkType = struct.unpack('<II', f.read(8))
+        lChunkData = f.read(lChunkLength)
+        if lChunkType == GLB_CHUNK_JSON:
+            lOutput = json.loads(lChunkData.decode('utf-8'))
+        elif lChunkType == GLB_CHUNK_BIN:
+            lBinData = lChunkData
+    f.close()
+    return lOutput, lBinData
+
+def WriteJSON(pOutputFile, pOutput):
+    out = open(pOutputFile, 'w')
+    out.write(json.dumps(pOutput, indent = 2, sort_keys = True, separators=(',', ': ')))
+    out.close()
+
+# Files are copied, not hard linked. Outputs are written in place, which would change
+# the cache entry sharing the inode. Target is removed first in case it is still a link.
+def CopyFile(pSource, pTarget):
+    if os.path.exists(pTarget):
+        os.remove(pTarget)
+    shutil.copyfile(pSource, pTarget)
+
+# Uris of the buffers and images written beside the output are renamed with the output file
+def RenameOutputUris(pOutput, pOldBasename, pBasename):
+    for lLib in [pOutput.get('buffers', []), pOutput.get('images', [])]:
+        for lItem in lLib:
+            if 'uri' in lItem and lItem['uri'].startswith(pOldBasename):
+                lItem['uri'] = pBasename + lItem['uri'][len(pOldBasename):]
+            # Mip levels of processed textures
+            lMipmaps = lItem.get('extras', {}).get('mipmaps', [])
+            for i in range(len(lMipmaps)):
+                if lMipmaps[i].startswith(pOldBasename):
+                    lMipmaps[i] = pBasename + lMipmaps[i][len(pOldBasename):]
+
+# Converted files are cached by the hash of fbx file and conversion options.
+# Each entry is a directory with a manifest and the output files, least recently
+# used entries are evicted when total size exceeds maxSize.
+# Texture files read in the conversion are only known after the scene is loaded. They
+# are listed in a file under the key of fbx and options, and the path, size and modified
+# time of each one are hashed into the key of the entry.
+class ConversionCache(object):
+
+    def __init__(self, cacheDir, maxSize = 0):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if not os.path.exists(cacheDir):
+            os.makedirs(cacheDir)
+
+    def GetKey(self, pFilePath, pOptions):
+        lHash = hashlib.sha1()
+        # Converter itself is part of the key, entries are invalid after it is modified.
+        for lConverterFile in _converterFiles:
+            with open(lConverterFile, 'rb') as f:
+                lHash.update(f.read())
+        lHash.update(json.dumps(pOptions, sort_keys = True).encode('utf-8'))
+        lFile = open(pFilePath, 'rb')
+        while True:
+            lChunk = lFile.read(1 << 20)
+            if not lChunk:
+                break
+            lHash.update(lChunk)
+        lFile.close()
+        return lHash.hexdigest()
+
+    def GetEntryDir(self, pKey):
+        return os.path.join(self.cacheDir, pKey)
+
+    def GetTextureListFile(self, pKey):
+        return os.path.join(self.cacheDir, pKey + '.textures.json')
+
+    def GetTextureKey(self, pKey, pTextureFiles):
+        if len(pTextureFiles) == 0:
+            return pKey
+        lHash = hashlib.sha1(pKey.encode('utf-8'))
+        for lFile in sorted(pTextureFiles):
+            lHash.update(lFile.encode('utf-8'))
+            # Removed files are hashed with the path only
+            if os.path.isfile(lFile):
+                lStat = os.stat(lFile)
+                lHash.update(struct.pack('<qq', lStat.st_size, lStat.st_mtime_ns))
+        return lHash.hexdigest()
+
+    def Fetch(self, pKey, pOutputFile):
+        lTextureListFile = self.GetTextureListFile(pKey)
+        if os.path.exists(lTextureListFile):
+            pKey = self.GetTextureKey(pKey, json.load(open(lTextureListFile)))
+        lEntryDir = self.GetEntryDir(pKey)
+        lManifestFile = os.path.join(lEntryDir, 'manifest.json')
+        if not os.path.exists(lManifestFile):
+            self.misses += 1
+            return False
+
+        lManifest = json.load(open(lManifestFile))
+        lOldBasename = lManifest['basename']
+        lOutputDir = os.path.dirname(pOutputFile)
+        lBasename = os.path.splitext(os.path.basename(pOutputFile))[0]
+        for lFileName in lManifest['files']:
+            lSource = os.path.join(lEntryDir, lFileName)
+            if lFileName == lManifest['output']:
+                lTarget = pOutputFile
+            else:
+                lTarget = os.path.join(lOutputDir, lBasename + lFileName[len(lOldBasename):])
+
+            if lFileName.endswith('.gltf'):
+                lOutput = json.load(open(lSource))
+                RenameOutputUris(lOutput, lOldBasename, lBasename)
+                WriteJSON(lTarget, lOutput)
+            elif lFileName.endswith('.glb'):
+                # Clip buffers and textures are external files, the JSON chunk is rewritten
+                # with its length and padding
+                lOutput, lBinData = ReadGLB(lSource)
+                RenameOutputUris(lOutput, lOldBasename, lBasename)
+                WriteGLB(lTarget, lOutput, [lBinData])
+            else:
+                CopyFile(lSource, lTarget)
 
-def GetNodeIdx(pNode):
-    return _nodeIdxMap[pNode.GetUniqueID()]
+        # Modified time is used as the last access time
+        os.utime(lEntryDir, None)
+        self.hits += 1
+        return True
+
+    def Store(self, pKey, pOutputFile, pFiles, pTextureFiles = []):
+        lTextureListKey = None
+        if len(pTextureFiles) > 0:
+            lTextureListKey = pKey
+            pKey = self.GetTextureKey(pKey, pTextureFiles)
+        lEntryDir = self.GetEntryDir(pKey)
+        if not os.path.exists(lEntryDir):
+            self.StoreEntry(lEntryDir, pOutputFile, pFiles, lTextureListKey)
+        if not lTextureListKey == None:
+            # Written after the entry so it is not evicted as unused, and replaced at once
+            # because other workers may read it
+            lTextureListFile = self.GetTextureListFile(lTextureListKey)
+            lTmpFile = lTextureListFile + '.tmp%d' % os.getpid()
+            WriteJSON(lTmpFile, sorted(pTextureFiles))
+            os.replace(lTmpFile, lTextureListFile)
+
+        self.Evict()
+
+    def StoreEntry(self, pEntryDir, pOutputFile, pFiles, pTextureListKey):
+        # Write to a temporary directory first, other workers may store the same entry.
+        lTmpDir = pEntryDir + '.tmp%d' % os.getpid()
+        if os.path.exists(lTmpDir):
+            shutil.rmtree(lTmpDir)
+        os.makedirs(lTmpDir)
+        for lFile in pFiles:
+            CopyFile(lFile, os.path.join(lTmpDir, os.path.basename(lFile)))
+        lManifest = {
+            'basename' : os.path.splitext(os.path.basename(pOutputFile))[0],
+            'output' : os.path.basename(pOutputFile),
+            'files' : [os.path.basename(lFile) for lFile in pFiles],
+            'textureList' : pTextureListKey
+        }
+        WriteJSON(os.path.join(lTmpDir, 'manifest.json'), lManifest)
+        try:
+            os.rename(lTmpDir, pEntryDir)
+        except OSError:
+            shutil.rmtree(lTmpDir)
+
+    def Evict(self):
+        if self.maxSize <= 0:
+            return
+        lEntries = []
+        lTotalSize = 0
+        for lKey in os.listdir(self.cacheDir):
+            lEntryDir = self.GetEntryDir(lKey)
+            lManifestFile = os.path.join(lEntryDir, 'manifest.json')
+            if not os.path.exists(lManifestFile):
+                continue
+            lSize = 0
+            for lFileName in os.listdir(lEntryDir):
+                lSize += os.path.getsize(os.path.join(lEntryDir, lFileName))
+            with open(lManifestFile) as f:
+                lTextureListKey = json.load(f).get('textureList')
+            lEntries.append((os.path.getmtime(lEntryDir), lSize, lEntryDir, lTextureListKey))
+            lTotalSize += lSize
+
+        lEntries.sort()
+        lTextureListKeys = set()
+        for lTime, lSize, lEntryDir, lTextureListKey in lEntries:
+            if lTotalSize <= self.maxSize:
+                lTextureListKeys.add(lTextureListKey)
+                continue
+            shutil.rmtree(lEntryDir, True)
+            lTotalSize -= lSize
+            self.evictions += 1
+
+        # Texture lists are removed with the last entry using them
+        for lFileName in os.listdir(self.cacheDir):
+            if lFileName.endswith('.textures.json') and not lFileName[:-len('.textures.json')] in lTextureListKeys:
+                try:
+                    os.remove(os.path.join(self.cacheDir, lFileName))
+                except OSError:
+                    # Removed by another worker
+                    pass
+
+    def GetStatistics(self):
+        lLookups = self.hits + self.misses
+        return {
+            'hits' : self.hits,
+            'misses' : self.misses,
+            'evictions' : self.evictions,
+            'hitRate' : self.hits / lLookups if lLookups > 0 else 0
+        }
 
 # FIXME
 # http://help.autodesk.com/view/FBX/2017/ENU/?guid=__cpp_ref_fbxtime_8h_html
@@ -1002,12 +2788,85 @@ def Convert(
     animFrameRate = 1 / 20,
     startTime = 0,
     duration = 1000,
-    poseTime = TIME_INFINITY):
+    poseTime = TIME_INFINITY,
+    useNumpy = True,
+    weldEpsilon = 0,
+    binary = False,
+    vertexCacheSize = 0,
+    quantize = False,
+    animTolerance = None,
+    cubicSpline = False,
+    keySampling = False,
+    splitClips = False,
+    animJobs = 1,
+    maxInfluences = 4,
+    textureMaxSize = 0,
+    textureFormat = '',
+    textureMips = False,
+    textureJobs = 0,
+    imageHash = False,
+    embedTextures = False,
+    atlasSize = 0,
+    atlasTextureSize = 256,
+    mergePrimitives = False,
+    sdkManager = None,
+    cache = None):
+
+    if not cache == None:
+        lCacheKey = cache.GetKey(filePath, {
+            'excluded' : sorted(excluded),
+            'animFrameRate' : animFrameRate,
+            'startTime' : startTime,
+            'duration' : duration,
+            'poseTime' : poseTime.GetSecondDouble(),
+            'weldEpsilon' : weldEpsilon,
+            'binary' : binary,
+            'vertexCacheSize' : vertexCacheSize,
+            'quantize' : quantize,
+            'animTolerance' : animTolerance,
+            'cubicSpline' : cubicSpline,
+            'keySampling' : keySampling,
+            'splitClips' : splitClips,
+            'maxInfluences' : maxInfluences,
+            'textureMaxSize' : textureMaxSize,
+            'textureFormat' : textureFormat,
+            'textureMips' : textureMips,
+            'imageHash' : imageHash,
+            'embedTextures' : embedTextures,
+            'atlasSize' : atlasSize,
+            'atlasTextureSize' : atlasTextureSize,
+            'mergePrimitives' : mergePrimitives
+        })
+        # Skip loading the scene if converted before.
+        if cache.Fetch(lCacheKey, ouptutFile):
+            return True
+
+    lBuilder = GltfBuilder(useNumpy, weldEpsilon, vertexCacheSize, quantize, animTolerance, cubicSpline, splitClips, animJobs, maxInfluences, imageHash, mergePrimitives, keySampling)
+    lBuilder.filePath = filePath
+    if vertexCacheSize > 0 and not lBuilder.useNumpy:
+        print('Vertex cache optimization needs numpy, skipped.')
+    if quantize and not lBuilder.useNumpy:
+        print('Quantization needs numpy, skipped.')
+    if not animTolerance == None and not lBuilder.useNumpy:
+        print('Keyframe reduction needs numpy, skipped.')
+    lProcessTextures = textureMaxSize > 0 or textureFormat or textureMips
+    if lProcessTextures and Image == None:
+        print('Texture processing needs Pillow, skipped.')
+        lProcessTextures = False
+    lAtlas = atlasSize > 0
+    if lAtlas and Image == None:
+        print('Texture atlas needs Pillow, skipped.')
+        lAtlas = False
 
     ignoreScene = 'scene' in excluded
     ignoreAnimation = 'animation' in excluded
     # Prepare the FBX SDK.
-    lSdkManager, lScene = InitializeSdkObjects()
+    if sdkManager == None:
+        lSdkManager, lScene = InitializeSdkObjects()
+    else:
+        # Reuse the sdk manager in batch conversion
+        lSdkManager = sdkManager
+        lScene = FbxScene.Create(lSdkManager, '')
     fbxConverter = FbxGeometryConverter(lSdkManager)
     # Load the scene.
     lResult = LoadScene(lSdkManager, lScene, filePath)
@@ -1017,64 +2876,718 @@ def Convert(
     else:
         lBasename, lExt = os.path.splitext(ouptutFile)
 
-        ListNodes(lScene.GetRootNode(), fbxConverter)
+        lSceneIdx = None
+        ListNodes(lBuilder, lScene.GetRootNode(), fbxConverter)
         if not ignoreScene:
-            lSceneIdx = ConvertScene(lScene, poseTime, fbxConverter)
+            if lAtlas:
+                PlanTextureAtlases(lBuilder, lScene, os.path.dirname(filePath), atlasSize, atlasTextureSize)
+            lSceneIdx = ConvertScene(lBuilder, lScene, poseTime, fbxConverter)
+            CreateSkinBindMatrices(lBuilder)
+            lBuilder.CreateDequantizedMeshNodes()
         if not ignoreAnimation:
-            ConvertAnimation(lScene, animFrameRate, startTime, duration)
+            ConvertAnimation(lBuilder, lScene, animFrameRate, startTime, duration)
 
-        #Merge binary data and write to a binary file
-        lBin = bytearray()
-        lBin.extend(attributeBuffer)
-        lBin.extend(invBindMatricesBuffer)
-        lBin.extend(animationBuffer)
-        lBin.extend(indicesBuffer)
+        lTriangleCount, lMissesBefore, lMissesAfter = lBuilder.vertexCacheStats
+        if lTriangleCount > 0:
+            print('ACMR of %d triangles: %.3f before, %.3f after vertex cache optimization' % (
+                lTriangleCount, lMissesBefore / lTriangleCount, lMissesAfter / lTriangleCount
+            ))
 
-        out = open(lBasename + ".bin", 'wb')
-        out.write(lBin)
-        out.close()
+        for path in _samplerChannels:
+            if path in lBuilder.animReductionStats:
+                lBefore, lAfter, lMaxError = lBuilder.animReductionStats[path]
+                print('Keyframes of %s: %d -> %d, max error %g%s' % (
+                    path, lBefore, lAfter, lMaxError, ' degrees' if path == 'rotation' else ''
+                ))
+        if cubicSpline:
+            print('Cubic spline: %d channels exported from keys, %d channels sampled' % tuple(lBuilder.cubicSplineStats))
+        if len(lBuilder.animReductionStats) > 0:
+            lBytesBefore, lBytesAfter = lBuilder.animReductionBytes
+            print('Keyframe reduction saved %d of %d bytes' % (lBytesBefore - lBytesAfter, lBytesBefore))
+
+        lBuffers = lBuilder.GetBuffers()
+        lOutputFiles = [ouptutFile]
+
+        # Atlases and processed textures written beside the output file
+        lTextureFiles = WriteTextureAtlases(lBuilder, ouptutFile)
+        lSearchDirs = [os.path.dirname(filePath), os.path.dirname(ouptutFile)]
+
+        if lProcessTextures:
+            lTextureFiles += ProcessTextures(lBuilder, lSearchDirs, ouptutFile, textureMaxSize, textureFormat, textureMips, textureJobs)
+
+        lBuilder.CreateBufferViews(0)
+
+        if embedTextures:
+            # Written textures are looked up first
+            if len(lTextureFiles) > 0:
+                lSearchDirs.reverse()
+            lBuffers += EmbedTextures(lBuilder, 0, GetBuffersByteLength(lBuffers), lSearchDirs)
+
+        # Textures replaced by processed or embedded ones are removed after the buffer is written
+        lUnusedFiles = GetUnusedTextureFiles(lBuilder, lTextureFiles)
+        lOutputFiles += [lFile for lFile in lTextureFiles if not lFile in lUnusedFiles]
+
+        lByteLength = GetBuffersByteLength(lBuffers)
+        if binary:
+            # Buffer of GLB BIN chunk has no uri
+            lBuilder.lib_buffers.append({'byteLength' : lByteLength})
+        else:
+            lBufferName = lBasename + '.bin'
+            out = open(lBufferName, 'wb')
+            WriteBuffers(out, lBuffers)
+            out.close()
+            lOutputFiles.append(lBufferName)
+
+            lBuilder.lib_buffers.append({'byteLength' : lByteLength, 'uri' : os.path.basename(lBufferName)})
+
+        # Clip buffers are always external files, which can be fetched when the clip is played
+        for i in range(len(lBuilder.clipBuffers)):
+            lClipName, lClipBuffer, lClipAccessors = lBuilder.clipBuffers[i]
+            if len(lClipAccessors) == 0:
+                continue
+            lClipBufferName = '%s_animation%d.bin' % (lBasename, i)
+            out = open(lClipBufferName, 'wb')
+            WriteBuffers(out, [lClipBuffer])
+            out.close()
+            lOutputFiles.append(lClipBufferName)
+
+            lClipBufferIdx = len(lBuilder.lib_buffers)
+            lBuilder.lib_buffers.append({'byteLength' : len(lClipBuffer), 'uri' : os.path.basename(lClipBufferName), 'name' : lClipName})
+            lBuilder.CreateBufferView(lClipBufferIdx, len(lClipBuffer), lClipAccessors, 0)
 
-        lBufferName = lBasename + '.bin'
-        lib_buffers.append({'byteLength' : len(lBin), 'uri' : os.path.basename(lBufferName)})
+        #Output json
+        lOutput = lBuilder.ToJSON(lSceneIdx)
 
-        CreateBufferViews(0)
+        if binary:
+            WriteGLB(ouptutFile, lOutput, lBuffers)
+        else:
+            WriteJSON(ouptutFile, lOutput)
+
+        for lFile in lUnusedFiles:
+            os.remove(lFile)
+
+        if not cache == None:
+            # Textures written beside the output may be found in the search dirs, they are not sources
+            lWrittenFiles = set([os.path.realpath(lFile) for lFile in lTextureFiles])
+            cache.Store(lCacheKey, ouptutFile, lOutputFiles, [lFile for lFile in lBuilder.textureFiles if not lFile in lWrittenFiles])
+
+    if not sdkManager == None:
+        lScene.Destroy()
+
+    return lResult
+
+# Pillow format and extension of output formats
+_textureFormatMap = {
+    'png' : ('PNG', '.png'),
+    'jpeg' : ('JPEG', '.jpg'),
+    'webp' : ('WEBP', '.webp')
+}
+
+# Fbx keeps the path on the artist's machine, also look for the image beside the fbx file
+def FindTextureFile(pUri, pFbxDir):
+    for lPath in [pUri, os.path.join(pFbxDir, pUri), os.path.join(pFbxDir, os.path.basename(pUri))]:
+        if os.path.isfile(lPath):
+            return os.path.realpath(lPath)
+    return None
+
+def FindTextureFileInDirs(pUri, pDirs):
+    for lDir in pDirs:
+        lFile = FindTextureFile(pUri, lDir)
+        if not lFile == None:
+            return lFile
+    return None
+
+# Written textures which are not referenced by any image
+def GetUnusedTextureFiles(pBuilder, pFiles):
+    lUris = set()
+    for lImage in pBuilder.lib_images:
+        if 'uri' in lImage:
+            lUris.add(lImage['uri'])
+        lUris.update(lImage.get('extras', {}).get('mipmaps', []))
+    return [lFile for lFile in pFiles if not os.path.basename(lFile) in lUris]
+
+# Relative and absolute paths of the same file have the same key
+def NormalizeImagePath(pPath, pFbxDir):
+    # Paths written on Windows
+    if not os.sep == '\\':
+        pPath = pPath.replace('\\', '/')
+    return os.path.normcase(os.path.abspath(os.path.join(pFbxDir, pPath)))
+
+# Sha1 of content of the image file, None if it is not found
+def HashImageFile(pFile):
+    if pFile == None:
+        return None
+    lHash = hashlib.sha1()
+    with open(pFile, 'rb') as f:
+        while True:
+            lChunk = f.read(1 << 20)
+            if not lChunk:
+                break
+            lHash.update(lChunk)
+    return lHash.digest()
+
+def FloorPowerOfTwo(pValue):
+    return 1 << (max(int(pValue), 1).bit_length() - 1)
+
+# Downscale and re-encode the image. Mip levels are written to '_mip%d' files, mips need power of two sizes.
+# Returns the paths of all levels.
+def ProcessTexture(pSourceFile, pTargetFile, pMaxSize, pFormat, pMips):
+    lImage = Image.open(pSourceFile)
+    lImage.load()
+    lHasAlpha = 'A' in lImage.getbands() or 'transparency' in lImage.info
+    if pFormat == 'JPEG':
+        lImage = lImage.convert('RGB')
+    elif not lImage.mode in ('RGB', 'RGBA', 'L', 'LA'):
+        lImage = lImage.convert('RGBA' if lHasAlpha else 'RGB')
+
+    lWidth, lHeight = lImage.size
+    if pMaxSize > 0 and max(lWidth, lHeight) > pMaxSize:
+        lScale = pMaxSize / max(lWidth, lHeight)
+        lWidth = max(int(round(lWidth * lScale)), 1)
+        lHeight = max(int(round(lHeight * lScale)), 1)
+    if pMips:
+        lWidth = FloorPowerOfTwo(lWidth)
+        lHeight = FloorPowerOfTwo(lHeight)
+    if not (lWidth, lHeight) == lImage.size:
+        lImage = lImage.resize((lWidth, lHeight), Image.LANCZOS)
+    lImage.save(pTargetFile, pFormat)
+
+    lFiles = [pTargetFile]
+    if pMips:
+        lBasename, lExt = os.path.splitext(pTargetFile)
+        while lWidth > 1 or lHeight > 1:
+            lWidth = max(lWidth // 2, 1)
+            lHeight = max(lHeight // 2, 1)
+            # Each level is filtered from the previous one
+            lImage = lImage.resize((lWidth, lHeight), Image.BOX)
+            lMipFile = '%s_mip%d%s' % (lBasename, len(lFiles), lExt)
+            lImage.save(lMipFile, pFormat)
+            lFiles.append(lMipFile)
+    return lFiles
+
+# Each unique image file is processed once in a thread pool, uris of images are
+# replaced with the processed files beside the output file. Returns the written files.
+def ProcessTextures(pBuilder, pSearchDirs, pOutputFile, pMaxSize, pFormat, pMips, pJobs):
+    lOutputDir = os.path.dirname(pOutputFile)
+    lBasename = os.path.splitext(os.path.basename(pOutputFile))[0]
+
+    lNames = set()
+    lTasks = {}
+    lImageTasks = []
+    lExecutor = concurrent.futures.ThreadPoolExecutor(pJobs if pJobs > 0 else multiprocessing.cpu_count())
+    for lImage in pBuilder.lib_images:
+        lSourceFile = FindTextureFileInDirs(lImage['uri'], pSearchDirs)
+        if lSourceFile == None:
+            print('Texture ' + lImage['uri'] + ' not found.')
+            continue
+        pBuilder.AddTextureFile(lSourceFile)
+        if not lSourceFile in lTasks:
+            lStem, lExt = os.path.splitext(os.path.basename(lSourceFile))
+            lExt = lExt.lower()
+            if pFormat:
+                lFormat, lExt = _textureFormatMap[pFormat]
+            elif lExt in ('.jpg', '.jpeg'):
+                lFormat = 'JPEG'
+            elif lExt == '.webp':
+                lFormat = 'WEBP'
+            else:
+                # Formats not supported in browsers, such as tga and psd
+                lFormat, lExt = _textureFormatMap['png']
+            lName = '%s_%s' % (lBasename, lStem)
+            while lName + lExt in lNames:
+                lName += '_'
+            lNames.add(lName + lExt)
+            lTargetFile = os.path.join(lOutputDir, lName + lExt)
+            lTasks[lSourceFile] = lExecutor.submit(ProcessTexture, lSourceFile, lTargetFile, pMaxSize, lFormat, pMips)
+        lImageTasks.append((lImage, lSourceFile, lTasks[lSourceFile]))
+
+    lOutputFiles = []
+    lFailed = set()
+    for lImage, lSourceFile, lTask in lImageTasks:
+        try:
+            lFiles = lTask.result()
+        except Exception as e:
+            if not lSourceFile in lFailed:
+                print('Failed to process texture %s: %s' % (lSourceFile, e))
+                lFailed.add(lSourceFile)
+            continue
+        lImage['uri'] = os.path.basename(lFiles[0])
+        if len(lFiles) > 1:
+            lImage['extras'] = {'mipmaps' : [os.path.basename(lFile) for lFile in lFiles[1:]]}
+        for lFile in lFiles:
+            if not lFile in lOutputFiles:
+                lOutputFiles.append(lFile)
+    lExecutor.shutdown()
+    return lOutputFiles
+
+# Free space is kept as maximal rectangles, each rectangle is placed
+# in the free rectangle with the best short side fit.
+class RectanglePacker(object):
+
+    def __init__(self, pWidth, pHeight):
+        self.width = pWidth
+        self.height = pHeight
+        # (x, y, width, height)
+        self.freeRects = [(0, 0, pWidth, pHeight)]
+
+    # Returns position of the rectangle, None if it doesn't fit
+    def Insert(self, pWidth, pHeight):
+        lBest = None
+        for x, y, w, h in self.freeRects:
+            if w >= pWidth and h >= pHeight:
+                lFit = (min(w - pWidth, h - pHeight), max(w - pWidth, h - pHeight))
+                if lBest == None or lFit < lBest[0]:
+                    lBest = (lFit, x, y)
+        if lBest == None:
+            return None
+        lRect = (lBest[1], lBest[2], pWidth, pHeight)
+
+        lFreeRects = []
+        for lFreeRect in self.freeRects:
+            lFreeRects += SplitFreeRect(lFreeRect, lRect)
+        # Rectangles inside another one are not maximal
+        self.freeRects = []
+        for i in range(len(lFreeRects)):
+            lContained = False
+            for j in range(len(lFreeRects)):
+                if not i == j and RectContains(lFreeRects[j], lFreeRects[i]) and (not lFreeRects[i] == lFreeRects[j] or j < i):
+                    lContained = True
+                    break
+            if not lContained:
+                self.freeRects.append(lFreeRects[i])
+        return lRect[0], lRect[1]
+
+def RectContains(pA, pB):
+    return pA[0] <= pB[0] and pA[1] <= pB[1] and pA[0] + pA[2] >= pB[0] + pB[2] and pA[1] + pA[3] >= pB[1] + pB[3]
+
+# Free space left in pFree after pUsed is placed
+def SplitFreeRect(pFree, pUsed):
+    fx, fy, fw, fh = pFree
+    ux, uy, uw, uh = pUsed
+    if ux >= fx + fw or ux + uw <= fx or uy >= fy + fh or uy + uh <= fy:
+        return [pFree]
+    lRects = []
+    if ux > fx:
+        lRects.append((fx, fy, ux - fx, fh))
+    if ux + uw < fx + fw:
+        lRects.append((ux + uw, fy, fx + fw - ux - uw, fh))
+    if uy > fy:
+        lRects.append((fx, fy, fw, uy - fy))
+    if uy + uh < fy + fh:
+        lRects.append((fx, uy + uh, fw, fy + fh - uy - uh))
+    return lRects
+
+# Pixels around each texture in atlas, copied from its edges
+_atlasGutter = 2
+
+def CeilPowerOfTwo(pValue):
+    return 1 << (max(int(pValue), 1) - 1).bit_length()
+
+def ListSceneMaterials(pNode, pMaterials):
+    if not pNode.GetGeometry() == None:
+        for i in range(pNode.GetMaterialCount()):
+            lMaterial = pNode.GetMaterial(i)
+            pMaterials[lMaterial.GetUniqueID()] = lMaterial
+    for i in range(pNode.GetChildCount()):
+        ListSceneMaterials(pNode.GetChild(i), pMaterials)
+
+# Diffuse maps not larger than pTextureSize are packed to atlas pages of pAtlasSize.
+# Only materials with one diffuse map and no other maps are packed, uvs of their
+# meshes are remapped in ConvertMesh.
+def PlanTextureAtlases(pBuilder, pScene, pFbxDir, pAtlasSize, pTextureSize):
+    lMaterials = collections.OrderedDict()
+    ListSceneMaterials(pScene.GetRootNode(), lMaterials)
+
+    lImageSizes = {}
+    lMaterialFiles = collections.OrderedDict()
+    for lMaterialId, lMaterial in lMaterials.items():
+        if lMaterial.Bump.GetSrcObjectCount() > 0 or lMaterial.NormalMap.GetSrcObjectCount() > 0:
+            continue
+        if lMaterial.Diffuse.GetSrcObjectCount(FbxCriteria.ObjectType(FbxLayeredTexture.ClassId)) > 0:
+            continue
+        lTextures = GetFileTextures(lMaterial.Diffuse)
+        if not len(lTextures) == 1:
+            continue
+        lFile = FindTextureFile(lTextures[0].GetFileName(), pFbxDir)
+        if lFile == None:
+            continue
+        pBuilder.AddTextureFile(lFile)
+        if not lFile in lImageSizes:
+            try:
+                # Only header is read
+                lImageSizes[lFile] = Image.open(lFile).size
+            except IOError:
+                lImageSizes[lFile] = None
+        lSize = lImageSizes[lFile]
+        if lSize == None or max(lSize) > pTextureSize or max(lSize) + _atlasGutter * 2 > pAtlasSize:
+            continue
+        lMaterialFiles[lMaterialId] = lFile
+
+    # Larger ones first
+    lFiles = sorted(set(lMaterialFiles.values()), key = lambda lFile: (-max(lImageSizes[lFile]), -lImageSizes[lFile][0] * lImageSizes[lFile][1], lFile))
+    lPackers = []
+    lPageFiles = []
+    lFilePlaces = {}
+    for lFile in lFiles:
+        lWidth, lHeight = lImageSizes[lFile]
+        lWidth += _atlasGutter * 2
+        lHeight += _atlasGutter * 2
+        lPosition = None
+        for lPageIdx in range(len(lPackers)):
+            lPosition = lPackers[lPageIdx].Insert(lWidth, lHeight)
+            if not lPosition == None:
+                break
+        if lPosition == None:
+            lPageIdx = len(lPackers)
+            lPackers.append(RectanglePacker(pAtlasSize, pAtlasSize))
+            lPageFiles.append([])
+            lPosition = lPackers[lPageIdx].Insert(lWidth, lHeight)
+        lPageFiles[lPageIdx].append(lFile)
+        lFilePlaces[lFile] = (lPageIdx, lPosition[0] + _atlasGutter, lPosition[1] + _atlasGutter)
+
+    lPageMap = {}
+    for lPageIdx in range(len(lPageFiles)):
+        # Nothing is saved with one texture
+        if len(lPageFiles[lPageIdx]) < 2:
+            continue
+        lRight = max([lFilePlaces[lFile][1] + lImageSizes[lFile][0] + _atlasGutter for lFile in lPageFiles[lPageIdx]])
+        lBottom = max([lFilePlaces[lFile][2] + lImageSizes[lFile][1] + _atlasGutter for lFile in lPageFiles[lPageIdx]])
+        lPageMap[lPageIdx] = len(pBuilder.atlasPages)
+        pBuilder.atlasPages.append({
+            # Power of two for mipmaps
+            'size' : (CeilPowerOfTwo(lRight), CeilPowerOfTwo(lBottom)),
+            'files' : [(lFile,) + lFilePlaces[lFile][1:] for lFile in lPageFiles[lPageIdx]],
+            'image' : None,
+            'texture' : None
+        })
 
-        #Output json
-        lOutput = {
-            'asset': {
-                'generator': 'qtek fbx2gltf',
-                'version': '2.0'
-            },
-            'extensionsUsed': ['KHR_materials_common'],
-            'accessors' : lib_accessors,
-            'bufferViews' : lib_buffer_views,
-            'buffers' : lib_buffers,
-            'nodes' : lib_nodes,
-            'scenes' : lib_scenes,
-            'meshes' : lib_meshes,
+    for lMaterialId, lFile in lMaterialFiles.items():
+        lPageIdx, x, y = lFilePlaces[lFile]
+        if not lPageIdx in lPageMap:
+            continue
+        lPageWidth, lPageHeight = pBuilder.atlasPages[lPageMap[lPageIdx]]['size']
+        lWidth, lHeight = lImageSizes[lFile]
+        pBuilder.atlasMaterials[lMaterialId] = (lPageMap[lPageIdx], (
+            x / lPageWidth, y / lPageHeight, lWidth / lPageWidth, lHeight / lPageHeight
+        ))
+
+# Edge pixels are stretched over the gutter, so filtering doesn't bleed the neighbours
+def PasteAtlasImage(pPage, pImage, x, y):
+    lWidth, lHeight = pImage.size
+    g = _atlasGutter
+    pPage.paste(pImage, (x, y))
+    pPage.paste(pImage.crop((0, 0, lWidth, 1)).resize((lWidth, g), Image.NEAREST), (x, y - g))
+    pPage.paste(pImage.crop((0, lHeight - 1, lWidth, lHeight)).resize((lWidth, g), Image.NEAREST), (x, y + lHeight))
+    # Columns include the corners
+    pPage.paste(pPage.crop((x, y - g, x + 1, y + lHeight + g)).resize((g, lHeight + g * 2), Image.NEAREST), (x - g, y - g))
+    pPage.paste(pPage.crop((x + lWidth - 1, y - g, x + lWidth, y + lHeight + g)).resize((g, lHeight + g * 2), Image.NEAREST), (x + lWidth, y - g))
+
+# Pages used by the meshes are written to png files beside the output file.
+# Returns the written files.
+def WriteTextureAtlases(pBuilder, pOutputFile):
+    lBasename = os.path.splitext(pOutputFile)[0]
+    lOutputFiles = []
+    for lPageIdx in range(len(pBuilder.atlasPages)):
+        lPage = pBuilder.atlasPages[lPageIdx]
+        if lPage['image'] == None:
+            continue
+        lImages = []
+        for lFile, x, y in lPage['files']:
+            lImage = Image.open(lFile)
+            lImage.load()
+            lImages.append((lImage, x, y))
+        lHasAlpha = any(['A' in lImage.getbands() or 'transparency' in lImage.info for lImage, x, y in lImages])
+        lMode = 'RGBA' if lHasAlpha else 'RGB'
+        lPageImage = Image.new(lMode, lPage['size'])
+        for lImage, x, y in lImages:
+            PasteAtlasImage(lPageImage, lImage.convert(lMode), x, y)
+
+        lPageFile = '%s_atlas%d.png' % (lBasename, len(lOutputFiles))
+        lPageImage.save(lPageFile, 'PNG')
+        pBuilder.lib_images[lPage['image']]['uri'] = os.path.basename(lPageFile)
+        lOutputFiles.append(lPageFile)
+    return lOutputFiles
+
+# Mime types of images which can be embedded
+_imageMimeTypeMap = {
+    '.png' : 'image/png',
+    '.jpg' : 'image/jpeg',
+    '.jpeg' : 'image/jpeg',
+    '.webp' : 'image/webp'
+}
+
+# Images are appended to the buffer from pByteOffset, each in a buffer view aligned
+# to 4 bytes. Files are not read until the buffer is written.
+# Returns the buffer sections.
+def EmbedTextures(pBuilder, pBufferIdx, pByteOffset, pSearchDirs):
+    lSections = []
+    lPadding = GetPadding(pByteOffset)
+    if lPadding > 0:
+        lSections.append(b'\0' * lPadding)
+        pByteOffset += lPadding
+
+    lFileBufferViews = {}
+    for lImage in pBuilder.lib_images:
+        lFile = FindTextureFileInDirs(lImage['uri'], pSearchDirs)
+        if lFile == None:
+            print('Texture ' + lImage['uri'] + ' not found, not embedded.')
+            continue
+        pBuilder.AddTextureFile(lFile)
+        lExt = os.path.splitext(lFile)[1].lower()
+        if not lExt in _imageMimeTypeMap:
+            print('Texture ' + lImage['uri'] + ' is not png, jpeg or webp, not embedded.')
+            continue
+
+        if not lFile in lFileBufferViews:
+            lSection = FileSection(lFile)
+            lFileBufferViews[lFile] = len(pBuilder.lib_buffer_views)
+            pBuilder.CreateBufferView(pBufferIdx, len(lSection), [], pByteOffset, None)
+            lPadding = GetPadding(len(lSection))
+            lSections.append(lSection)
+            if lPadding > 0:
+                lSections.append(b'\0' * lPadding)
+            pByteOffset += len(lSection) + lPadding
+
+        del lImage['uri']
+        lImage['bufferView'] = lFileBufferViews[lFile]
+        lImage['mimeType'] = _imageMimeTypeMap[lExt]
+    return lSections
+
+def ListBatchFiles(pInput):
+    # Directory, all fbx files in it will be converted
+    if os.path.isdir(pInput):
+        lFiles = []
+        for lRoot, lDirs, lFileNames in os.walk(pInput):
+            lDirs.sort()
+            for lFileName in sorted(lFileNames):
+                if lFileName.lower().endswith('.fbx'):
+                    lFiles.append(os.path.join(lRoot, lFileName))
+        return lFiles, pInput
+    # Manifest, json array or text file with one path per line
+    elif os.path.isfile(pInput):
+        lManifestDir = os.path.dirname(pInput)
+        if pInput.lower().endswith('.json'):
+            lPaths = json.load(open(pInput))
+        else:
+            lPaths = [lLine.strip() for lLine in open(pInput)]
+            lPaths = [lPath for lPath in lPaths if lPath and not lPath.startswith('#')]
+        lFiles = [os.path.join(lManifestDir, lPath) for lPath in lPaths]
+        return lFiles, GetCommonDir(lFiles)
+    # Glob pattern
+    else:
+        lFiles = sorted(glob.glob(pInput, recursive = True))
+        return lFiles, GetCommonDir(lFiles)
+
+# Files with the same name in different directories are kept apart in the output dir
+def GetCommonDir(pFiles):
+    if len(pFiles) == 0:
+        return None
+    return os.path.commonpath([os.path.dirname(os.path.abspath(lFile)) for lFile in pFiles])
+
+def GetBatchOutputFile(pFilePath, pRootDir, pOutputDir, pBinary):
+    lExt = '.glb' if pBinary else '.gltf'
+    if not pOutputDir:
+        return os.path.splitext(pFilePath)[0] + lExt
+    # Keep the directory structure when converting a directory
+    if pRootDir:
+        lRelPath = os.path.relpath(os.path.abspath(pFilePath), os.path.abspath(pRootDir))
+    else:
+        lRelPath = os.path.basename(pFilePath)
+    return os.path.join(pOutputDir, os.path.splitext(lRelPath)[0] + lExt)
+
+def GetOutputByteLength(pOutputFile):
+    lByteLength = os.path.getsize(pOutputFile)
+    lBinFile = os.path.splitext(pOutputFile)[0] + '.bin'
+    if not pOutputFile.endswith('.glb') and os.path.exists(lBinFile):
+        lByteLength += os.path.getsize(lBinFile)
+    return lByteLength
+
+def BatchWorker(pConnection, pOptions):
+    # One sdk manager for all the files converted in this worker
+    lSdkManager, lScene = InitializeSdkObjects()
+    lScene.Destroy()
+
+    lCache = None
+    if pOptions['cacheDir']:
+        lCache = ConversionCache(pOptions['cacheDir'], pOptions['cacheSize'])
+
+    lPoseTime = TIME_INFINITY
+    if pOptions['pose'] >= 0:
+        lPoseTime = FbxTime()
+        lPoseTime.SetSecondDouble(pOptions['pose'])
+
+    while True:
+        lTask = pConnection.recv()
+        if lTask == None:
+            break
+        lTaskIdx, lFilePath, lOutputFile = lTask
+        lError = None
+        lCacheHits = lCache.hits if lCache else 0
+        try:
+            lOutputDir = os.path.dirname(lOutputFile)
+            if lOutputDir and not os.path.exists(lOutputDir):
+                os.makedirs(lOutputDir)
+            if not Convert(
+                lFilePath,
+                lOutputFile,
+                pOptions['excluded'],
+                pOptions['animFrameRate'],
+                pOptions['startTime'],
+                pOptions['duration'],
+                lPoseTime,
+                useNumpy = pOptions['useNumpy'],
+                weldEpsilon = pOptions['weldEpsilon'],
+                binary = pOptions['binary'],
+                vertexCacheSize = pOptions['vertexCacheSize'],
+                quantize = pOptions['quantize'],
+                animTolerance = pOptions['animTolerance'],
+                cubicSpline = pOptions['cubicSpline'],
+                keySampling = pOptions['keySampling'],
+                splitClips = pOptions['splitClips'],
+                maxInfluences = pOptions['maxInfluences'],
+                textureMaxSize = pOptions['textureMaxSize'],
+                textureFormat = pOptions['textureFormat'],
+                textureMips = pOptions['textureMips'],
+                textureJobs = pOptions['textureJobs'],
+                imageHash = pOptions['imageHash'],
+                embedTextures = pOptions['embedTextures'],
+                atlasSize = pOptions['atlasSize'],
+                atlasTextureSize = pOptions['atlasTextureSize'],
+                mergePrimitives = pOptions['mergePrimitives'],
+                sdkManager = lSdkManager,
+                cache = lCache
+            ):
+                lError = 'Failed to load scene'
+        except Exception:
+            lError = traceback.format_exc()
+        pConnection.send((lTaskIdx, lError, not lCache == None and lCache.hits > lCacheHits))
+
+    lSdkManager.Destroy()
+
+def StartBatchWorker(pOptions):
+    lConnection, lWorkerConnection = multiprocessing.Pipe()
+    lProcess = multiprocessing.Process(target = BatchWorker, args = (lWorkerConnection, pOptions))
+    lProcess.daemon = True
+    lProcess.start()
+    return {
+        'process' : lProcess,
+        'connection' : lConnection,
+        'task' : None,
+        'startTime' : 0
+    }
+
+def StopBatchWorker(pWorker, pForce = False):
+    if pForce:
+        pWorker['process'].terminate()
+    else:
+        pWorker['connection'].send(None)
+    pWorker['process'].join()
+    pWorker['connection'].close()
+
+def ConvertBatch(pFiles, pOutputFiles, pOptions, pJobs, pTimeout = 0, pReportFile = ''):
+    lTaskCount = len(pFiles)
+    lPending = [(i, pFiles[i], pOutputFiles[i]) for i in range(lTaskCount)]
+    lPending.reverse()
+    lResults = [None] * lTaskCount
+    lFinishedCount = 0
+
+    lBatchStartTime = time.time()
+    lWorkers = [StartBatchWorker(pOptions) for i in range(max(min(pJobs, lTaskCount), 1))]
+
+    def FinishTask(pWorker, pStatus, pError, pCacheHit = False):
+        lTaskIdx, lFilePath, lOutputFile = pWorker['task']
+        lResult = {
+            'file' : lFilePath,
+            'output' : lOutputFile,
+            'status' : pStatus,
+            'time' : time.time() - pWorker['startTime'],
+            'inputBytes' : os.path.getsize(lFilePath) if os.path.exists(lFilePath) else 0
         }
-        if len(lib_cameras) > 0:
-            lOutput['cameras'] = lib_cameras
-        if len(lib_skins) > 0:
-            lOutput['skins'] = lib_skins
-        if len(lib_materials) > 0:
-            lOutput['materials'] = lib_materials
-        if len(lib_images) > 0:
-            lOutput['images'] = lib_images
-        if len(lib_samplers) > 0:
-            lOutput['samplers'] = lib_samplers
-        if len(lib_textures) > 0:
-            lOutput['textures'] = lib_textures
-        if len(lib_animations) > 0:
-            lOutput['animations'] = lib_animations
-        #Default scene
-        if not ignoreScene:
-            lOutput['scene'] = lSceneIdx
+        if pStatus == 'succeeded':
+            lResult['outputBytes'] = GetOutputByteLength(lOutputFile)
+            lResult['cacheHit'] = pCacheHit
+        else:
+            lResult['error'] = pError
+            print('Failed to convert %s: %s' % (lFilePath, pStatus))
+        lResults[lTaskIdx] = lResult
+        pWorker['task'] = None
+
+    while lFinishedCount < lTaskCount:
+        for lWorker in lWorkers:
+            if lWorker['task'] == None and len(lPending) > 0:
+                lWorker['task'] = lPending.pop()
+                lWorker['startTime'] = time.time()
+                lWorker['connection'].send(lWorker['task'])
+
+        lBusyWorkers = [lWorker for lWorker in lWorkers if not lWorker['task'] == None]
+        lReadyConnections = wait([lWorker['connection'] for lWorker in lBusyWorkers], 0.5)
+        for lWorker in lBusyWorkers:
+            if lWorker['connection'] in lReadyConnections:
+                try:
+                    lTaskIdx, lError, lCacheHit = lWorker['connection'].recv()
+                except EOFError:
+                    # Handled as crashed below
+                    continue
+                FinishTask(lWorker, 'succeeded' if lError == None else 'failed', lError, lCacheHit)
+                lFinishedCount += 1
+
+        # Kill the workers which crashed or are timeout, and restart them
+        for i in range(len(lWorkers)):
+            lWorker = lWorkers[i]
+            if lWorker['task'] == None:
+                continue
+            if not lWorker['process'].is_alive():
+                lStatus = 'crashed'
+                lError = 'Worker exited with code %s' % lWorker['process'].exitcode
+            elif pTimeout > 0 and time.time() - lWorker['startTime'] > pTimeout:
+                lStatus = 'timeout'
+                lError = 'Not finished in %g seconds' % pTimeout
+            else:
+                continue
+            StopBatchWorker(lWorker, True)
+            FinishTask(lWorker, lStatus, lError)
+            lFinishedCount += 1
+            lWorkers[i] = StartBatchWorker(pOptions)
+
+    for lWorker in lWorkers:
+        StopBatchWorker(lWorker)
+
+    lElapsed = time.time() - lBatchStartTime
+    lFailures = [lResult for lResult in lResults if not lResult['status'] == 'succeeded']
+    lInputBytes = sum([lResult['inputBytes'] for lResult in lResults])
+    lOutputBytes = sum([lResult.get('outputBytes', 0) for lResult in lResults])
+    lSummary = {
+        'files' : lTaskCount,
+        'succeeded' : lTaskCount - len(lFailures),
+        'failed' : len(lFailures),
+        'jobs' : len(lWorkers),
+        'elapsed' : lElapsed,
+        'filesPerSecond' : lTaskCount / lElapsed if lElapsed > 0 else 0,
+        'inputBytes' : lInputBytes,
+        'outputBytes' : lOutputBytes,
+        'inputBytesPerSecond' : lInputBytes / lElapsed if lElapsed > 0 else 0,
+        'cacheHits' : len([lResult for lResult in lResults if lResult.get('cacheHit')]),
+        'failures' : [{
+            'file' : lResult['file'],
+            'status' : lResult['status'],
+            'error' : lResult['error']
+        } for lResult in lFailures],
+        'results' : lResults
+    }
+
+    print('Converted %d of %d files in %.2f seconds, %.2f files per second' % (
+        lSummary['succeeded'], lTaskCount, lElapsed, lSummary['filesPerSecond']
+    ))
+    for lFailure in lFailures:
+        print('  %s %s' % (lFailure['status'].upper(), lFailure['file']))
 
-        out = open(ouptutFile, 'w')
-        out.write(json.dumps(lOutput, indent = 2, sort_keys = True, separators=(',', ': ')))
+    if pReportFile:
+        out = open(pReportFile, 'w')
+        out.write(json.dumps(lSummary, indent = 2, sort_keys = True, separators=(',', ': ')))
         out.close()
 
+    return lSummary
+
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='FBX to glTF converter', add_help=True)
@@ -1083,6 +3596,32 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--output', default='', type=str, help="Ouput glTF file path")
     parser.add_argument('-f', '--framerate', default=20, type=float, help="Animation frame per sencond")
     parser.add_argument('-p', '--pose', default=-1, type=float, help="Static pose time")
+    parser.add_argument('--no-numpy', action='store_true', help="Pack buffers with struct even if numpy is installed")
+    parser.add_argument('-b', '--glb', action='store_true', help="Output binary glTF(.glb) with embedded buffer")
+    parser.add_argument('--batch', action='store_true', help="Convert all files of a directory, glob pattern or manifest file. Output is a directory")
+    parser.add_argument('-j', '--jobs', default=multiprocessing.cpu_count(), type=int, help="Number of worker processes in batch conversion")
+    parser.add_argument('--timeout', default=0, type=float, help="Timeout in seconds of each file in batch conversion, 0 for no timeout")
+    parser.add_argument('--report', default='', type=str, help="Write a json summary of batch conversion")
+    parser.add_argument('-r', '--reduce', default='', type=str, help="Reduce animation keyframes with error tolerances, in format 'translation,rotationDegrees,scale' such as '0.001,0.1,0.001'")
+    parser.add_argument('--cubic', action='store_true', help="Export translation and scale keys as CUBICSPLINE animation instead of sampling. QTEK plays the key values linearly without tangents")
+    parser.add_argument('--key-sampling', action='store_true', help="Sample nodes without pivots, pre/post rotation, limits and cyclic extrapolation from curve keys instead of the FBX evaluator, faster on long clips. Needs numpy")
+    parser.add_argument('--anim-jobs', default=1, type=int, help="Number of worker processes sampling animation, each loads the file again. Not used in batch conversion")
+    parser.add_argument('--split-clips', action='store_true', help="Write animation data of each clip to its own .bin file")
+    parser.add_argument('--max-influences', default=4, type=int, choices=[4, 8], help="Joints bound to one vertex, 8 joints are written to JOINTS_1 and WEIGHTS_1 for other runtimes, QTEK only reads 4")
+    parser.add_argument('--texture-max-size', default=0, type=int, help="Downscale textures larger than this size, needs Pillow. 0 for no limit")
+    parser.add_argument('--texture-format', default='', type=str, choices=['', 'png', 'jpeg', 'webp'], help="Re-encode textures to this format, needs Pillow")
+    parser.add_argument('--texture-mips', action='store_true', help="Resize textures to power of two and write mip levels, needs Pillow")
+    parser.add_argument('--image-hash', action='store_true', help="Merge images with identical content but different paths")
+    parser.add_argument('--embed-textures', action='store_true', help="Pack png, jpeg and webp images in the buffer instead of separate files")
+    parser.add_argument('--atlas-size', default=0, type=int, help="Pack small diffuse maps to texture atlases of this size, needs Pillow. 0 to disable")
+    parser.add_argument('--atlas-texture-size', default=256, type=int, help="Diffuse maps not larger than this size are packed to atlases")
+    parser.add_argument('--merge-primitives', action='store_true', help="Merge materials only differ in name, and primitives of a mesh with the same material")
+    parser.add_argument('--texture-jobs', default=0, type=int, help="Number of threads processing textures, 0 for the cpu count")
+    parser.add_argument('-q', '--quantize', action='store_true', help="Quantize vertex attributes with KHR_mesh_quantization")
+    parser.add_argument('--vertex-cache', default=0, type=int, help="Reorder triangles and vertices for a post transform vertex cache of this size, such as 16. 0 to disable")
+    parser.add_argument('--cache', default='', type=str, help="Directory of conversion cache, unchanged files are copied from it")
+    parser.add_argument('--cache-size', default=0, type=float, help="Max size of conversion cache in MB, 0 for unlimited")
+    parser.add_argument('-w', '--weld', default=0, type=float, help="Weld vertices closer than this epsilon, 0 to weld only identical vertices")
     parser.add_argument('file')
 
     args = parser.parse_args()
@@ -1096,14 +3635,102 @@ if __name__ == "__main__":
     if lTimeRange[1]:
         lDuration = float(lTimeRange[1])
 
+    excluded = args.exclude.split(',')
+
+    lAnimTolerance = None
+    if args.reduce:
+        try:
+            lAnimTolerance = [float(lTolerance) for lTolerance in args.reduce.split(',')]
+        except ValueError:
+            lAnimTolerance = []
+        if not len(lAnimTolerance) == 3 or min(lAnimTolerance) < 0:
+            parser.error("--reduce needs 3 non-negative tolerances 'translation,rotationDegrees,scale'")
+
+    if args.batch:
+        lFiles, lRootDir = ListBatchFiles(args.file)
+        lOutputFiles = [GetBatchOutputFile(lFilePath, lRootDir, args.output, args.glb) for lFilePath in lFiles]
+        # Workers writing the same output at the same time would corrupt it
+        lTargets = {}
+        for lFilePath, lOutputFile in zip(lFiles, lOutputFiles):
+            lTarget = os.path.normcase(os.path.abspath(lOutputFile))
+            if lTarget in lTargets:
+                parser.error("%s and %s are both converted to %s" % (lTargets[lTarget], lFilePath, lOutputFile))
+            lTargets[lTarget] = lFilePath
+        lSummary = ConvertBatch(lFiles, lOutputFiles, {
+            'excluded' : excluded,
+            'animFrameRate' : 1 / args.framerate,
+            'startTime' : lStartTime,
+            'duration' : lDuration,
+            'pose' : args.pose,
+            'useNumpy' : not args.no_numpy,
+            'weldEpsilon' : args.weld,
+            'binary' : args.glb,
+            'vertexCacheSize' : args.vertex_cache,
+            'quantize' : args.quantize,
+            'animTolerance' : lAnimTolerance,
+            'cubicSpline' : args.cubic,
+            'keySampling' : args.key_sampling,
+            'splitClips' : args.split_clips,
+            'maxInfluences' : args.max_influences,
+            'textureMaxSize' : args.texture_max_size,
+            'textureFormat' : args.texture_format,
+            'textureMips' : args.texture_mips,
+            # Files are already converted in parallel
+            'textureJobs' : 1,
+            'imageHash' : args.image_hash,
+            'embedTextures' : args.embed_textures,
+            'atlasSize' : args.atlas_size,
+            'atlasTextureSize' : args.atlas_texture_size,
+            'mergePrimitives' : args.merge_primitives,
+            'cacheDir' : args.cache,
+            'cacheSize' : args.cache_size * 1024 * 1024
+        }, args.jobs, args.timeout, args.report)
+        sys.exit(1 if lSummary['failed'] > 0 else 0)
+
     if not args.output:
         lBasename, lExt = os.path.splitext(args.file)
-        args.output = lBasename + '.gltf'
+        if args.glb:
+            args.output = lBasename + '.glb'
+        else:
+            args.output = lBasename + '.gltf'
 
     if (args.pose >= 0):
         lPoseTime = FbxTime()
         lPoseTime.SetSecondDouble(float(args.pose))
 
-    excluded = args.exclude.split(',')
-
-    Convert(args.file, args.output, excluded, 1 / args.framerate, lStartTime, lDuration, lPoseTime)
\ No newline at end of file
+    lCache = None
+    if args.cache:
+        lCache = ConversionCache(args.cache, args.cache_size * 1024 * 1024)
+
+    Convert(
+        args.file,
+        args.output,
+        excluded,
+        1 / args.framerate,
+        lStartTime,
+        lDuration,
+        lPoseTime,
+        useNumpy = not args.no_numpy,
+        weldEpsilon = args.weld,
+        binary = args.glb,
+        vertexCacheSize = args.vertex_cache,
+        quantize = args.quantize,
+        animTolerance = lAnimTolerance,
+        cubicSpline = args.cubic,
+        keySampling = args.key_sampling,
+        splitClips = args.split_clips,
+        maxInfluences = args.max_influences,
+        textureMaxSize = args.texture_max_size,
+        textureFormat = args.texture_format,
+        textureMips = args.texture_mips,
+        textureJobs = args.texture_jobs,
+        imageHash = args.image_hash,
+        embedTextures = args.embed_textures,
+        atlasSize = args.atlas_size,
+        atlasTextureSize = args.atlas_texture_size,
+        mergePrimitives = args.merge_primitives,
+        animJobs = args.anim_jobs,
+        cache = lCache
+    )
+    if not lCache == None:
+        print('Cache: %(hits)d hits, %(misses)d misses, %(evictions)d evictions' % lCache.GetStatistics())
\ No newline at end of file
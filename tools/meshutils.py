@@ -0,0 +1,54 @@
+# ############################################
+# Vertex helpers shared by fbx2gltf and fbx2gltf2
+# ############################################
+import math
+
+# NumPy is optional, functions using it are only called when it is installed.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+def ListFromM4(m):
+    return [m[0][0], m[0][1], m[0][2], m[0][3], m[1][0], m[1][1], m[1][2], m[1][3], m[2][0], m[2][1], m[2][2], m[2][3], m[3][0], m[3][1], m[3][2], m[3][3]]
+
+def ToNumpyArray(pList, pStride):
+    if isinstance(pList, np.ndarray):
+        lCount = pList.shape[0]
+        return pList.reshape(lCount, pList.size // max(lCount, 1))[:, :pStride]
+    if pStride == 1:
+        return np.array(pList).reshape(len(pList), 1)
+    elif pStride == 16:
+        return np.array([ListFromM4(m) for m in pList]).reshape(len(pList), 16)
+    return np.array([[item[i] for i in range(pStride)] for item in pList]).reshape(len(pList), pStride)
+
+def QuantizeKey(pKey, pEpsilon):
+    return tuple([math.floor(v / pEpsilon + 0.5) for v in pKey])
+
+def WeldVertices(pKeys, pEpsilon = 0):
+    if pEpsilon > 0:
+        lKeys = np.floor(pKeys / pEpsilon + 0.5).astype(np.int64)
+    else:
+        # 0.0 and -0.0 are the same key in a python dict
+        lKeys = pKeys + 0.0
+    lKeys = np.ascontiguousarray(lKeys)
+    # Hash on packed rows
+    lRows = lKeys.view(np.dtype((np.void, lKeys.dtype.itemsize * lKeys.shape[1]))).ravel()
+    _, lFirst, lInverse = np.unique(lRows, return_index=True, return_inverse=True)
+    # np.unique sorts the keys, vertices are reordered to the order they first appear.
+    lOrder = np.argsort(lFirst, kind='stable')
+    lRank = np.empty_like(lOrder)
+    lRank[lOrder] = np.arange(len(lOrder))
+    return lRank[lInverse.ravel()], lFirst[lOrder]
+
+# pStreams is a list of (values, splitted). Values not splitted are per control point.
+def WeldVertexStreams(pPolygonVertices, pStreams, pEpsilon = 0):
+    lColumns = []
+    for lValues, lSplitted in pStreams:
+        if lSplitted:
+            lColumns.append(lValues)
+        else:
+            lColumns.append(lValues[pPolygonVertices])
+    lIndices, lFirst = WeldVertices(np.hstack(lColumns), pEpsilon)
+    # Also returns the polygon vertex each welded vertex first appears
+    return lIndices, [lColumn[lFirst] for lColumn in lColumns], lFirst
@@ -2,64 +2,94 @@ import cv2
 import numpy as np
 import sys
 import getopt
+import concurrent.futures
 
-fileInput = None
-fileOutput = None
+# Rows of each band, temporaries are float32 arrays of one band
+BAND_ROWS = 256
 
-opts, args = getopt.getopt(sys.argv[1:], "i:o:", ["input=", "ouput="])
+# 16 bit tif to rgbe png. Channels of the tif are in [0, 256) after divided by 256,
+# they are scaled by 2^-e so the max channel is in [128, 256), alpha is e + 128.
+def EncodeBand(pInput, pOutput, pStart, pEnd):
+    lBand = pInput[pStart:pEnd, :, :3].astype(np.float32)
+    lMax = np.amax(lBand, axis=2)
+    # Exponent of the undivided value is e + 8, the division by 256 is folded in it
+    lMantissa, lExponent = np.frexp(lMax)
+    # Scale 2^(8 - exponent) is exact, black pixels are zero already
+    np.ldexp(np.float32(256), -lExponent, out=lMantissa)
+    lBand *= lMantissa[:, :, np.newaxis]
+    pOutput[pStart:pEnd, :, :3] = lBand
+    # e + 128
+    lExponent += 120
+    lExponent[lMax == 0] = 0
+    pOutput[pStart:pEnd, :, 3] = lExponent
 
-for k, v in opts:
-    if k in ("--input", "-i"):
-        fileInput = v
-    if k in ("--output", "-o"):
-        fileOutput = v
+def DecodeBand(pInput, pOutput, pStart, pEnd):
+    lAlpha = pInput[pStart:pEnd, :, 3]
+    # Exponent in int32, uint8 wraps when 128 is subtracted
+    lExponent = lAlpha.astype(np.int32)
+    lExponent -= 128
+    lScale = np.ldexp(np.float32(1), lExponent)
+    lScale[lAlpha == 0] = 0
+    lBand = pInput[pStart:pEnd, :, :3].astype(np.float32)
+    lBand *= lScale[:, :, np.newaxis]
+    np.minimum(lBand, 65535, out=lBand)
+    pOutput[pStart:pEnd] = lBand
 
-if fileInput == None or fileOutput == None:
-    print "Input or output wrong"
-    sys.exit()
+# Bands write to their own rows of output, numpy releases the GIL in ufuncs
+def ProcessBands(pFunction, pInput, pOutput, pBandRows = BAND_ROWS, pJobs = 1):
+    lHeight = pInput.shape[0]
+    lBands = [(lStart, min(lStart + pBandRows, lHeight)) for lStart in range(0, lHeight, pBandRows)]
+    if pJobs > 1:
+        lExecutor = concurrent.futures.ThreadPoolExecutor(pJobs)
+        lTasks = [lExecutor.submit(pFunction, pInput, pOutput, lStart, lEnd) for lStart, lEnd in lBands]
+        for lTask in lTasks:
+            lTask.result()
+        lExecutor.shutdown()
+    else:
+        for lStart, lEnd in lBands:
+            pFunction(pInput, pOutput, lStart, lEnd)
 
-ext = fileInput.split('.')[-1]
+def Encode(pTif, pBandRows = BAND_ROWS, pJobs = 1):
+    lPng = np.empty((pTif.shape[0], pTif.shape[1], 4), np.uint8)
+    ProcessBands(EncodeBand, pTif, lPng, pBandRows, pJobs)
+    return lPng
 
-if ext == "tif":
-    tif = cv2.imread(fileInput, -1)
-    height = tif.shape[0]
-    width = tif.shape[1]
-    png = np.zeros((height, width, 4), np.uint8)
-    tif = np.array(tif, np.float)
-    tif /= 256.0    # convert to [0. - 1.0]
-    # Tone mapping with reinhard's operator
-    
-    v = np.zeros((height, width), np.float)
-    e = np.zeros((height, width), np.uint32)
-    tmp = np.amax(tif, axis=2)
-    mask = tmp != 0.0
-    np.frexp(tmp, v, e)
-    v[mask] = v[mask] * 256 / tmp[mask]
-    v[tmp == 0] = 0.0
-    e[tmp == 0] = -128
-    png[:,:,0] = tif[:,:,0] * v
-    png[:,:,1] = tif[:,:,1] * v
-    png[:,:,2] = tif[:,:,2] * v
-    png[:,:,3] = e + 128
-    params = list()
-    params.append(cv2.cv.CV_IMWRITE_PNG_COMPRESSION)
-    params.append(10)
-    cv2.imwrite(fileOutput, png, params)
+def Decode(pPng, pBandRows = BAND_ROWS, pJobs = 1):
+    lTif = np.empty((pPng.shape[0], pPng.shape[1], 3), np.uint16)
+    ProcessBands(DecodeBand, pPng, lTif, pBandRows, pJobs)
+    return lTif
 
-if ext == "png":
-    png = cv2.imread(fileInput, -1)
-    height = png.shape[0]
-    width = png.shape[1]
+if __name__ == "__main__":
 
-    tif = np.zeros((height, width, 3), np.uint16)
-    v = np.zeros((height, width), np.float)
-    e = png[:,:,3]
-    # np.ldexp(1, e - 128, v)
-    v = np.power(2.0, e - 128)
-    v[e==0] = 0
-    tif[:,:,0] = png[:,:,0] * v
-    tif[:,:,1] = png[:,:,1] * v
-    tif[:,:,2] = png[:,:,2] * v
-    cv2.imwrite(fileOutput, tif)
+    fileInput = None
+    fileOutput = None
+    bandRows = BAND_ROWS
+    jobs = 1
 
-        
\ No newline at end of file
+    opts, args = getopt.getopt(sys.argv[1:], "i:o:b:j:", ["input=", "output=", "band=", "jobs="])
+
+    for k, v in opts:
+        if k in ("--input", "-i"):
+            fileInput = v
+        if k in ("--output", "-o"):
+            fileOutput = v
+        if k in ("--band", "-b"):
+            bandRows = max(int(v), 1)
+        if k in ("--jobs", "-j"):
+            jobs = int(v)
+
+    if fileInput == None or fileOutput == None:
+        print("Input or output wrong")
+        sys.exit()
+
+    ext = fileInput.split('.')[-1]
+
+    if ext == "tif":
+        tif = cv2.imread(fileInput, -1)
+        png = Encode(tif, bandRows, jobs)
+        cv2.imwrite(fileOutput, png, [cv2.IMWRITE_PNG_COMPRESSION, 9])
+
+    if ext == "png":
+        png = cv2.imread(fileInput, -1)
+        tif = Decode(png, bandRows, jobs)
+        cv2.imwrite(fileOutput, tif)